@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import threading, traceback, os, time
+
+# Runs a backfill (see import-old-tsv.py) as a set of independent work units, one per (date, dataset)
+#
+# The units are run on a pool of BACKFILL_WORKERS threads, each with its own database connection and its own
+# staging table, so several days (and several datasets of the same day) load at once. Every unit that
+# finishes is recorded in the backfill_checkpoints table in the same transaction as its rows, so if a backfill
+# is stopped or falls over, running it again picks up with the units that hadn't finished yet.
+#
+# BACKFILL_RESUME=false ignores the checkpoints and runs every unit again (they are still recorded).
+# The connection pool needs at least BACKFILL_WORKERS connections.
+
+backfill_workers = int(os.environ.get("BACKFILL_WORKERS", 1))
+resume = os.environ.get("BACKFILL_RESUME", "true").lower() in ('1', 'true', 'yes')
+
+CHECKPOINT_TABLE = 'backfill_checkpoints'
+
+# The units that the current run is going to load, and every unit whose rows are (or will be) in the database
+# once it finishes - already checkpointed or part of this run. Filled in by run(), for the importers to check
+pending_units = set()
+covered_units = set()
+
+
+def work_units(dates, datasets):
+    # e.g. work_units(['2023/01/05', ...], ['notes', 'ratings']) -> [('2023/01/05', 'notes'), ('2023/01/05', 'ratings'), ...]
+    return [(date, dataset) for date in dates for dataset in datasets]
+
+
+def previous_date(date):
+    # '2023/01/05' -> '2023/01/04'
+    return (datetime.strptime(date, '%Y/%m/%d') - timedelta(1)).strftime('%Y/%m/%d')
+
+
+def next_date(date):
+    return (datetime.strptime(date, '%Y/%m/%d') + timedelta(1)).strftime('%Y/%m/%d')
+
+
+def is_pending(date, dataset):
+    return (date, dataset) in pending_units
+
+
+def will_load(date, dataset):
+    return (date, dataset) in covered_units
+
+
+def staging_table(date, dataset):
+    # A staging table name that no other unit is using, e.g. temp_ratings_20230105_import_old
+    return 'temp_{0}_{1}_import_old'.format(dataset.lower(), date.replace('/', ''))
+
+
+def ensure_table(connection):
+    # Each worker calls this, so the create is done under an advisory lock - two CREATE TABLE IF NOT EXISTS
+    # racing each other can still fail on pg_type's unique index. The lock goes with the commit below
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('{0}'));".format(CHECKPOINT_TABLE))
+    cursor.execute('CREATE TABLE IF NOT EXISTS {0} ("fileDate" TEXT NOT NULL, "dataset" TEXT NOT NULL, "rows" BIGINT, "seconds" DOUBLE PRECISION, "finishedAt" TIMESTAMP NOT NULL DEFAULT now(), PRIMARY KEY ("fileDate", "dataset"));'.format(CHECKPOINT_TABLE))
+    cursor.close()
+    connection.commit()
+
+
+def completed(connection):
+    # The (date, dataset) units that have already been loaded
+    ensure_table(connection)
+    cursor = connection.cursor()
+    cursor.execute('SELECT "fileDate", "dataset" FROM {0};'.format(CHECKPOINT_TABLE))
+    units = set(cursor.fetchall())
+    cursor.close()
+    connection.commit()
+    return units
+
+
+def checkpoint(connection, date, dataset, rows, seconds):
+    # Doesn't commit - the caller commits it along with the unit's rows
+    cursor = connection.cursor()
+    cursor.execute('INSERT INTO {0} ("fileDate", "dataset", "rows", "seconds") VALUES (%s, %s, %s, %s) ON CONFLICT ("fileDate", "dataset") DO UPDATE SET "rows" = EXCLUDED."rows", "seconds" = EXCLUDED."seconds", "finishedAt" = now();'.format(CHECKPOINT_TABLE), (date, dataset, rows, seconds))
+    cursor.close()
+
+
+def run(db, units, importers, workers=None, make_engine=None, logger=None):
+    # importers maps each dataset to a function(connection, engine, file_path, table_name) that loads that
+    # dataset for one date and returns how many rows it added, without committing
+    # make_engine is called once per worker thread, for anything that needs its own engine (LOAD_METHOD=to_sql)
+    # Returns a summary of what happened
+    if workers is None:
+        workers = backfill_workers
+    connection = db.getconn()
+    checkpointed = completed(connection)
+    db.putconn(connection)
+    done = checkpointed if resume else set()
+    pending = [unit for unit in units if unit not in done]
+    pending_units.clear()
+    pending_units.update(pending)
+    covered_units.clear()
+    covered_units.update(checkpointed)
+    covered_units.update(units)
+    print(f'Backfilling {len(pending)} of {len(units)} units with {workers} worker(s) ({len(units) - len(pending)} already done)')
+    if logger:
+        logger.log_struct(
+            {
+                "message": 'Starting backfill',
+                "severity": 'INFO',
+                "units": str(len(units)),
+                "pending-units": str(len(pending)),
+                "workers": str(workers)
+            })
+
+    local = threading.local()
+    engines = []
+
+    def run_unit(date, dataset):
+        if make_engine and not hasattr(local, 'engine'):
+            local.engine = make_engine()
+            engines.append(local.engine)
+        start_time = time.perf_counter()
+        connection = db.getconn()
+        try:
+            rows = importers[dataset](connection, getattr(local, 'engine', None), date, staging_table(date, dataset))
+            seconds = time.perf_counter() - start_time
+            checkpoint(connection, date, dataset, rows, seconds)
+            connection.commit()
+            return rows, seconds
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            db.putconn(connection)
+
+    summary = {"units": len(units), "skipped": len(units) - len(pending), "loaded": 0, "failed": 0, "rows": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_unit, date, dataset): (date, dataset) for date, dataset in pending}
+        for future in as_completed(futures):
+            date, dataset = futures[future]
+            try:
+                rows, seconds = future.result()
+            except Exception as e:
+                summary["failed"] += 1
+                print(f'Error when backfilling {dataset} for {date}:')
+                print(str(type(e)))
+                print(traceback.format_exc())
+                if logger:
+                    logger.log_struct(
+                        {
+                            "message": 'Backfill unit failed',
+                            "severity": 'WARNING',
+                            "current-date": date,
+                            "dataset": dataset,
+                            "exception": str(type(e))
+                        })
+                continue
+            summary["loaded"] += 1
+            summary["rows"] += rows
+            print(f'Backfilled {dataset} for {date}: {rows} rows in {seconds:.1f}s ({summary["loaded"] + summary["failed"]}/{len(pending)})')
+
+    for engine in engines:
+        engine.close()
+    print(f'Backfill finished: {summary["loaded"]} units loaded, {summary["failed"]} failed, {summary["skipped"]} skipped, {summary["rows"]} rows added')
+    if logger:
+        logger.log_struct(dict({"message": 'Backfill finished', "severity": 'INFO'}, **{key: str(value) for key, value in summary.items()}))
+    return summary
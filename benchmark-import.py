@@ -0,0 +1,212 @@
+import argparse, importlib.util, json, os, platform, subprocess, tempfile, time
+import psycopg2
+import schemas, synthetic_data
+
+# End to end benchmark of the import-tsv.py pipelines on synthetic data
+#
+# Writes a synthetic day's export (see synthetic_data.py) into a directory that stands in for the bucket
+# (STORAGE_BACKEND=local, or mmap if that's what it's set to - see storage_session.py), creates a throwaway database with the Birdwatch tables in it, runs import-tsv.py's
+# main() against the two, and reports the time, rows/sec and memory of every stage of every dataset (see
+# stage_timer.py). The results can be written to a JSON file and compared with an earlier run, e.g. one
+# from before a change:
+#
+# python3 benchmark-import.py --ratings 1000000 --output before.json
+# python3 benchmark-import.py --ratings 1000000 --output after.json --compare before.json
+#
+# The database (--database, default birdwatch_benchmark) is DROPPED and created again every run, so don't point
+# it at one you care about. It uses the postgres server at --host, not DB_HOST/DB_NAME from the environment.
+# Everything else is set up the way import-tsv.py normally is, so settings like STREAMING_IMPORT,
+# TSV_ENGINE, IMPORT_MODE or LOAD_METHOD can be compared by setting them for one run and not the other.
+# Generating 50M ratings takes a few minutes - use --data to keep the files and reuse them next time.
+
+# The settings that change how an import runs, recorded with the results
+SETTINGS = ['STORAGE_BACKEND', 'IMPORT_MODE', 'IMPORT_WORKERS', 'STREAMING_IMPORT', 'TSV_CHUNK_ROWS', 'TSV_ENGINE', 'TSV_PARSE_THREADS', 'APPLY_SCHEMAS', 'SHARD_WORKERS', 'LOAD_METHOD', 'COPY_BATCH_ROWS', 'STAGING_TABLE', 'UPSERT', 'STATUS_SYNC', 'READ_PARQUET']
+
+BUCKET_NAME = 'birdwatch-benchmark' # Only used in log messages, since the bucket is a directory
+
+TABLES = {
+    'notes': 'CREATE TABLE notes ("noteId" BIGINT PRIMARY KEY, "noteAuthorParticipantId" TEXT, "createdAtMillis" BIGINT, "tweetId" BIGINT, "classification" TEXT, "believable" TEXT, "harmful" TEXT, "validationDifficulty" TEXT, {0}, "summary" TEXT);'.format(', '.join('"{0}" SMALLINT'.format(column) for column in schemas.NOTES_FLAGS if column != 'isMediaNote')),
+    'ratings': 'CREATE TABLE ratings ("ratingsId" TEXT PRIMARY KEY, "noteId" BIGINT, "raterParticipantId" TEXT, "createdAtMillis" BIGINT, "version" SMALLINT, "helpfulnessLevel" TEXT, {0});'.format(', '.join('"{0}" SMALLINT'.format(column) for column in schemas.RATINGS_FLAGS)),
+    'status_history': 'CREATE TABLE status_history ("noteId" BIGINT, "noteAuthorParticipantId" TEXT, "createdAtMillis" BIGINT, "timestampMillisOfFirstNonNMRStatus" BIGINT, "firstNonNMRStatus" TEXT, "timestampMillisOfCurrentStatus" BIGINT, "currentStatus" TEXT, "timestampMillisOfLatestNonNMRStatus" BIGINT, "mostRecentNonNMRStatus" TEXT, "timestampMillisOfStatusLock" BIGINT, "lockedStatus" TEXT, "timestampMillisOfRetroLock" BIGINT, "statusId" TEXT PRIMARY KEY);',
+    'enrollment_status': 'CREATE TABLE enrollment_status ("participantId" TEXT, "enrollmentState" TEXT, "successfulRatingNeededToEarnIn" INTEGER, "timestampOfLastStateChange" BIGINT, "timestampOfLastEarnOut" BIGINT, "modelingPopulation" TEXT, "statusId" TEXT PRIMARY KEY);',
+}
+
+
+def generate(directory, args):
+    # Reuses what is already in directory if it was generated with the same arguments
+    parameters = {"ratings": args.ratings, "shards": args.shards, "seed": args.seed}
+    manifest = os.path.join(directory, 'synthetic.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            written = json.load(f)
+        if written["parameters"] == parameters:
+            print(f'Using the synthetic data already in {directory}')
+            return written["rows"], 0.0
+    print(f'Writing a synthetic export with {args.ratings} ratings in {args.shards} shards to {directory}...')
+    start = time.perf_counter()
+    rows = synthetic_data.write_day(directory, args.ratings, args.shards, args.seed)
+    seconds = time.perf_counter() - start
+    with open(manifest, 'w') as f:
+        json.dump({"parameters": parameters, "rows": rows}, f)
+    return rows, seconds
+
+
+def create_database(args):
+    connection = psycopg2.connect(host=args.host, port=5432, user=args.user, password=args.password, dbname='postgres')
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute('DROP DATABASE IF EXISTS "{0}";'.format(args.database))
+    cursor.execute('CREATE DATABASE "{0}";'.format(args.database))
+    cursor.close()
+    connection.close()
+    connection = psycopg2.connect(host=args.host, port=5432, user=args.user, password=args.password, dbname=args.database)
+    cursor = connection.cursor()
+    for sql in TABLES.values():
+        cursor.execute(sql)
+    cursor.close()
+    connection.commit()
+    connection.close()
+
+
+def table_rows(args):
+    connection = psycopg2.connect(host=args.host, port=5432, user=args.user, password=args.password, dbname=args.database)
+    cursor = connection.cursor()
+    rows = {}
+    for table in TABLES:
+        cursor.execute('SELECT count(*) FROM {0};'.format(table))
+        rows[table] = cursor.fetchone()[0]
+    cursor.close()
+    connection.close()
+    return rows
+
+
+def drop_database(args):
+    connection = psycopg2.connect(host=args.host, port=5432, user=args.user, password=args.password, dbname='postgres')
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute('DROP DATABASE IF EXISTS "{0}";'.format(args.database))
+    cursor.close()
+    connection.close()
+
+
+def git_commit():
+    # Which commit was benchmarked, with -dirty on the end if there were uncommitted changes
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except Exception:
+        return None
+
+
+def run_import(bucket_directory, args):
+    # import-tsv.py and the modules it uses read their settings from the environment when they are imported,
+    # so everything has to be set before it's loaded
+    os.environ.update({
+        "STORAGE_BACKEND": os.environ.get("STORAGE_BACKEND") if os.environ.get("STORAGE_BACKEND") in ('local', 'mmap') else 'local',
+        "STORAGE_DIR": bucket_directory,
+        "gcs_bucket_name": BUCKET_NAME,
+        "DATE_OVERRIDE": args.date,
+        "DB_HOST": args.host,
+        "DB_USER": args.user,
+        "DB_PASS": args.password,
+        "DB_NAME": args.database,
+        "LOG_ID": 'benchmark-import',
+        "LOG_SINKS": 'jsonl',
+        "LOG_FILE": os.path.join(bucket_directory, 'benchmark-import.jsonl'),
+    })
+    for name in ['RUN_REPORT', 'PROMETHEUS_TEXTFILE']:
+        os.environ.pop(name, None)
+    spec = importlib.util.spec_from_file_location('import_tsv', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import-tsv.py'))
+    import_tsv = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(import_tsv)
+    start = time.perf_counter()
+    import_tsv.main('benchmark', None)
+    seconds = time.perf_counter() - start
+    return import_tsv.stage_timer.report('benchmark-import'), seconds
+
+
+def stage_results(run):
+    # The totals for each stage, plus the process' peak memory by the time the stage (last) finished
+    peaks = {}
+    for entry in run["stages"]:
+        key = (entry["dataset"], entry["stage"])
+        peaks[key] = max(peaks.get(key, 0), entry["peak-rss-bytes"])
+    results = []
+    for total in run["totals"]:
+        results.append(dict(total, **{"peak-rss-bytes": peaks[(total["dataset"], total["stage"])]}))
+    return results
+
+
+def compare(results, previous):
+    before = {(stage["dataset"], stage["stage"]): stage for stage in previous["stages"]}
+    print(f'\nCompared with {previous.get("commit")} ({previous.get("started")}):')
+    print(f'{"dataset":<18}{"stage":<14}{"before":>14}{"after":>14}  rows/sec')
+    for stage in results["stages"]:
+        old = before.get((stage["dataset"], stage["stage"]))
+        if not old or not old["rows-per-second"] or not stage["rows-per-second"]:
+            continue
+        change = stage["rows-per-second"] / old["rows-per-second"] - 1
+        print(f'{stage["dataset"]:<18}{stage["stage"]:<14}{old["rows-per-second"]:>14,.0f}{stage["rows-per-second"]:>14,.0f}  {change:+.1%}')
+    print(f'Total: {previous["seconds"]:.1f}s -> {results["seconds"]:.1f}s, peak memory {previous["peak-rss-bytes"] / 1024 / 1024:.0f} -> {results["peak-rss-bytes"] / 1024 / 1024:.0f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ratings', type=int, default=1000000, help='Total ratings across all the shards. The other datasets are sized to match')
+    parser.add_argument('--shards', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--date', default='2023/01/05', help='Which day the export is for')
+    parser.add_argument('--data', help='Directory to keep the synthetic data in (default: a temporary one)')
+    parser.add_argument('--host', default='localhost', help='Postgres server (or socket directory) to create the database on')
+    parser.add_argument('--user', default=os.environ.get("BENCHMARK_DB_USER", "postgres"))
+    parser.add_argument('--password', default=os.environ.get("BENCHMARK_DB_PASS", ""))
+    parser.add_argument('--database', default='birdwatch_benchmark', help='Dropped and created again every run!')
+    parser.add_argument('--keep-database', action='store_true', help="Don't drop the database at the end")
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results from an earlier run to compare with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        bucket_directory = args.data or temporary
+        rows, generate_seconds = generate(os.path.join(bucket_directory, *args.date.split('/')), args)
+        create_database(args)
+        try:
+            run, seconds = run_import(bucket_directory, args)
+            loaded = table_rows(args)
+        finally:
+            if not args.keep_database:
+                drop_database(args)
+
+    results = {
+        "benchmark": 'import-tsv',
+        "commit": git_commit(),
+        "started": run["started"],
+        "hostname": run["hostname"],
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {"ratings": args.ratings, "shards": args.shards, "seed": args.seed},
+        "settings": {name: os.environ.get(name) for name in SETTINGS if os.environ.get(name) is not None},
+        "generate-seconds": generate_seconds,
+        "seconds": seconds,
+        "peak-rss-bytes": run["peak-rss-bytes"],
+        "file-rows": rows,
+        "table-rows": loaded,
+        "stages": stage_results(run),
+    }
+    print(f'\n{"dataset":<18}{"stage":<14}{"seconds":>9}{"rows":>13}{"rows/sec":>14}{"peak MiB":>10}')
+    for stage in results["stages"]:
+        rate = f'{stage["rows-per-second"]:,.0f}' if stage["rows-per-second"] else '-'
+        print(f'{stage["dataset"]:<18}{stage["stage"]:<14}{stage["seconds"]:9.2f}{stage["rows"]:>13,}{rate:>14}{stage["peak-rss-bytes"] / 1024 / 1024:>10.0f}')
+    print(f'Imported {sum(loaded.values()):,} rows in {seconds:.1f}s, peak memory {results["peak-rss-bytes"] / 1024 / 1024:.0f} MiB')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import argparse, time
+import surrogate_keys, synthetic_data
+
+# Micro-benchmark for building ratingsId on a synthetic ratings DataFrame (see synthetic_data.py)
+# Compares the old row-by-row lambda with surrogate_keys.ratings_id(), and checks that both produce identical keys
+#
+# Usage: python3 benchmark-keys.py --rows 10000000
+# (the old method takes a good few minutes at 10M rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000000)
+    args = parser.parse_args()
+
+    print(f'Generating a synthetic ratings DataFrame with {args.rows} rows...')
+    df = synthetic_data.ratings(args.rows)
+
+    start = time.perf_counter()
+    legacy = df[['noteId', 'raterParticipantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
+    legacy_time = time.perf_counter() - start
+    print(f'apply(lambda):              {legacy_time:8.2f}s ({args.rows / legacy_time:,.0f} rows/sec)')
+
+    start = time.perf_counter()
+    vectorized = surrogate_keys.ratings_id(df)
+    vectorized_time = time.perf_counter() - start
+    print(f'surrogate_keys.ratings_id:  {vectorized_time:8.2f}s ({args.rows / vectorized_time:,.0f} rows/sec)')
+
+    if not legacy.equals(vectorized):
+        raise SystemExit('Keys do not match!')
+    print(f'Keys are identical. Speedup: {legacy_time / vectorized_time:.1f}x')
+
+if __name__ == "__main__":
+    main()
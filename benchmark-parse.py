@@ -0,0 +1,55 @@
+import argparse, json, os, tempfile, time
+import schemas, synthetic_data, tsv_reader
+
+# Compares the TSV parse engines in tsv_reader.py on synthetic ratings shards
+# Parses the same files with each engine, checks that they all give identical DataFrames, and reports
+# rows/sec along with how many cores' worth of CPU time each engine used
+#
+# Usage: python3 benchmark-parse.py --rows 1000000 --shards 10 [--engines c pyarrow] [--json]
+
+
+def measure(paths, engine):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    frames = [tsv_reader.read_tsv(path, schemas.dtypes_for(path), engine=engine) for path in paths]
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    rows = sum(df.shape[0] for df in frames)
+    return frames, {"rows": rows, "seconds": wall, "rows-per-second": rows / wall, "cores-used": cpu / wall}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000, help='Rows in each shard')
+    parser.add_argument('--shards', type=int, default=10)
+    parser.add_argument('--engines', nargs='+', default=['c', 'pyarrow'])
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        print(f'Writing {args.shards} synthetic ratings shards with {args.rows} rows each...')
+        for i in range(args.shards):
+            path = os.path.join(directory, 'ratings' + str(i).zfill(5) + '.tsv')
+            synthetic_data.write_tsv(synthetic_data.ratings(args.rows, seed=i), path)
+            paths.append(path)
+
+        expected = None
+        for engine in args.engines:
+            frames, results[engine] = measure(paths, engine)
+            if expected is None:
+                expected = frames
+            elif not all(a.equals(b) and (a.dtypes == b.dtypes).all() for a, b in zip(expected, frames)):
+                raise SystemExit(f'{engine} did not give the same DataFrames as {args.engines[0]}!')
+            del frames
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    for engine, result in results.items():
+        print(f'{engine:<10}{result["seconds"]:8.2f}s {result["rows-per-second"]:>14,.0f} rows/sec  {result["cores-used"]:5.1f} cores')
+    print(f'All engines gave identical DataFrames ({os.cpu_count()} cores available)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import pandas as pd
+import argparse, json, os, tempfile, time
+import schemas, synthetic_data
+
+# Memory benchmark for reading a ratings TSV with and without the schema in schemas.py
+# Writes a synthetic ratings file, parses it both ways and reports bytes per row (including the python
+# strings behind object columns) and how long the parse took
+#
+# Usage: python3 benchmark-schemas.py --rows 1000000 [--json]
+
+
+def measure(path, dtype):
+    start = time.perf_counter()
+    df = pd.read_csv(path, sep='\t', header=0, dtype=dtype)
+    seconds = time.perf_counter() - start
+    return {"bytes-per-row": df.memory_usage(index=False, deep=True).sum() / df.shape[0], "parse-seconds": seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ratings00000.tsv')
+        print(f'Writing a synthetic ratings TSV with {args.rows} rows...')
+        synthetic_data.write_tsv(synthetic_data.ratings(args.rows), path)
+        inferred = measure(path, None)
+        typed = measure(path, schemas.dtypes_for(path))
+
+    results = {"rows": args.rows, "inferred": inferred, "schema": typed, "memory-reduction": inferred["bytes-per-row"] / typed["bytes-per-row"]}
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    print(f'inferred dtypes:  {inferred["bytes-per-row"]:8.1f} bytes/row, parsed in {inferred["parse-seconds"]:.2f}s')
+    print(f'schemas.py:       {typed["bytes-per-row"]:8.1f} bytes/row, parsed in {typed["parse-seconds"]:.2f}s')
+    print(f'Memory per row is {results["memory-reduction"]:.1f}x smaller')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from google.api_core.exceptions import NotFound
+import fcntl, glob, os, threading
+
+# A read-through cache on local disk for the files the importers read from the bucket
+#
+# Re-running an import for the same day (DATE_OVERRIDE), or running note-status-only.py and
+# user-enrollment-only.py after import-tsv.py, used to download the same few hundred MB again every time.
+# With BLOB_CACHE=true, storage_session.open_blob() keeps a copy of each object it reads under BLOB_CACHE_DIR,
+# named after the object's generation, and reads that copy for as long as the object hasn't been replaced.
+# Objects are cached as stored (i.e. still gzipped), and asking GCS for the object's metadata is all a hit costs.
+#
+# The cache is kept under BLOB_CACHE_MAX_BYTES by deleting the least recently read files. Any number of threads
+# and processes (e.g. the shard reader's workers, or two scripts at once) can share it: only one of them
+# downloads a given object while the rest wait for it, and files only appear once they are complete.
+#
+# stats() counts hits, misses and how many bytes each way - storage_session.log_stats() reports them.
+
+enabled = os.environ.get("BLOB_CACHE", "false").lower() in ('1', 'true', 'yes')
+cache_dir = os.environ.get("BLOB_CACHE_DIR", "/tmp/birdwatch-cache")
+max_bytes = int(os.environ.get("BLOB_CACHE_MAX_BYTES", 20 * 1024 * 1024 * 1024))
+
+lock = threading.Lock()
+object_locks = {}
+counters = {"hits": 0, "misses": 0, "bytes-from-cache": 0, "bytes-downloaded": 0, "evictions": 0, "evicted-bytes": 0}
+
+
+def entry_path(bucket_name, object, generation):
+    # e.g. <BLOB_CACHE_DIR>/<bucket>/2023/01/05/ratings00000.tsv@1673000000000000
+    return os.path.join(cache_dir, bucket_name, *object.split('/')) + '@' + str(generation)
+
+
+def count(**amounts):
+    with lock:
+        for name, amount in amounts.items():
+            counters[name] += amount
+
+
+@contextmanager
+def locked(path):
+    # Only one thread of one process at a time. flock() only keeps other processes out, so threads need their own lock
+    with lock:
+        thread_lock = object_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_entry(path):
+    # Opens a cached copy and marks it as just used, or returns None if it isn't there (or was just evicted)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass # Evicted since we opened it, but we can still read it
+    count(hits=1, **{"bytes-from-cache": os.fstat(f.fileno()).st_size})
+    return f
+
+
+def fetch(blob, path):
+    # Download blob to path, replacing any copies of older generations of it
+    temporary = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        # As stored, so that gzipped objects stay gzipped (see compression.py)
+        blob.download_to_filename(temporary, raw_download=True)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    size = os.path.getsize(path)
+    count(misses=1, **{"bytes-downloaded": size})
+    for stale in glob.glob(glob.escape(path.rsplit('@', 1)[0]) + '@*'):
+        if stale != path and not stale.endswith(('.lock', '.tmp')):
+            os.remove(stale)
+    evict(keep=path)
+
+
+def evict(keep=None):
+    # Delete the least recently read files until the cache fits in max_bytes. Readers that already have one of
+    # them open can carry on reading it
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, '.evict.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        entries = []
+        for directory, subdirectories, files in os.walk(cache_dir):
+            for file in files:
+                if '@' not in file or file.endswith(('.lock', '.tmp')):
+                    continue
+                path = os.path.join(directory, file)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, path))
+        total = sum(size for used, size, path in entries)
+        for used, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            count(evictions=1, **{"evicted-bytes": size})
+
+
+def open_cached(bucket, object):
+    # A binary file object for reading object from bucket, from the cache when the cached copy is current
+    blob = bucket.get_blob(object)
+    if blob is None:
+        raise NotFound(f'{bucket.name}/{object} does not exist')
+    # Keyed by the generation, which changes every time the object is replaced (or the ETag, if there's no generation)
+    path = entry_path(bucket.name, object, blob.generation or blob.etag)
+    f = open_entry(path)
+    if f is not None:
+        return f
+    with locked(entry_path(bucket.name, object, 'latest')):
+        # Someone else may have downloaded it while we waited
+        f = open_entry(path)
+        if f is None:
+            fetch(blob, path)
+            f = open(path, 'rb')
+    return f
+
+
+def stats():
+    with lock:
+        result = dict(counters)
+    reads = result["hits"] + result["misses"]
+    result["hit-rate"] = round(result["hits"] / reads, 3) if reads else None
+    return result
+
+
+def take_counts():
+    # Returns the counts so far and starts again from zero, for worker processes to hand back to their parent
+    with lock:
+        result = dict(counters)
+        for name in counters:
+            counters[name] = 0
+    return result
+
+
+def add_counts(amounts):
+    count(**amounts)
+
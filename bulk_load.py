@@ -0,0 +1,201 @@
+import pandas as pd
+import io, os, time
+import stage_timer
+
+# Shared helpers for getting a DataFrame into a staging table in postgres.
+#
+# The original approach was df.to_sql(table_name, engine, if_exists='replace'), which sends the
+# data as (lots of) INSERT statements and is by far the slowest part of the nightly import.
+# Here we instead stream the rows into the staging table using COPY ... FROM STDIN.
+#
+# LOAD_METHOD can be set to 'to_sql' to go back to the old behavior - mostly useful for comparing the
+# rows/sec numbers that get logged by load_dataframe()
+#
+# Staging tables are TEMP tables by default (STAGING_TABLE=temp). They only exist for the connection that
+# created them, nothing written to them goes through the write-ahead log, and postgres drops them itself when
+# the connection closes - so an import that falls over half way doesn't leave temp_* tables lying around.
+# STAGING_TABLE=unlogged makes a regular table that skips the WAL, for when the staging table has to be read
+# from a different connection, and STAGING_TABLE=logged is the old behavior.
+
+load_method = os.environ.get("LOAD_METHOD", "copy")
+copy_batch_rows = int(os.environ.get("COPY_BATCH_ROWS", 100000)) # How many rows get serialized into memory for each COPY statement
+staging_table = os.environ.get("STAGING_TABLE", "temp")
+upsert = os.environ.get("UPSERT", "true").lower() in ('1', 'true', 'yes') # Update rows that have changed (see merge_sql), rather than only adding new ones
+
+STAGING_KINDS = {'temp': 'TEMP ', 'unlogged': 'UNLOGGED ', 'logged': ''}
+
+
+def target_columns(connection, target_table):
+    # Look up which columns actually exist on the destination table
+    cursor = connection.cursor()
+    cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position;', (target_table,))
+    columns = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return columns
+
+
+def create_staging_table(connection, table_name, target_table, kind=None):
+    # The staging table gets the same column types as the real table. This means the COPY is what
+    # parses the values, instead of pandas guessing at the types (see the timestampMillisOfStatusLock mess)
+    if kind is None:
+        kind = staging_table
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS {0} CASCADE;'.format(table_name))
+    cursor.execute('CREATE {2}TABLE {0} (LIKE {1});'.format(table_name, target_table, STAGING_KINDS[kind]))
+    cursor.close()
+
+
+def primary_key(connection, target_table):
+    # The columns of target_table's primary key, or [] if it doesn't have one
+    cursor = connection.cursor()
+    cursor.execute('SELECT a.attname FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) WHERE i.indrelid = %s::regclass AND i.indisprimary ORDER BY a.attnum;', (target_table,))
+    columns = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return columns
+
+
+def merge_sql(table_name, target_table, columns, key_columns, casts=None, newest_column=None, cleared=()):
+    # INSERT the staging table into target_table. Rows that are already there are updated, but only if one of
+    # their values has actually changed, so unchanged rows don't cost a new row version (and its WAL)
+    # casts is e.g. {"timestampMillisOfStatusLock": "BIGINT"}, and newest_column picks the row that is kept when
+    # the staging table has a key in it more than once (the one where it's highest)
+    # cleared columns are set to NULL on every row that gets updated, e.g. a hash of the row that would be out of date
+    casts = casts or {}
+    column_list = ', '.join('"' + column + '"' for column in columns)
+    select_list = ', '.join('"' + column + '"' + ('::' + casts[column] if column in casts else '') for column in columns)
+    key_list = ', '.join('"' + column + '"' for column in key_columns)
+    if not upsert or not key_columns:
+        return 'INSERT INTO {0} ({1}) SELECT {2} FROM {3} ON CONFLICT DO NOTHING;'.format(target_table, column_list, select_list, table_name)
+    updates = [column for column in columns if column not in key_columns]
+    set_list = ', '.join(['"{0}" = EXCLUDED."{0}"'.format(column) for column in updates] + ['"{0}" = NULL'.format(column) for column in cleared])
+    changed = '({0}) IS DISTINCT FROM ({1})'.format(', '.join('{0}."{1}"'.format(target_table, column) for column in updates), ', '.join('EXCLUDED."{0}"'.format(column) for column in updates))
+    # DISTINCT ON, because ON CONFLICT DO UPDATE refuses to touch the same row twice if a file has a key in it more than once
+    # Without the ORDER BY, which of the duplicates wins is up to however postgres happens to read them
+    order_list = key_list + (', "{0}" DESC NULLS LAST'.format(newest_column) if newest_column else '')
+    return 'INSERT INTO {0} ({1}) SELECT DISTINCT ON ({4}) {2} FROM {3} ORDER BY {7} ON CONFLICT ({4}) DO UPDATE SET {5} WHERE {6};'.format(target_table, column_list, select_list, table_name, key_list, set_list, changed, order_list)
+
+
+def wal_position(connection):
+    # Where the server's write-ahead log is up to, so that wal_bytes() can tell how much an import wrote
+    # Returns None if the server won't say (e.g. not allowed to, or it's not postgres 10+)
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_current_wal_lsn()::text;')
+        position = cursor.fetchone()[0]
+        cursor.close()
+        connection.commit()
+        return position
+    except Exception as e:
+        print(f'Unable to read the WAL position ({type(e).__name__})')
+        connection.rollback()
+        return None
+
+
+def wal_bytes(connection, position):
+    # Bytes of WAL written (by everything on the server, not just us) since wal_position() returned position
+    if position is None:
+        return None
+    end = wal_position(connection)
+    if end is None:
+        return None
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_wal_lsn_diff(%s::pg_lsn, %s::pg_lsn);', (end, position))
+    written = int(cursor.fetchone()[0])
+    cursor.close()
+    connection.commit()
+    return written
+
+
+def log_wal(connection, position, target_table, logger=None):
+    written = wal_bytes(connection, position)
+    if written is None:
+        return None
+    print(f'Importing {target_table} wrote {written / 1024 / 1024:.1f} MiB of WAL (staging tables are {staging_table})')
+    if logger:
+        logger.log_struct(
+            {
+                "message": 'WAL written during import',
+                "severity": 'INFO',
+                "table": target_table,
+                "staging-table": staging_table,
+                "wal-bytes": str(written)
+            })
+    return written
+
+
+def integral_floats_to_int(df):
+    # pandas turns integer columns with any missing values into floats, which would then be written
+    # as e.g. '1677000000000.0' and rejected by a BIGINT column. Convert those back to nullable ints
+    for column in df.columns:
+        if pd.api.types.is_float_dtype(df[column]):
+            try:
+                df[column] = df[column].astype('Int64')
+            except (TypeError, ValueError):
+                pass # Actually has fractional values, so leave it alone
+    return df
+
+
+def copy_dataframe(connection, df, table_name, columns):
+    # Stream the DataFrame into table_name in batches of copy_batch_rows, so we never have more
+    # than one batch worth of CSV text in memory at a time
+    column_list = ', '.join('"' + column + '"' for column in columns)
+    sql = 'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv);'.format(table_name, column_list)
+    cursor = connection.cursor()
+    for start in range(0, df.shape[0], copy_batch_rows):
+        batch = integral_floats_to_int(df[columns].iloc[start:start + copy_batch_rows].copy())
+        buffer = io.StringIO()
+        batch.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, buffer) # psycopg2
+        else:
+            cursor.execute(sql, stream=buffer) # pg8000 (the Cloud SQL connector scripts)
+    cursor.close()
+    return df.shape[0]
+
+
+def load_chunks(chunks, table_name, target_table, connection, engine=None, logger=None, staging=None):
+    # Put every DataFrame from chunks into a staging table called table_name, ready to be copied into target_table
+    # chunks can be a generator (e.g. tsv_reader.read_tsv_chunks), in which case only one chunk is in memory at a time
+    # staging overrides STAGING_TABLE. LOAD_METHOD=to_sql always makes a regular table, since it goes through engine's connection
+    # Returns the number of rows that were loaded
+    # The stage timing (see stage_timer.py) leaves out the time spent producing the chunks, which is timed on its own
+    stage = stage_timer.start(target_table, 'load')
+    chunks = stage.excluding(chunks)
+    start_time = time.perf_counter()
+    rows = 0
+    if load_method == 'to_sql':
+        if_exists = 'replace'
+        for chunk in chunks:
+            chunk.to_sql(table_name, engine, if_exists=if_exists)
+            if_exists = 'append'
+            rows += chunk.shape[0]
+        if hasattr(engine, 'commit'):
+            engine.commit()
+    else:
+        create_staging_table(connection, table_name, target_table, staging)
+        available = target_columns(connection, target_table)
+        for chunk in chunks:
+            columns = [column for column in chunk.columns if column in available]
+            rows += copy_dataframe(connection, chunk, table_name, columns)
+        connection.commit()
+    stage.stop(rows=rows)
+    elapsed = time.perf_counter() - start_time
+    rate = rows / elapsed if elapsed > 0 else 0
+    print(f'Loaded {rows} rows into {table_name} using {load_method} in {elapsed:.2f} seconds ({rate:,.0f} rows/sec)')
+    if logger:
+        logger.log_struct(
+            {
+                "message": 'Loaded dataframe into staging table',
+                "severity": 'INFO',
+                "table-name": table_name,
+                "load-method": load_method,
+                "rows": str(rows),
+                "seconds": str(round(elapsed, 3)),
+                "rows-per-second": str(round(rate))
+            })
+    return rows
+
+
+def load_dataframe(df, table_name, target_table, connection, engine=None, logger=None, staging=None):
+    return load_chunks([df], table_name, target_table, connection, engine, logger, staging)
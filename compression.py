@@ -0,0 +1,47 @@
+import gzip, os
+
+# Compressed storage for the TSVs in the bucket
+#
+# Files are uploaded gzipped, keeping their .tsv names, with Content-Encoding: gzip set on the object. GCS
+# transcodes these on the fly for anyone who downloads them without asking for gzip, so other users of the
+# public bucket still get a plain TSV. The importers download the stored bytes as-is and decompress them
+# themselves. Files are recognised by their first bytes rather than their metadata, so raw and gzipped
+# objects can sit side by side (see recompress-archive.py for converting the existing ones).
+#
+# UPLOAD_COMPRESSION=none uploads raw TSVs like before.
+
+upload_compression = os.environ.get("UPLOAD_COMPRESSION", "gzip").lower()
+compression_level = int(os.environ.get("COMPRESSION_LEVEL", 6)) # 1 is fastest, 9 is smallest
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def compress(data):
+    # Returns (data to upload, the Content-Encoding to set on the object or None)
+    if upload_compression != 'gzip':
+        return data, None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    # mtime=0 so that compressing the same file twice gives exactly the same bytes
+    return gzip.compress(data, compresslevel=compression_level, mtime=0), 'gzip'
+
+
+def is_gzip(header):
+    return header[:2] == GZIP_MAGIC
+
+
+def decompressed(f):
+    # Wrap a binary file object so that it reads the raw TSV whether or not it was stored gzipped
+    # f needs to be seekable, so that the first couple of bytes can be looked at and put back
+    header = f.read(2)
+    f.seek(0)
+    if is_gzip(header):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    return f
+
+
+def read_all(data):
+    # bytes version of decompressed()
+    if is_gzip(data):
+        return gzip.decompress(data)
+    return data
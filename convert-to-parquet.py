@@ -0,0 +1,41 @@
+from datetime import date, timedelta
+import argparse, os
+import storage_session, parquet_snapshots
+
+# Create Parquet snapshots (see parquet_snapshots.py) for TSVs that are already in the bucket
+#
+# e.g. python convert-to-parquet.py --start 2022-10-01 --end 2023-03-01 --workers 16
+#
+# Files whose snapshot is newer than the TSV are skipped, so this can be stopped and started again. Use
+# --overwrite to rewrite them anyway (for example after changing PARQUET_ROW_GROUP_ROWS).
+
+bucket_name = os.environ.get("gcs_bucket_name")
+project_id = os.environ.get("GCP_PROJECT")
+
+
+def daterange(start_date, end_date):
+    for n in range(int((end_date - start_date).days) + 1):
+        yield start_date + timedelta(n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write Parquet snapshots of the TSVs in the bucket')
+    parser.add_argument('--start', type=date.fromisoformat, default=date.today(), help='First date to convert (YYYY-MM-DD)')
+    parser.add_argument('--end', type=date.fromisoformat, default=date.today(), help='Last date to convert (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    bucket = storage_session.get_bucket(bucket_name, project_id)
+    objects = []
+    for single_date in daterange(args.start, args.end):
+        prefix = single_date.strftime("%Y/%m/%d") + '/'
+        objects += [blob.name for blob in bucket.list_blobs(prefix=prefix) if blob.name.endswith('.tsv')]
+    print(f'Found {len(objects)} TSVs between {args.start} and {args.end}')
+
+    parquet_snapshots.convert_all(bucket_name, objects, project_id, workers=args.workers, overwrite=args.overwrite)
+    storage_session.log_stats()
+
+
+if __name__ == "__main__":
+    main()
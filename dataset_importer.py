@@ -0,0 +1,491 @@
+import pandas as pd
+import traceback
+import bulk_load, tsv_reader, surrogate_keys, watermarks, storage_session, parquet_snapshots, schemas, shard_reader, status_sync, stage_timer, snapshot_delta
+
+# The one import pipeline that every dataset and every script goes through
+#
+# Importing notes, ratings, noteStatusHistory or userEnrollmentStatus is the same job each time: read the
+# day's file(s), throw away the rows we already have, build the surrogate key, load what's left into a staging
+# table, copy that into the real table and drop the staging table. This used to be pasted into each of
+# import-tsv.py, import-old-tsv.py, note-status-only.py and user-enrollment-only.py, and the copies had drifted
+# apart. Now each dataset is described once (DATASETS below) and all four scripts run them through an
+# Importer, so they all get the same streaming, parallel shard reads, Parquet snapshots, TEMP staging tables,
+# upserts, stage timings and WAL logging.
+#
+# Which rows are kept depends on the Importer's mode (IMPORT_MODE by default):
+# - incremental: rows newer than the table's watermark (see watermarks.py)
+# - trim: the newest 10% of the file, by the dataset's trim column
+# - all: every row, for backfills (import-old-tsv.py), which can pass their own dedup instead
+#
+# With STREAMING_IMPORT=true every dataset is streamed into its staging table in chunks. Nothing can be sorted
+# that way, so in trim mode every row gets loaded.
+#
+# With READ_DELTA=true, a day that has a delta (see snapshot_delta.py) is loaded from that instead. It only has
+# the rows that are new or changed since the day before, so all of them are loaded whatever the mode.
+
+
+class Dataset:
+    # name is what the TSV files are called, and table is where they get imported to
+    # key is the surrogate key column built by build_key (None if the file already has one), from key_columns
+    # columns are copied into table, with casts (e.g. {"timestampMillisOfStatusLock": "BIGINT"}) applied on the way
+    # numeric_columns are coerced into integers before loading, with anything that isn't a number becoming 0
+    # optional_columns are missing from some older files, and get added to to_sql staging tables as the given type
+    # sharded datasets can be split across numbered files (e.g. ratings00000.tsv ... ratings00009.tsv)
+    # other_names are numbered names that a dataset's single file has gone by. Only the first of them that a day
+    # has is read, and name.tsv if it has none of them
+    # upsert updates rows that are already there when they've changed, rather than only adding new ones
+    # synced uses status_sync.py when STATUS_SYNC=true
+    # newest_column says which of two rows with the same key is the newer one, when a file has a key in it more
+    # than once (trim_column if not given)
+    def __init__(self, name, table, staging_name, columns, trim_column, key=None, build_key=None, sharded=False,
+                 upsert=False, synced=False, casts=None, numeric_columns=(), optional_columns=None, key_columns=(),
+                 newest_column=None, other_names=()):
+        self.name = name
+        self.table = table
+        self.staging_name = staging_name
+        self.columns = columns
+        self.trim_column = trim_column
+        self.key = key
+        self.build_key = build_key
+        self.sharded = sharded
+        self.other_names = other_names
+        self.upsert = upsert
+        self.synced = synced
+        self.casts = casts or {}
+        self.numeric_columns = numeric_columns
+        self.optional_columns = optional_columns or {}
+        self.key_columns = key_columns
+        self.newest_column = newest_column or trim_column
+
+    def staging_table(self, suffix):
+        # e.g. temp_status_20230105
+        return 'temp_{0}_{1}'.format(self.staging_name, suffix)
+
+    def read_columns(self):
+        # Every column of the file that an import uses: the ones that are loaded, the ones the key is built
+        # from, and the ones it's trimmed or filtered by. Only these are read from Parquet snapshots
+        wanted = self.columns + list(self.key_columns) + [self.trim_column] + watermarks.WATERMARK_COLUMNS[self.table]
+        return list(dict.fromkeys(wanted))
+
+
+DATASETS = {
+    'notes': Dataset(
+        'notes', 'notes', 'notes',
+        ["noteId", "createdAtMillis", "tweetId", "classification", "believable", "harmful", "validationDifficulty", "misleadingOther", "misleadingFactualError", "misleadingManipulatedMedia", "misleadingOutdatedInformation", "misleadingMissingImportantContext", "misleadingUnverifiedClaimAsFact", "misleadingSatire", "notMisleadingOther", "notMisleadingFactuallyCorrect", "notMisleadingOutdatedButNotWhenWritten", "notMisleadingClearlySatire", "notMisleadingPersonalOpinion", "trustworthySources", "summary", "noteAuthorParticipantId"],
+        'createdAtMillis',
+        # Newer days are notes00004.tsv or notes00000.tsv rather than notes.tsv. They aren't shards: import-tsv.py
+        # has always read notes00004.tsv on days that have both, so that's the one that's used
+        other_names=['notes00004', 'notes00000']),
+    'ratings': Dataset(
+        'ratings', 'ratings', 'ratings',
+        ["noteId", "createdAtMillis", "version", "agree", "disagree", "helpful", "notHelpful", "helpfulnessLevel", "helpfulOther", "helpfulInformative", "helpfulClear", "helpfulEmpathetic", "helpfulGoodSources", "helpfulUniqueContext", "helpfulAddressesClaim", "helpfulImportantContext", "helpfulUnbiasedLanguage", "notHelpfulOther", "notHelpfulIncorrect", "notHelpfulSourcesMissingOrUnreliable", "notHelpfulOpinionSpeculationOrBias", "notHelpfulMissingKeyPoints", "notHelpfulOutdated", "notHelpfulHardToUnderstand", "notHelpfulArgumentativeOrBiased", "notHelpfulOffTopic", "notHelpfulSpamHarassmentOrAbuse", "notHelpfulIrrelevantSources", "notHelpfulOpinionSpeculation", "notHelpfulNoteNotNeeded", "ratingsId", "raterParticipantId"],
+        'createdAtMillis',
+        key='ratingsId', build_key=surrogate_keys.ratings_id, key_columns=['noteId', 'raterParticipantId'], sharded=True),
+    'noteStatusHistory': Dataset(
+        'noteStatusHistory', 'status_history', 'status',
+        ["noteId", "noteAuthorParticipantId", "createdAtMillis", "timestampMillisOfFirstNonNMRStatus", "firstNonNMRStatus", "timestampMillisOfCurrentStatus", "currentStatus", "timestampMillisOfLatestNonNMRStatus", "mostRecentNonNMRStatus", "timestampMillisOfStatusLock", "lockedStatus", "timestampMillisOfRetroLock", "statusId"],
+        'createdAtMillis',
+        # Note statuses change over time, so notes that are already in the table get their new status rather than being skipped
+        key='statusId', build_key=surrogate_keys.status_history_id, upsert=True, synced=True, newest_column='timestampMillisOfCurrentStatus',
+        # Some older files have participantId instead of noteAuthorParticipantId
+        key_columns=['noteId', 'noteAuthorParticipantId', 'participantId'],
+        # Many rows have a timestampMillisOfStatusLock of -1 or nothing at all, which used to end up as TEXT
+        # and get rejected by the BIGINT column (see the README)
+        casts={"timestampMillisOfStatusLock": "BIGINT"}, numeric_columns=['timestampMillisOfStatusLock']),
+    'userEnrollmentStatus': Dataset(
+        'userEnrollmentStatus', 'enrollment_status', 'enrollment',
+        ["participantId", "enrollmentState", "successfulRatingNeededToEarnIn", "timestampOfLastStateChange", "timestampOfLastEarnOut", "modelingPopulation", "statusId"],
+        'timestampOfLastStateChange',
+        # Participant Ids may be duplicated (because the same user's status may change), so the timestamp is part of the key
+        key='statusId', build_key=surrogate_keys.enrollment_status_id, key_columns=['participantId', 'timestampOfLastStateChange'], upsert=True,
+        # Older files don't have modelingPopulation
+        optional_columns={"modelingPopulation": "TEXT"}),
+}
+
+
+class Importer:
+    # bucket_name and project_id are where the files are read from
+    # updates=False only ever adds rows - no upserts or status sync - for backfills, which shouldn't replace a
+    # newer status with an older one
+    # dedup(chunks, file_path, dataset) can filter the rows before anything else happens, and must yield chunks
+    def __init__(self, bucket_name, project_id=None, logger=None, mode=None, updates=True, dedup=None):
+        self.bucket_name = bucket_name
+        self.project_id = project_id
+        self.logger = logger
+        self.mode = mode or watermarks.import_mode
+        self.updates = updates
+        self.dedup = dedup
+
+    def objects(self, dataset, file_path):
+        # The day's files for dataset: its numbered shards if it has any, otherwise e.g. 2023/01/05/notes.tsv
+        if dataset.sharded or dataset.other_names:
+            objects = shard_reader.list_shards(self.bucket_name, file_path, dataset.name, self.project_id)
+            if dataset.other_names:
+                names = [file_path + '/' + name + '.tsv' for name in dataset.other_names]
+                objects = [name for name in names if name in objects][:1]
+            if objects:
+                return objects
+        return [file_path + '/' + dataset.name + '.tsv']
+
+    def retrieve(self, object, filters=None, columns=None):
+        # With READ_PARQUET=true, the Parquet snapshot of object is read instead when there is one (see parquet_snapshots.py)
+        # filters lets it skip the rows (and whole row groups) that we are going to throw away anyway, and
+        # columns the columns (see snapshot_columns)
+        table = parquet_snapshots.DATASET_TABLES.get(schemas.dataset_name(object))
+        if parquet_snapshots.read_parquet and parquet_snapshots.exists(self.bucket_name, object, self.project_id):
+            path = storage_session.url(self.bucket_name, parquet_snapshots.snapshot_name(object))
+            print(f'Loading {path} into a pandas DataFrame...')
+            self.logger.log_struct(
+                {
+                    "message": "Retrieving Parquet snapshot and loading into Pandas dataframe",
+                    "severity": "INFO",
+                    "object": str(object),
+                    "gcs-path": str(path)
+                })
+            with stage_timer.start(table, 'read-parquet') as stage:
+                df = parquet_snapshots.read(self.bucket_name, object, self.project_id, columns=columns, filters=filters)
+                stage.rows = df.shape[0]
+            return df
+        path = storage_session.url(self.bucket_name, object)
+        print(f'Loading {path} into a pandas DataFrame...')
+        self.logger.log_struct(
+            {
+                "message": "Retrieving TSV and loading into Pandas dataframe",
+                "severity": "INFO",
+                "object": str(object),
+                "gcs-path": str(path)
+            })
+        # Read through the shared storage client rather than letting pandas open a new connection for every file
+        # The time spent waiting on the download is counted separately from the parse (see stage_timer.py)
+        with stage_timer.start(table, 'parse') as stage:
+            with storage_session.open_blob(self.bucket_name, object, self.project_id) as f:
+                f = stage_timer.TimedReader(f)
+                df = tsv_reader.read_tsv(f, schemas.dtypes_for(object))
+            stage.rows = df.shape[0]
+            stage.split_off('download', f.seconds, bytes=f.bytes)
+        return df
+
+    def retrieve_chunks(self, object, columns=None):
+        table = parquet_snapshots.DATASET_TABLES.get(schemas.dataset_name(object))
+        if parquet_snapshots.read_parquet and parquet_snapshots.exists(self.bucket_name, object, self.project_id):
+            path = storage_session.url(self.bucket_name, parquet_snapshots.snapshot_name(object))
+            print(f'Streaming {path} in chunks of up to {tsv_reader.tsv_chunk_rows} rows...')
+            self.logger.log_struct(
+                {
+                    "message": "Retrieving Parquet snapshot and streaming it in chunks",
+                    "severity": "INFO",
+                    "object": str(object),
+                    "gcs-path": str(path),
+                    "chunk-rows": str(tsv_reader.tsv_chunk_rows)
+                })
+            yield from stage_timer.timed_chunks(parquet_snapshots.read_chunks(self.bucket_name, object, self.project_id, columns=columns), table, 'read-parquet')
+            return
+        path = storage_session.url(self.bucket_name, object)
+        print(f'Streaming {path} in chunks of up to {tsv_reader.tsv_chunk_rows} rows...')
+        self.logger.log_struct(
+            {
+                "message": "Retrieving TSV and streaming it in chunks",
+                "severity": "INFO",
+                "object": str(object),
+                "gcs-path": str(path),
+                "chunk-rows": str(tsv_reader.tsv_chunk_rows)
+            })
+        with storage_session.open_blob(self.bucket_name, object, self.project_id) as f:
+            f = stage_timer.TimedReader(f)
+            yield from stage_timer.timed_chunks(tsv_reader.read_tsv_chunks(f, dtype=schemas.dtypes_for(object)), table, 'parse', f)
+
+    def unreadable(self, object, e):
+        print(f'Unable to read {object}')
+        print(str(type(e)))
+        self.logger.log_struct(
+            {
+                "message": "Unable to read file",
+                "severity": "WARNING",
+                "object": str(object),
+                "exception": str(type(e))
+            })
+
+    def snapshot_columns(self, dataset):
+        # The columns to read from Parquet snapshots. All of them for a dedup, which fingerprints whole rows
+        return None if self.dedup else dataset.read_columns()
+
+    def read(self, dataset, objects, connection):
+        # The whole of the day's files as one DataFrame
+        filters = parquet_snapshots.watermark_filters(connection, objects[0]) if self.mode == 'incremental' else None
+        columns = self.snapshot_columns(dataset)
+        if len(objects) == 1:
+            return self.retrieve(objects[0], filters, columns)
+        # Several shards are downloaded and parsed in parallel worker processes (see shard_reader.py), so
+        # downloading and parsing are timed together here
+        frames = []
+        reading = stage_timer.start(dataset.table, 'read-shards')
+        for object, df in shard_reader.read_shards(self.bucket_name, objects, self.project_id, filters, on_error=self.unreadable, columns=columns):
+            print(f'Read {object} ({df.shape[0]} rows)')
+            frames.append(df)
+        reading.stop(rows=sum(frame.shape[0] for frame in frames))
+        if not frames:
+            raise FileNotFoundError(f'None of the {dataset.name} files could be read: {objects}')
+        with stage_timer.start(dataset.table, 'concat') as concat:
+            df = pd.concat(frames, ignore_index=True) # concatenate once at the end, rather than copying everything we've seen so far for each file
+            concat.rows = df.shape[0]
+        return df
+
+    def keep(self, dataset, df, connection):
+        # Drops the rows that don't need loading. Returns the DataFrame and the watermark to save once it's committed
+        if self.mode == 'all':
+            return df, None
+        new_mark = None
+        trim = stage_timer.start(dataset.table, 'filter' if self.mode == 'incremental' else 'trim')
+        if self.mode == 'incremental':
+            df, new_mark = watermarks.filter_dataframe(df, dataset.table, connection, self.logger)
+        elif self.syncing(dataset):
+            # Compare every row against what is stored - only the ones that have changed get written
+            pass
+        else:
+            df.sort_values(by=[dataset.trim_column], ascending=False, inplace=True)
+            # Only keep the top 10% of the dataframe - we are almost always dealing with duplicated data, so this will improve runtime
+            size = df.shape[0]
+            drop = int(size * 0.9)
+            # drop = int(size - 10) # use a small number when testing - it'll go way faster!
+            df.drop(df.tail(drop).index, inplace = True)
+            self.logger.log_struct(
+                {
+                    "message": 'Dropped rows from dataframe',
+                    "table": dataset.table,
+                    "original-size": str(size),
+                    "dropped-rows": str(drop),
+                    "new-size": str(df.shape[0]),
+                    "severity": 'INFO',
+                }
+            )
+        trim.stop(rows=df.shape[0])
+        return df, new_mark
+
+    def prepare(self, dataset, df):
+        # The keys are only built for the rows that are being kept
+        for column in dataset.numeric_columns:
+            # Coax this column into being an actual number, and replace any NaN values with 0
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype(int)
+        if dataset.key:
+            keys = stage_timer.start(dataset.table, 'keys')
+            df[dataset.key] = dataset.build_key(df)
+            keys.stop(rows=df.shape[0])
+        return df
+
+    def file_chunks(self, dataset, objects):
+        # Every file of the day in turn, one chunk at a time. A file that can't be read is skipped (unless it's the
+        # only one), but one that fails after some of it has gone into the staging table stops the import, which
+        # is rolled back: skipping the rest would leave it half loaded, and the watermark past rows that weren't
+        for object in objects:
+            started = False
+            try:
+                for chunk in self.retrieve_chunks(object, self.snapshot_columns(dataset)):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if len(objects) == 1 or started:
+                    raise
+                self.unreadable(object, e)
+
+    def chunks(self, dataset, objects, file_path, connection, marks):
+        # Every file of the day, one chunk at a time, ready to load. The newest timestamp of each chunk is added to marks
+        mark = watermarks.get_watermark(connection, dataset.table) if self.mode == 'incremental' else None
+        chunks = self.file_chunks(dataset, objects)
+        if self.dedup:
+            # Once for the whole day, so that every shard is compared against the whole of the previous day
+            chunks = self.dedup(chunks, file_path, dataset)
+        for chunk in chunks:
+            if self.mode == 'incremental':
+                filtering = stage_timer.start(dataset.table, 'filter')
+                chunk, newest = watermarks.filter_rows(chunk, dataset.table, mark)
+                marks.append(newest)
+                filtering.stop(rows=chunk.shape[0])
+            yield self.prepare(dataset, chunk)
+        if self.mode == 'incremental':
+            marks.append(mark)
+
+    def syncing(self, dataset):
+        return dataset.synced and self.updates and status_sync.status_sync
+
+    def stage_delta(self, dataset, connection, file_path, table_name, engine=None):
+        # The same as stage(), from the day's delta. The watermark still moves on past the rows in it
+        name = snapshot_delta.delta_name(dataset.name, file_path, 'changes')
+        previous = snapshot_delta.previous_date(self.bucket_name, dataset.name, file_path, self.project_id)
+        print(f'Loading {storage_session.url(self.bucket_name, name)}, the changes since {previous}')
+        self.logger.log_struct(
+            {
+                "message": 'Loading the delta into a temporary table',
+                "severity": "INFO",
+                "dataset": dataset.name,
+                "object": name,
+                "previous-date": str(previous),
+                "table-name": table_name
+            })
+        chunks = stage_timer.timed_chunks(snapshot_delta.read_chunks(self.bucket_name, dataset.name, file_path, self.project_id, chunk_rows=tsv_reader.tsv_chunk_rows), dataset.table, 'read-delta')
+        marks = []
+        def prepared():
+            for chunk in chunks:
+                if self.mode == 'incremental':
+                    marks.append(watermarks.filter_rows(chunk, dataset.table, None)[1])
+                yield self.prepare(dataset, chunk.drop(columns=[snapshot_delta.CHANGE_COLUMN]))
+        bulk_load.load_chunks(prepared(), table_name, dataset.table, connection, engine, self.logger)
+        marks = [mark for mark in marks if mark is not None]
+        return max(marks) if marks else None
+
+    def stage(self, dataset, connection, file_path, table_name, engine=None):
+        # Everything up to and including the staging table. Returns the watermark to save once it's committed
+        if snapshot_delta.read_delta and snapshot_delta.exists(self.bucket_name, dataset.name, file_path, self.project_id):
+            return self.stage_delta(dataset, connection, file_path, table_name, engine)
+        objects = self.objects(dataset, file_path)
+        print(f'Found {len(objects)} {dataset.name} file(s) under {file_path}')
+        self.logger.log_struct(
+            {
+                "message": "Listed files",
+                "severity": "INFO",
+                "dataset": dataset.name,
+                "gcs-path-prefix": str(file_path),
+                "objects": str(objects)
+            })
+        if tsv_reader.streaming_import:
+            # Only one chunk is ever in memory, so there's nothing to sort and trim
+            marks = []
+            print(f'Now streaming {dataset.name} into a temporary table')
+            self.logger.log_struct(
+                {
+                    "message": 'Now streaming into a temporary table',
+                    "severity": "INFO",
+                    "dataset": dataset.name,
+                    "gcs-path-prefix": str(file_path),
+                    "table-name": table_name
+                })
+            bulk_load.load_chunks(self.chunks(dataset, objects, file_path, connection, marks), table_name, dataset.table, connection, engine, self.logger)
+            marks = [mark for mark in marks if mark is not None]
+            return max(marks + [-1]) if self.mode == 'incremental' else None
+        df = self.read(dataset, objects, connection)
+        if self.dedup:
+            [df] = list(self.dedup([df], file_path, dataset))
+        df, new_mark = self.keep(dataset, df, connection)
+        df = self.prepare(dataset, df)
+        print(df.info())
+        print(df)
+        print(f'Now converting dataframe into sql and placing into a temporary table called {table_name}')
+        self.logger.log_struct(
+            {
+                "message": 'Now converting dataframe into sql and placing into a temporary table',
+                "severity": "INFO",
+                "dataset": dataset.name,
+                "gcs-path-prefix": str(file_path),
+                "table-name": table_name
+            })
+        bulk_load.load_dataframe(df, table_name, dataset.table, connection, engine, self.logger)
+        return new_mark
+
+    def fix_staging_types(self, dataset, connection, table_name):
+        # A staging table made by bulk_load is already just like the real table, but one made by
+        # LOAD_METHOD=to_sql has whatever types pandas guessed, and only the columns that were in the file
+        cursor = connection.cursor()
+        for column, kind in dataset.optional_columns.items():
+            cursor.execute('ALTER TABLE {0} ADD COLUMN IF NOT EXISTS "{1}" {2};'.format(table_name, column, kind))
+        for column, kind in dataset.casts.items():
+            sql = 'ALTER TABLE {0} ALTER COLUMN "{1}" TYPE {2} USING "{1}"::{2};'.format(table_name, column, kind)
+            print(f'Attempting to run SQL statement: {str(sql)}')
+            self.logger.log_struct(
+                {
+                    "message": 'Running SQL statement to convert column datatype',
+                    "severity": 'INFO',
+                    "table-name": table_name,
+                    "column-name": column,
+                    "sql": str(sql)
+                })
+            cursor.execute(sql)
+        cursor.close()
+
+    def merge(self, dataset, connection, table_name):
+        # Copy the staging table into the real table. Returns the number of rows added or changed
+        print('Now copying into the real table...')
+        self.logger.log(f'Copying {table_name} into {dataset.table}', severity="INFO")
+        insert = stage_timer.start(dataset.table, 'insert')
+        if self.syncing(dataset):
+            status_sync.ensure_tables(connection, dataset.columns, dataset.table)
+            inserted, updated = status_sync.sync(connection, table_name, dataset.columns, dataset.table, casts=dataset.casts, newest_column=dataset.newest_column)
+            print(f'Added {inserted} rows to {dataset.table} and updated {updated} that had changed')
+            self.logger.log_struct(
+                {
+                    "message": 'Synced ' + dataset.table,
+                    "severity": 'INFO',
+                    "inserted-rows": str(inserted),
+                    "updated-rows": str(updated)
+                })
+            rows = inserted + updated
+        else:
+            key_columns = bulk_load.primary_key(connection, dataset.table) if dataset.upsert and self.updates else []
+            # With STATUS_SYNC turned off, a row changed here would keep the hash from the last time it was synced.
+            # That could then match a later file and have the row skipped, so it's cleared to be worked out again
+            cleared = []
+            if dataset.synced and key_columns and status_sync.HASH_COLUMN in bulk_load.target_columns(connection, dataset.table):
+                cleared = [status_sync.HASH_COLUMN]
+            cursor = connection.cursor()
+            cursor.execute(bulk_load.merge_sql(table_name, dataset.table, dataset.columns, key_columns, casts=dataset.casts, newest_column=dataset.newest_column, cleared=cleared))
+            rows = cursor.rowcount
+            cursor.close()
+        insert.stop(rows=rows)
+        return rows
+
+    def drop(self, dataset, connection, table_name):
+        cursor = connection.cursor()
+        try:
+            dropping = stage_timer.start(dataset.table, 'drop')
+            cursor.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
+            dropping.stop()
+            self.logger.log_struct(
+                {
+                    "message": 'Dropped temporary table',
+                    "severity": 'INFO',
+                    "table-name": table_name
+                })
+        except Exception as e:
+            print('Unable to drop a temp table. Does it actually exist?')
+            print(str(type(e)))
+            self.logger.log_struct(
+                {
+                    "message": "Error when dropping " + table_name,
+                    "severity": "WARNING",
+                    "table-name": table_name,
+                    "exception": str(type(e))
+                })
+        cursor.close()
+
+    def load(self, dataset, connection, file_path, table_name, engine=None):
+        # Imports one day of dataset through the staging table table_name, without committing
+        # engine is only used for LOAD_METHOD=to_sql. Returns (rows added or changed, watermark to save after the commit)
+        new_mark = self.stage(dataset, connection, file_path, table_name, engine)
+        if bulk_load.load_method == 'to_sql':
+            self.fix_staging_types(dataset, connection, table_name)
+        rows = self.merge(dataset, connection, table_name)
+        self.drop(dataset, connection, table_name)
+        return rows, new_mark
+
+    def run(self, dataset, connection, file_path, table_name, engine=None):
+        # load(), then commit and move the watermark on. Errors are logged rather than raised, so that one
+        # dataset failing doesn't stop the others. Returns the number of rows, or None if it failed
+        try:
+            wal_start = bulk_load.wal_position(connection)
+            rows, new_mark = self.load(dataset, connection, file_path, table_name, engine)
+            connection.commit()
+            watermarks.set_watermark(connection, dataset.table, new_mark)
+            bulk_load.log_wal(connection, wal_start, dataset.table, self.logger)
+            return rows
+        except Exception as e:
+            print(f'Error when processing {dataset.name}:')
+            print(str(type(e)))
+            print(traceback.format_exc())
+            connection.rollback()
+            self.logger.log_struct(
+                {
+                    "message": "Error when processing " + dataset.name,
+                    "severity": "WARNING",
+                    "dataset": dataset.name,
+                    "exception": str(type(e)),
+                    "error": str(e)
+                })
+            return None
@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+import argparse, json, os
+import storage_session, structured_log, stage_timer, local_bucket, snapshot_delta, dataset_importer
+
+# Write the delta between two days' exports of each dataset (see snapshot_delta.py)
+#
+# e.g. python diff-snapshots.py --current 2023-01-05
+#      python diff-snapshots.py --previous 2023-01-01 --current 2023-01-05 --dataset ratings --output-dir /tmp/deltas
+#
+# The previous day defaults to the day before --current. Deltas go into the bucket under DELTA_PREFIX, or into
+# --output-dir instead. The files are read in chunks of TSV_CHUNK_ROWS (or from their Parquet snapshots, with
+# READ_PARQUET=true), so memory use depends on the number of rows, not on how big they are.
+
+bucket_name = os.environ.get("gcs_bucket_name")
+project_id = os.environ.get("GCP_PROJECT")
+
+logger = structured_log.get_logger('diff-snapshots', project_id)
+importer = dataset_importer.Importer(bucket_name, project_id, logger)
+
+
+def chunks(dataset, file_path):
+    # Every row of the day's files for dataset, one chunk at a time
+    for object in importer.objects(dataset, file_path):
+        yield from importer.retrieve_chunks(object)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the rows that are new, changed or removed since the previous day')
+    parser.add_argument('--current', type=date.fromisoformat, default=date.today(), help='Day to write the delta for (YYYY-MM-DD)')
+    parser.add_argument('--previous', type=date.fromisoformat, help='Day to compare it with (default: the day before)')
+    parser.add_argument('--dataset', action='append', choices=list(dataset_importer.DATASETS), help='Can be given more than once (default: all of them)')
+    parser.add_argument('--output-dir', help='Write the deltas to this directory instead of the bucket')
+    parser.add_argument('--report', help='Write the summary to this JSON file')
+    args = parser.parse_args()
+
+    current = args.current.strftime('%Y/%m/%d')
+    previous = (args.previous or args.current - timedelta(1)).strftime('%Y/%m/%d')
+    bucket = local_bucket.LocalBucket('output', args.output_dir) if args.output_dir else storage_session.get_bucket(bucket_name, project_id)
+    names = args.dataset or list(dataset_importer.DATASETS)
+
+    summaries = []
+    for name in names:
+        dataset = dataset_importer.DATASETS[name]
+        print(f'Comparing {name} for {current} with {previous}')
+        try:
+            summary = snapshot_delta.diff(lambda: chunks(dataset, previous), chunks(dataset, current), name, bucket, current, previous)
+        except Exception as e:
+            print(f'Unable to diff {name} ({type(e).__name__}: {e})')
+            logger.log_struct(
+                {
+                    "message": "Unable to diff snapshots",
+                    "severity": "WARNING",
+                    "dataset": name,
+                    "current-date": current,
+                    "previous-date": previous,
+                    "exception": str(type(e))
+                })
+            continue
+        rate = summary["current-rows"] / summary["seconds"] if summary["seconds"] else 0
+        print(f'{name}: {summary["added"]} added, {summary["changed"]} changed, {summary["removed"]} removed, {summary["unchanged"]} unchanged ({summary["seconds"]}s, {rate:,.0f} rows/sec)')
+        logger.log_struct(dict({"message": "Wrote snapshot delta", "severity": "INFO"}, **{key: str(value) for key, value in summary.items()}))
+        summaries.append(summary)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    storage_session.log_stats(logger)
+    stage_timer.finish('diff-snapshots', logger)
+    logger.flush(structured_log.exit_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from google.cloud import storage
 import urllib.request, time, os
 import requests
 import gzip
+import downloader, gcs_transfer, storage_session, download_manifest, compression
 
 
 
@@ -12,65 +13,13 @@ import gzip
 end_date = date.today()
 
 bucket_name = os.environ.get("gcs_bucket_name")
+# Checked here rather than in parquet_snapshots.py, which (with everything it needs) is only imported when it is turned on
+write_parquet = os.environ.get("PARQUET_SNAPSHOTS", "false").lower() in ('1', 'true', 'yes')
 project_id = os.environ.get("GCP_PROJECT")
 
 dates_list = []
 url_list = {}
 
-def query_url(url):
-    print(f'Querying {url}')
-    try:
-        r = requests.get(url, allow_redirects=True)
-        print(r.status_code)
-        if (r.status_code != 200):
-            print("Didn't get a HTTP 200 response")
-            return 1
-        print(r.headers.get('content-type'))
-        return r.content
-    except Exception as e:
-        print('Something went wrong!')
-        print(type(e))
-        print(e)
-        return 1
-    # try:
-    #     # request.add_header('Accept-Encoding','gzip, deflate')
-    #     response = urllib.request.urlopen(url)
-    #     code = response.getcode()
-    #     print(f'{url} - {code}')
-    #     print(response.headers.get_content_charset())
-    #     try:
-    #         content=gzip.decompress(response.read().decode('utf-8'))
-    #         gzip_fd = gzip.GzipFile(fileobj=fd)
-    #     except gzip.BadGzipFile as e:
-    #         content=response.read().decode('utf-8')
-    #     return content
-    # except HTTPError as e:
-    #     print(f'urllib.error.HTTPError - HTTP Error {e.code} | {e.reason}')
-    #     if e.code == 429: # HTTP 429 - too many requests
-    #         retry = e.headers['Retry-After'] # Check if the server told us how long to wait before sending the next request
-    #         try:
-    #             retry = int(retry) # Try converting to an int to check if we got a real number or not
-    #         except ValueError:
-    #             retry = 30 # We'll use the "Retry-After" value from the headers if present, but otherwise try again after 30 seconds
-    #         except TypeError:
-    #             retry = 30 # Use 30 seconds if we have a NoneType trying to go into the retry value
-    #         print(f'Waiting {retry} seconds before trying the next URL...')
-    #         time.sleep(retry)
-    #     return 1
-    # except ConnectionResetError as e:
-    #     print('Got ConnectionResetError - waiting a bit before trying the next URL')
-    #     time.sleep(15)
-    #     return 1
-    # except BrokenPipeError as e:
-    #     print('Got BrokenPipeError - waiting a bit before trying the next URL')
-    #     time.sleep(15)
-    #     return 1
-    # except Exception as e:
-    #     print(f'Got some other error when attempting to download {url}')
-    #     print(type(e))
-    #     print(e)
-    #     return 1
-
 def upload_blob(contents, destination_blob_name):
     """Uploads a file to the bucket."""
 
@@ -83,16 +32,27 @@ def upload_blob(contents, destination_blob_name):
     # The ID of your GCS object
     # destination_blob_name = "storage-object-name"
 
-    storage_client = storage.Client(project_id)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = storage_session.get_bucket(bucket_name, project_id)
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_string(contents)
+    # Stored gzipped unless UPLOAD_COMPRESSION=none (see compression.py)
+    contents, blob.content_encoding = compression.compress(contents)
+    blob.upload_from_string(contents, content_type='text/tab-separated-values')
 
     print(
         f"{destination_blob_name} was uploaded to {bucket_name}."
     )
 
+def open_sink(destination_blob_name):
+    """Opens a resumable upload to the bucket, so that a download can be streamed straight into it."""
+
+    if storage_session.local_root:
+        return gcs_transfer.LocalFileSink(storage_session.local_root, destination_blob_name)
+
+    bucket = storage_session.get_bucket(bucket_name, project_id)
+    blob = bucket.blob(destination_blob_name)
+    return gcs_transfer.GCSResumableSink(blob)
+
 def main(event_data, context):
     # We have to include event_data and context because these will be passed as arguments when invoked as a Cloud Function
     # and the runtime will freak out if the function only accepts 0 arguments... go figure
@@ -113,22 +73,19 @@ def main(event_data, context):
         url_list[target_date]['noteStatusHistory'] = ('https://ton.twimg.com/birdwatch-public-data/' + target_date + '/noteStatusHistory/noteStatusHistory-00000.tsv')
         url_list[target_date]['userEnrollmentStatus'] = ('https://ton.twimg.com/birdwatch-public-data/' + target_date + '/userEnrollment/userEnrollment-00000.tsv')
 
+    # Build the list of files to download, then download them all in parallel (see downloader.py)
+    jobs = []
     for target in url_list:
 
         # Download notes
         current_url = url_list[target]['notes']
-        data = query_url(current_url)
 
         # This is wrong, I think:
         destination_file = target + '/notes' + str(i).zfill(5) + '.tsv'
 
         # This is what the file should be named, if we're being sensible
         destination_file = target + '/notes00000.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print(f'Error when downloading {current_url}. check above for error messages')
+        jobs.append((current_url, destination_file))
 
 
 
@@ -136,36 +93,28 @@ def main(event_data, context):
 
         for i in range(10):
             current_url = url_list[target]['ratings'].replace('00000', str(i).zfill(5)) # replace the 00000 with the correct number, padding with zeros if necessary
-            # download notes
-            data = query_url(current_url)
             destination_file = target + '/ratings' + str(i).zfill(5) + '.tsv'
-            if isinstance(data, bytes):
-                print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-                upload_blob(data, destination_file)
-            else:
-                print(f'Error when downloading {current_url}. check above for error messages')
+            jobs.append((current_url, destination_file))
 
         # download notes status history - which there are now up to 10 separate TSV files
 
         current_url = url_list[target]['noteStatusHistory']
-        data = query_url(current_url)
         destination_file = target + '/noteStatusHistory' + str(i).zfill(5) + '.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print(f'Error when downloading {current_url}. check above for error messages')
+        jobs.append((current_url, destination_file))
 
 
 
         # get user enrollment status data
-        data = query_url(url_list[target]['userEnrollmentStatus'])
         destination_file = target + '/userEnrollmentStatus.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print('seems something went wrong. check above for error messages')
+        jobs.append((url_list[target]['userEnrollmentStatus'], destination_file))
+
+    manifest = download_manifest.load(bucket_name, project_id)
+    downloader.download_all(jobs, upload_blob, open_sink=open_sink, manifest=manifest)
+    if write_parquet:
+        # Keep a typed Parquet copy of every file next to the TSVs (see parquet_snapshots.py)
+        import parquet_snapshots
+        parquet_snapshots.convert_all(bucket_name, [destination_file for url, destination_file in jobs], project_id, workers=downloader.download_workers)
+    storage_session.log_stats()
 
     print('Finished!')
     
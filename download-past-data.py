@@ -4,6 +4,7 @@ from urllib.error import HTTPError
 from google.cloud import storage
 import urllib.request, time, os
 import requests
+import downloader, gcs_transfer, storage_session, download_manifest, compression
 
 
 
@@ -12,6 +13,8 @@ start_date = date(2022, 10, 1)
 end_date = date.today()
 
 bucket_name = os.environ.get("gcs_bucket_name")
+# Checked here rather than in parquet_snapshots.py, which (with everything it needs) is only imported when it is turned on
+write_parquet = os.environ.get("PARQUET_SNAPSHOTS", "false").lower() in ('1', 'true', 'yes')
 
 dates_list = []
 url_list = {}
@@ -21,52 +24,6 @@ def daterange(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         yield start_date + timedelta(n)
 
-def query_url(url):
-    print(f'Querying {url}')
-    try:
-        r = requests.get(url, allow_redirects=True)
-        print(r.status_code)
-        if (r.status_code != 200):
-            print("Didn't get a HTTP 200 response")
-            return 1
-        print(r.headers.get('content-type'))
-        return r.content
-    except Exception as e:
-        print('Something went wrong!')
-        print(type(e))
-        print(e)
-        return 1
-    # try:
-    #     response = urllib.request.urlopen(url)
-    #     code = response.getcode()
-    #     print(f'{url} - {code}')
-    #     return response.read()
-    # except HTTPError as e:
-    #     print(f'urllib.error.HTTPError - HTTP Error {e.code} | {e.reason}')
-    #     if e.code == 429: # HTTP 429 - too many requests
-    #         retry = e.headers['Retry-After'] # Check if the server told us how long to wait before sending the next request
-    #         try:
-    #             retry = int(retry) # Try converting to an int to check if we got a real number or not
-    #         except ValueError:
-    #             retry = 30 # We'll use the "Retry-After" value from the headers if present, but otherwise try again after 30 seconds
-    #         except TypeError:
-    #             retry = 30 # Use 30 seconds if we have a NoneType trying to go into the retry value
-    #         print(f'Waiting {retry} seconds before trying the next URL...')
-    #         time.sleep(retry)
-    #     return 1
-    # except ConnectionResetError as e:
-    #     print('Got ConnectionResetError - waiting a bit before trying the next URL')
-    #     time.sleep(15)
-    #     return 1
-    # except BrokenPipeError as e:
-    #     print('Got BrokenPipeError - waiting a bit before trying the next URL')
-    #     time.sleep(15)
-    #     return 1
-    # except Exception as e:
-    #     print(f'Got some other error when attempting to download {url}')
-    #     print(e)
-    #     return 1
-
 def upload_blob(contents, destination_blob_name):
     """Uploads a file to the bucket."""
 
@@ -79,16 +36,27 @@ def upload_blob(contents, destination_blob_name):
     # The ID of your GCS object
     # destination_blob_name = "storage-object-name"
 
-    storage_client = storage.Client(os.environ.get("gcs_project_id"))
-    bucket = storage_client.bucket(bucket_name)
+    bucket = storage_session.get_bucket(bucket_name, os.environ.get("gcs_project_id"))
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_string(contents)
+    # Stored gzipped unless UPLOAD_COMPRESSION=none (see compression.py)
+    contents, blob.content_encoding = compression.compress(contents)
+    blob.upload_from_string(contents, content_type='text/tab-separated-values')
 
     print(
         f"{destination_blob_name} was uploaded to {bucket_name}."
     )
 
+def open_sink(destination_blob_name):
+    """Opens a resumable upload to the bucket, so that a download can be streamed straight into it."""
+
+    if storage_session.local_root:
+        return gcs_transfer.LocalFileSink(storage_session.local_root, destination_blob_name)
+
+    bucket = storage_session.get_bucket(bucket_name, os.environ.get("gcs_project_id"))
+    blob = bucket.blob(destination_blob_name)
+    return gcs_transfer.GCSResumableSink(blob)
+
 def main():
 
     # Create a list of dates to check:
@@ -106,41 +74,25 @@ def main():
         url_counter += 4
     print(f'Created a dictionary containing URLs for {len(url_list)} dates of past data. It contains {str(url_counter)} total URLs')
     # for each URL:
+    jobs = []
     for target in url_list:
         # get notes
-        data = query_url(url_list[target]['notes'])
-        destination_file = target + '/notes.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print('seems something went wrong. check above for error messages')
+        jobs.append((url_list[target]['notes'], target + '/notes.tsv'))
         # get ratings
-        data = query_url(url_list[target]['ratings'])
-        destination_file = target + '/ratings.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print('seems something went wrong. check above for error messages')
-
+        jobs.append((url_list[target]['ratings'], target + '/ratings.tsv'))
         # get note status history data
-        data = query_url(url_list[target]['noteStatusHistory'])
-        destination_file = target + '/noteStatusHistory.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print('seems something went wrong. check above for error messages')
-
+        jobs.append((url_list[target]['noteStatusHistory'], target + '/noteStatusHistory.tsv'))
         # get user enrollment status data
-        data = query_url(url_list[target]['userEnrollmentStatus'])
-        destination_file = target + '/userEnrollmentStatus.tsv'
-        if isinstance(data, bytes):
-            print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
-            upload_blob(data, destination_file)
-        else:
-            print('seems something went wrong. check above for error messages')
+        jobs.append((url_list[target]['userEnrollmentStatus'], target + '/userEnrollmentStatus.tsv'))
+
+    # Download everything in parallel (see downloader.py)
+    manifest = download_manifest.load(bucket_name, os.environ.get("gcs_project_id"))
+    downloader.download_all(jobs, upload_blob, open_sink=open_sink, manifest=manifest)
+    if write_parquet:
+        # Keep a typed Parquet copy of every file next to the TSVs (see parquet_snapshots.py)
+        import parquet_snapshots
+        parquet_snapshots.convert_all(bucket_name, [destination_file for url, destination_file in jobs], os.environ.get("gcs_project_id"), workers=downloader.download_workers)
+    storage_session.log_stats()
     
 if __name__ == "__main__":
     print('FYI: Script started directly as __main__')
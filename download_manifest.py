@@ -0,0 +1,85 @@
+from google.api_core.exceptions import NotFound
+import threading, hashlib, json, time, os
+import storage_session
+
+# Keeps track of what has already been downloaded, so that unchanged files aren't downloaded and uploaded again
+#
+# download-new.py checks the last 5 days every time it runs, so most of what it fetches is already in the
+# bucket. The manifest is a JSON file saved in the bucket itself (DOWNLOAD_MANIFEST) that records, for each
+# file in the bucket, the URL it came from along with that URL's ETag and Last-Modified headers, and the
+# size and sha256 of what was uploaded.
+#
+# The next time that file is downloaded, the request is sent with If-None-Match / If-Modified-Since, and if
+# the server answers 304 Not Modified, nothing is downloaded or uploaded. If the server sends the file anyway,
+# it is only uploaded if its sha256 doesn't match what is already in the bucket.
+#
+# CONDITIONAL_DOWNLOADS=false turns all of this off and downloads everything, like before.
+
+conditional_downloads = os.environ.get("CONDITIONAL_DOWNLOADS", "true").lower() in ('1', 'true', 'yes')
+manifest_blob = os.environ.get("DOWNLOAD_MANIFEST", "download-manifest.json")
+
+
+class DownloadManifest:
+    def __init__(self, bucket_name, project=None, entries=None):
+        self.bucket_name = bucket_name
+        self.project = project
+        self.entries = entries or {}
+        self.lock = threading.Lock()
+        self.skipped = {"not-modified": 0, "same-content": 0}
+
+    def conditional_headers(self, url, destination_file):
+        # Headers to send with the GET for url, so that the server can tell us if nothing has changed
+        entry = self.entries.get(destination_file)
+        if not entry or entry.get('url') != url:
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last-modified'):
+            headers['If-Modified-Since'] = entry['last-modified']
+        return headers
+
+    def unchanged(self, destination_file, sha256):
+        # True if the bucket already has exactly this content for destination_file
+        entry = self.entries.get(destination_file)
+        return bool(entry and sha256 and entry.get('sha256') == sha256)
+
+    def skip(self, reason):
+        with self.lock:
+            self.skipped[reason] += 1
+
+    def record(self, url, destination_file, response, size, sha256):
+        # sha256 is None when it isn't known (e.g. a streamed transfer that was resumed part way through)
+        with self.lock:
+            self.entries[destination_file] = {
+                "url": url,
+                "etag": response.headers.get('ETag'),
+                "last-modified": response.headers.get('Last-Modified'),
+                "size": size,
+                "sha256": sha256,
+                "checked-at": int(time.time())
+            }
+
+    def save(self):
+        with self.lock:
+            contents = json.dumps(self.entries, indent=1, sort_keys=True)
+        storage_session.get_bucket(self.bucket_name, self.project).blob(manifest_blob).upload_from_string(contents, content_type='application/json')
+        print(f'Saved the download manifest ({len(self.entries)} files). Skipped {self.skipped["not-modified"]} unchanged downloads and {self.skipped["same-content"]} duplicate uploads')
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def load(bucket_name, project=None):
+    # Returns None when CONDITIONAL_DOWNLOADS is turned off, so that callers can just pass the result along
+    if not conditional_downloads:
+        return None
+    contents = None
+    try:
+        contents = storage_session.get_bucket(bucket_name, project).blob(manifest_blob).download_as_bytes()
+    except NotFound:
+        pass
+    entries = json.loads(contents) if contents else {}
+    print(f'Loaded the download manifest ({len(entries)} files)')
+    return DownloadManifest(bucket_name, project, entries)
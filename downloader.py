@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+import requests, threading, hashlib, time, os
+import gcs_transfer, download_manifest
+
+# Parallel download engine used by download-new.py and download-past-data.py
+#
+# Downloads run on a pool of DOWNLOAD_WORKERS threads. Each thread keeps its own keep-alive session, and
+# requests to the same host are spaced out so there are never more than REQUESTS_PER_SECOND started per host.
+# If the server answers with HTTP 429, that host is paused for however long the Retry-After header asks
+# (or 30 seconds if it doesn't say) and the request is tried again.
+
+download_workers = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+requests_per_second = float(os.environ.get("REQUESTS_PER_SECOND", 4))
+download_retries = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+download_timeout = int(os.environ.get("DOWNLOAD_TIMEOUT", 1800)) # Seconds - see auth-notes.md for why this is so generous
+
+
+class HostRateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, host):
+        # Reserve the next free slot for this host, then sleep until it comes around
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+    def back_off(self, host, seconds):
+        # Don't start anything else on this host for a while
+        with self.lock:
+            self.next_slot[host] = max(self.next_slot.get(host, 0), time.monotonic() + seconds)
+
+
+limiter = HostRateLimiter(requests_per_second)
+thread_data = threading.local()
+
+
+def session():
+    # requests.Session isn't guaranteed to be thread safe, so each worker thread gets its own
+    if not hasattr(thread_data, 'session'):
+        thread_data.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        thread_data.session.mount('https://', adapter)
+        thread_data.session.mount('http://', adapter)
+    return thread_data.session
+
+
+def retry_after(response, default=30):
+    # Retry-After can either be a number of seconds or an HTTP date
+    retry = response.headers.get('Retry-After')
+    try:
+        return int(retry)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0, parsedate_to_datetime(retry).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def request_url(url, headers=None, stream=False):
+    # GET url, waiting for the rate limiter and retrying after HTTP 429s and dropped connections
+    # Returns the response (whatever its status code), or None if we gave up
+    host = urlparse(url).netloc
+    for attempt in range(download_retries + 1):
+        limiter.wait(host)
+        print(f'Querying {url}')
+        try:
+            r = session().get(url, allow_redirects=True, timeout=download_timeout, headers=headers, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f'Got {type(e).__name__} for {url} - waiting a bit before trying again')
+            time.sleep(15)
+            continue
+        print(f'{url} - {r.status_code}')
+        if r.status_code == 429: # HTTP 429 - too many requests
+            retry = retry_after(r)
+            print(f'Waiting {retry} seconds before sending anything else to {host}...')
+            limiter.back_off(host, retry)
+            r.close()
+            continue
+        return r
+    print(f'Giving up on {url} after {download_retries + 1} attempts')
+    return None
+
+
+def query_url(url):
+    # Returns the contents of url as bytes, or 1 if it couldn't be downloaded
+    try:
+        r = request_url(url)
+    except Exception as e:
+        print('Something went wrong!')
+        print(type(e))
+        print(e)
+        return 1
+    if r is None:
+        return 1
+    if r.status_code != 200:
+        print("Didn't get a HTTP 200 response")
+        return 1
+    print(r.headers.get('content-type'))
+    return r.content
+
+
+def stream_one(url, destination_file, open_sink, manifest=None):
+    # Stream url straight into a resumable upload (see gcs_transfer.py) without holding the whole file in memory
+    # If the transfer is interrupted, the next attempt picks up from however much the bucket already has
+    sink = open_sink(destination_file)
+    for attempt in range(download_retries + 1):
+        try:
+            offset = sink.committed()
+            if offset is None:
+                print(f'{destination_file} was already completely uploaded')
+                sink.finish()
+                return True
+            # Ask for the file uncompressed, so that byte ranges and Content-Length line up with what ends up in the bucket
+            headers = {'Accept-Encoding': 'identity'}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+            elif manifest:
+                headers.update(manifest.conditional_headers(url, destination_file))
+            r = request_url(url, headers=headers, stream=True)
+            if r is None:
+                return False
+            if r.status_code == 304:
+                print(f'{destination_file} has not changed since it was last downloaded - skipping it')
+                manifest.skip('not-modified')
+                r.close()
+                sink.finish()
+                return True
+            if r.status_code not in (200, 206):
+                print("Didn't get a HTTP 200 response")
+                r.close()
+                return False
+            sink.start()
+            # The hash can only be worked out if we see the whole file
+            digest = hashlib.sha256() if not offset else None
+            with r:
+                size = gcs_transfer.upload_stream(r, sink, offset, digest)
+            print(f'Streamed {destination_file} ({size} bytes{", resumed from byte " + str(offset) if offset else ""})')
+            if manifest:
+                manifest.record(url, destination_file, r, size, digest.hexdigest() if digest else None)
+            return True
+        except (requests.exceptions.RequestException, IOError) as e:
+            print(f'Transfer of {destination_file} was interrupted ({type(e).__name__}) - resuming in a bit')
+            time.sleep(15)
+    print(f'Giving up on streaming {url} after {download_retries + 1} attempts')
+    return False
+
+
+def download_one(url, destination_file, upload, manifest=None):
+    headers = manifest.conditional_headers(url, destination_file) if manifest else None
+    try:
+        r = request_url(url, headers=headers)
+    except Exception as e:
+        print('Something went wrong!')
+        print(type(e))
+        print(e)
+        r = None
+    if r is not None and r.status_code == 304:
+        print(f'{destination_file} has not changed since it was last downloaded - skipping it')
+        manifest.skip('not-modified')
+        return True
+    if r is None or r.status_code != 200:
+        if r is not None:
+            print("Didn't get a HTTP 200 response")
+        print(f'Error when downloading {url}. check above for error messages')
+        return False
+    data = r.content
+    data_hash = download_manifest.sha256(data)
+    if manifest and manifest.unchanged(destination_file, data_hash):
+        print(f'{destination_file} is already in Google Cloud Storage with the same contents - not uploading it again')
+        manifest.skip('same-content')
+    else:
+        print(f'Looks like the download worked! Now saving {destination_file} to Google Cloud Storage')
+        upload(data, destination_file)
+    if manifest:
+        manifest.record(url, destination_file, r, len(data), data_hash)
+    return True
+
+
+def download_all(jobs, upload, workers=None, open_sink=None, manifest=None):
+    # jobs is a list of (url, destination_file) pairs. upload(contents, destination_file) is called for each successful download
+    # With STREAMING_UPLOADS=true and an open_sink(destination_file) function, downloads are streamed into the bucket instead
+    # If a manifest is given (see download_manifest.py), files that haven't changed are skipped and the manifest is saved at the end
+    # Returns the number of files that were downloaded and uploaded
+    if workers is None:
+        workers = download_workers
+    start_time = time.perf_counter()
+    succeeded = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if gcs_transfer.streaming_uploads and open_sink:
+            futures = {executor.submit(stream_one, url, destination_file, open_sink, manifest): url for url, destination_file in jobs}
+        else:
+            futures = {executor.submit(download_one, url, destination_file, upload, manifest): url for url, destination_file in jobs}
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    succeeded += 1
+            except Exception as e:
+                print(f'Error when uploading {futures[future]}')
+                print(type(e))
+                print(e)
+    if manifest:
+        manifest.save()
+    elapsed = time.perf_counter() - start_time
+    print(f'Downloaded {succeeded} of {len(jobs)} files in {elapsed:.1f} seconds using {workers} workers')
+    return succeeded
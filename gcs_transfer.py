@@ -0,0 +1,129 @@
+import requests, hashlib, json, os
+
+# Streams a download straight into a bucket in fixed-size chunks, instead of holding the whole file in memory
+#
+# Uploads use GCS resumable upload sessions. The session URL is saved to TRANSFER_STATE_DIR, so if a transfer
+# is interrupted (timeouts, see auth-notes.md) the next attempt asks GCS how much it already has, requests
+# only the rest of the file from the source with a Range header, and carries on from there.
+#
+# With a local storage backend (STORAGE_BACKEND=local or mmap, see storage_session.py) downloads are written
+# into that directory instead, in the same way. The google-cloud-storage library also honors
+# STORAGE_EMULATOR_HOST, so the GCS version can be pointed at a fake GCS server.
+
+streaming_uploads = os.environ.get("STREAMING_UPLOADS", "false").lower() in ('1', 'true', 'yes')
+chunk_bytes = int(os.environ.get("TRANSFER_CHUNK_BYTES", 8 * 1024 * 1024)) # GCS needs this to be a multiple of 256 KiB
+transfer_state_dir = os.environ.get("TRANSFER_STATE_DIR", "/tmp/birdwatch-transfers")
+
+
+class GCSResumableSink:
+    def __init__(self, blob, content_type='text/tab-separated-values'):
+        self.blob = blob
+        self.content_type = content_type
+        self.state_file = os.path.join(transfer_state_dir, hashlib.sha1((blob.bucket.name + '/' + blob.name).encode()).hexdigest() + '.json')
+        self.session_url = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.session_url = json.load(f)['session-url']
+
+    def start(self):
+        if self.session_url is None:
+            self.session_url = self.blob.create_resumable_upload_session(content_type=self.content_type)
+            os.makedirs(transfer_state_dir, exist_ok=True)
+            with open(self.state_file, 'w') as f:
+                json.dump({"blob": self.blob.name, "session-url": self.session_url}, f)
+
+    def committed(self):
+        # How many bytes GCS already has for this upload, or None if the upload has already finished
+        if self.session_url is None:
+            return 0
+        r = requests.put(self.session_url, headers={'Content-Range': 'bytes */*'})
+        if r.status_code in (200, 201):
+            return None
+        if r.status_code == 308:
+            received = r.headers.get('Range') # e.g. bytes=0-8388607
+            return int(received.split('-')[1]) + 1 if received else 0
+        # The session has expired or been cancelled, so start again from scratch
+        self.session_url = None
+        self.finish()
+        return 0
+
+    def write(self, data, offset, total=None):
+        # total is only known (and only passed) for the last chunk
+        end = offset + len(data) - 1
+        if total is None:
+            content_range = f'bytes {offset}-{end}/*'
+        elif len(data) == 0:
+            content_range = f'bytes */{total}'
+        else:
+            content_range = f'bytes {offset}-{end}/{total}'
+        r = requests.put(self.session_url, data=data, headers={'Content-Range': content_range})
+        if r.status_code not in (200, 201, 308):
+            r.raise_for_status()
+            raise IOError(f'Unexpected response {r.status_code} when uploading {self.blob.name}')
+        if r.status_code == 308:
+            received = r.headers.get('Range')
+            if not received or int(received.split('-')[1]) != end:
+                # GCS didn't keep all of this chunk. Raising makes the caller resume from whatever it did keep
+                raise IOError(f'Only part of the chunk at byte {offset} of {self.blob.name} was saved')
+
+    def finish(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+
+class LocalFileSink:
+    # Stand-in for a bucket: <root>/<blob name>.part while it's being written, renamed once it's complete
+    def __init__(self, root, blob_name):
+        self.path = os.path.join(root, blob_name)
+        self.part = self.path + '.part'
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def committed(self):
+        return os.path.getsize(self.part) if os.path.exists(self.part) else 0
+
+    def write(self, data, offset, total=None):
+        with open(self.part, 'r+b' if os.path.exists(self.part) else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+        if total is not None:
+            os.replace(self.part, self.path)
+
+    def finish(self):
+        pass
+
+
+def upload_stream(response, sink, offset, digest=None):
+    # Copy an HTTP response body into sink, starting at offset, in chunks of chunk_bytes
+    # If digest is given (e.g. hashlib.sha256()), it is updated with everything that is written
+    # Only ever holds one chunk (plus whatever piece of the response is being read) in memory
+    if offset and response.status_code == 200:
+        # The server ignored our Range header and sent the whole file, so skip what we already have
+        skip = offset
+    else:
+        skip = 0
+    # Where the file should end, so a connection that is dropped part way through isn't mistaken for the end of the file
+    length = response.headers.get('Content-Length')
+    expected_size = int(length) + (offset if response.status_code == 206 else 0) if length else None
+    buffer = bytearray()
+    for piece in response.iter_content(chunk_size=1024 * 1024):
+        if skip:
+            dropped = min(skip, len(piece))
+            piece = piece[dropped:]
+            skip -= dropped
+        if digest is not None:
+            digest.update(piece)
+        buffer += piece
+        # Hold on to anything past a full chunk, so that the final chunk (which carries the total size) is never empty unless the file is
+        while len(buffer) > chunk_bytes:
+            sink.write(bytes(buffer[:chunk_bytes]), offset)
+            offset += chunk_bytes
+            del buffer[:chunk_bytes]
+    if expected_size is not None and offset + len(buffer) != expected_size:
+        # Everything up to offset has been saved, so the next attempt carries on from there
+        raise IOError(f'Connection closed after {offset + len(buffer)} of {expected_size} bytes')
+    sink.write(bytes(buffer), offset, total=offset + len(buffer))
+    sink.finish()
+    return offset + len(buffer)
@@ -5,9 +5,9 @@ from sqlalchemy import create_engine, text
 from datetime import datetime, date, timedelta
 from dotenv import load_dotenv, find_dotenv
 import os, sqlalchemy, pg8000, psycopg2
-import google.cloud.logging
 import socket
 from psycopg2 import pool
+import bulk_load, storage_session, backfill, snapshot_diff, structured_log, stage_timer, dataset_importer
 
 # REQUIREMENTS
 #
@@ -25,8 +25,10 @@ bucket_name = os.environ.get("gcs_bucket_name")
 project_id = os.environ.get("GCP_PROJECT")
 start_date = os.environ.get("START_DATE", "2023, 5, 15")
 start_date = datetime.strptime(start_date, '%Y, %m, %d')
-end_date = datetime.today()
+end_date = os.environ.get("END_DATE")
+end_date = datetime.strptime(end_date, '%Y, %m, %d') if end_date else datetime.today()
 dates_list = []
+fingerprints = snapshot_diff.FingerprintCache()
 
 # Get DB info from the environment
 db_host = os.environ.get("DB_HOST")
@@ -35,8 +37,11 @@ db_name = os.environ.get("DB_NAME")
 db_password = os.environ.get("DB_PASS")
 
 # Set up Google cloud logging:
-log_client = google.cloud.logging.Client(project=project_id)
-logger = log_client.logger(name='import-old-tsv')
+# Log calls only queue the entry - it's sent in the background (see structured_log.py)
+# It's made by setup(), along with the importer, rather than when this module is imported, since the worker
+# processes that parse the shards import it again (see shard_reader.py)
+logger = None
+importer = None
 
 # [START cloud_sql_postgres_sqlalchemy_connect_connector]
 # From https://github.com/GoogleCloudPlatform/python-docs-samples/blob/main/cloud-sql/postgres/sqlalchemy/connect_connector.py
@@ -52,7 +57,8 @@ def daterange(start_date, end_date):
 ## postgres connection:
 def connection_pool():
     try:
-        pool = psycopg2.pool.SimpleConnectionPool(1, 10,
+        # Threaded, and big enough for every backfill worker to have a connection (see BACKFILL_WORKERS)
+        pool = psycopg2.pool.ThreadedConnectionPool(1, max(10, backfill.backfill_workers),
             user=db_user,
             password=db_password,
             host=db_host,
@@ -69,369 +75,132 @@ def connection_engine():
     connection_engine = db_engine.connect()
     return connection_engine
 
-def retrieve_tsv(object):
-    path = 'gs://' + bucket_name + '/' + object
-    print(f'Loading {path} into a pandas DataFrame...')
+def previous_fingerprint(file_path, dataset):
+    # The fingerprint of the previous day's file, or None if every row of this day's file needs loading
+    previous_date = backfill.previous_date(file_path)
+    previous = fingerprints.take(previous_date, dataset.name)
+    if not backfill.will_load(previous_date, dataset.name):
+        # Nothing says the previous day's rows are in the database, so they can't be skipped
+        return None
+    if previous is None:
+        objects = importer.objects(dataset, previous_date)
+        print(f'Reading {objects} to compare against')
+        try:
+            previous = pd.concat([snapshot_diff.fingerprint(importer.retrieve(object), dataset.name) for object in objects], ignore_index=True)
+        except Exception as e:
+            print(f'Unable to read {objects} ({type(e).__name__}) - loading every row instead')
+            return None
+    return previous
+
+
+def remember_fingerprint(file_path, dataset, fingerprint):
+    # Only worth keeping if this run is going to load the next day too
+    if backfill.is_pending(backfill.next_date(file_path), dataset.name):
+        fingerprints.put(file_path, dataset.name, fingerprint)
+
+
+def log_dedup(file_path, dataset, total, kept):
+    print(f'{dataset.name} for {file_path}: {kept} of {total} rows are new or changed since the previous day')
     logger.log_struct(
+        {
+            "message": 'Skipped rows that were in the previous day\'s file',
+            "severity": 'INFO',
+            "current-date": str(file_path),
+            "dataset": dataset.name,
+            "total-rows": str(total),
+            "new-rows": str(kept)
+        })
+
+
+def dedup(chunks, file_path, dataset):
+    # With BACKFILL_DEDUP=true, only keep the rows that weren't in the previous day's file (see snapshot_diff.py)
+    # chunks is either the whole file as one DataFrame, or the file being streamed in chunks
+    if not snapshot_diff.cross_day_dedup:
+        yield from chunks
+        return
+    previous = previous_fingerprint(file_path, dataset)
+    parts = []
+    kept = 0
+    for chunk in chunks:
+        current = snapshot_diff.fingerprint(chunk, dataset.name)
+        parts.append(current)
+        if previous is not None:
+            chunk = chunk[snapshot_diff.changed(current, previous)].copy()
+        kept += chunk.shape[0]
+        yield chunk
+    current = pd.concat(parts, ignore_index=True) if parts else None
+    if current is not None:
+        remember_fingerprint(file_path, dataset, current)
+        if previous is not None:
+            log_dedup(file_path, dataset, current.shape[0], kept)
+
+
+def setup():
+    # A Cloud Function instance that gets reused keeps the ones it made the first time
+    global logger, importer
+    if logger is None:
+        logger = structured_log.get_logger('import-old-tsv', project_id)
+        # Every dataset is imported the same way (see dataset_importer.py), except that a backfill loads every row
+        # (less the ones dedup() skips) and never replaces a row that's already there - the database may already
+        # have a newer version of it than the day being backfilled
+        importer = dataset_importer.Importer(bucket_name, project_id, logger, mode='all', updates=False, dedup=dedup)
+
+
+def importer_for(dataset):
+    # Loads dataset for one date (file_path) through the staging table table_name, and returns the number of
+    # rows added. It doesn't commit - backfill.run() does that, along with the unit's checkpoint
+    def import_unit(connection, engine, file_path, table_name):
+        logger.log_struct(
             {
-                "message": "Retrieving TSV and loading into Pandas dataframe",
+                "message": "Retrieving " + dataset.name,
                 "severity": "INFO",
-                "object": str(object),
-                "gcs-path": str(path)
+                "current-date": str(file_path)
             })
-    # gs://birdwatch-scraper_public-data/2022/11/12/ratings.tsv
-    df = pd.read_csv(path, sep='\t', header=0)
-    return df
+        rows, new_mark = importer.load(dataset, connection, file_path, table_name, engine)
+        return rows
+    return import_unit
+
+
+IMPORTERS = {name: importer_for(dataset) for name, dataset in dataset_importer.DATASETS.items()}
 
 
 def main(event_data, context):
     # We have to include event_data and context because these will be passed as arguments when invoked as a Cloud Function
     # and the runtime will freak out if the function only accepts 0 arguments... go figure
     print(f'Started Execution, with an initial date of: {start_date}')
+    setup()
+    stage_timer.reset()
     load_dotenv() # load environment variables
     
     # Set up a db connection pool
     db = connection_pool()
 
-    # Set up a db engine
-    engine = connection_engine()
-
-    
-
     # Create a list of dates to check:
     for single_date in daterange(start_date, end_date):
         dates_list.append(single_date.strftime("%Y/%m/%d"))
 
-    for current_date in dates_list:
-        file_path = current_date
-
-        ## Get notes ##
-        logger.log_struct(
-            {
-                "message": "Retrieving notes.tsv",
-                "severity": "INFO",
-                "current-date": str(file_path)
-            })
-        object = file_path + '/notes.tsv'
-        table_name = 'temp_notes_' + date.today().strftime("%Y%m%d") + '_import_old'
-        try: 
-            df = retrieve_tsv(object)
-            print(df.info())
-            print(df)
-
-            # # Insert data from that file into the db:
-            logger.log_struct(
-                {
-                    "message": 'Now converting dataframe into sql and placing into a temporary table',
-                    "severity": "INFO",
-                    "object": str(object),
-                    "table-name": table_name
-                }
-            )
-            df.to_sql(table_name, engine, if_exists='replace')
-            engine.commit()
-            logger.log('Copying temp_notes into the notes table', severity="INFO")
-            print('Now copying into the real table...')
-            connection = db.getconn()
-            cursor = connection.cursor()
-            sql = 'INSERT INTO notes ("noteId", "createdAtMillis", "tweetId", "classification", "believable", "harmful", "validationDifficulty", "misleadingOther", "misleadingFactualError", "misleadingManipulatedMedia", "misleadingOutdatedInformation", "misleadingMissingImportantContext", "misleadingUnverifiedClaimAsFact", "misleadingSatire", "notMisleadingOther", "notMisleadingFactuallyCorrect", "notMisleadingOutdatedButNotWhenWritten", "notMisleadingClearlySatire", "notMisleadingPersonalOpinion", "trustworthySources", "summary", "noteAuthorParticipantId" ) SELECT "noteId", "createdAtMillis", "tweetId", "classification", "believable", "harmful", "validationDifficulty", "misleadingOther", "misleadingFactualError", "misleadingManipulatedMedia", "misleadingOutdatedInformation", "misleadingMissingImportantContext", "misleadingUnverifiedClaimAsFact", "misleadingSatire", "notMisleadingOther", "notMisleadingFactuallyCorrect", "notMisleadingOutdatedButNotWhenWritten", "notMisleadingClearlySatire", "notMisleadingPersonalOpinion", "trustworthySources", "summary", "noteAuthorParticipantId" FROM {0} ON CONFLICT DO NOTHING;'.format(table_name)
-            cursor.execute(sql)
-            try:
-                cursor.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-                logger.log_struct(
-                    {
-                        "message": 'Dropped temporary table',
-                        "severity": 'INFO',
-                        "table-name": table_name
-                    }
-                )
-            except Exception as e:
-                print('Unable to drop a temp table. Does it actually exist?')
-                print(str(type(e)))
-                logger.log_struct(
-                    {
-                        "message": "Error when dropping temp_notes",
-                        "severity": "WARNING",
-                        "table-name": table_name,
-                        "exception": str(type(e))
-                    })
-            cursor.close()
-            connection.commit()
-            db.putconn(connection)
-        except Exception as e:
-            print('Error when getting notes:')
-            print(str(type(e)))
-            print(e)
-            logger.log_struct(
-                {
-                    "message": "Error when retreiving notes.tsv",
-                    "severity": "WARNING",
-                    "exception": str(type(e))
-                })
-
-
-        
-
-        # print('Now inserting data from table_temp into notes - and skipping duplicates')
-        # cur.execute("""Insert into notes select * From table_temp ON CONFLICT DO NOTHING;""");
-
-        # print('Now dropping the temporary table')
-        # cur.execute("""DROP TABLE table_temp CASCADE;""");  # You can drop if you want to but the replace option in to_sql will drop and recreate the table
-        # conn.commit()
-
-        ## Get ratings ##
-        logger.log_struct(
-            {
-                "message": "Retrieving ratings.tsv",
-                "severity": "INFO",
-                "current-date": str(file_path)
-            })
-        object = file_path + '/ratings.tsv'
-        table_name = 'temp_ratings_' + date.today().strftime("%Y%m%d") + '_import_old'
-        print(f'Searching for {object}')
-        try:
-            df = retrieve_tsv(object)
-            df['ratingsId'] = df[['noteId', 'raterParticipantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
-            print(df.info())
-            print(df)
-            logger.log_struct(
-                {
-                    "message": 'Now converting dataframe into sql and placing into a temporary table',
-                    "severity": "INFO",
-                    "object": str(object),
-                    "table-name": table_name
-                }
-            )
-            print('Now converting dataframe into sql and placing into a temporary table')
-            df.to_sql(table_name, engine, if_exists='replace')
-            engine.commit()
-            logger.log('Copying temp_ratings into ratings', severity="INFO")
-
-            print('Now copying into the real table...')
-            connection = db.getconn()
-            cursor = connection.cursor()
-            sql = 'INSERT INTO ratings ("noteId", "createdAtMillis", "version", "agree", "disagree", "helpful", "notHelpful", "helpfulnessLevel", "helpfulOther", "helpfulInformative", "helpfulClear", "helpfulEmpathetic", "helpfulGoodSources", "helpfulUniqueContext", "helpfulAddressesClaim", "helpfulImportantContext", "helpfulUnbiasedLanguage", "notHelpfulOther", "notHelpfulIncorrect", "notHelpfulSourcesMissingOrUnreliable", "notHelpfulOpinionSpeculationOrBias", "notHelpfulMissingKeyPoints", "notHelpfulOutdated", "notHelpfulHardToUnderstand", "notHelpfulArgumentativeOrBiased", "notHelpfulOffTopic", "notHelpfulSpamHarassmentOrAbuse", "notHelpfulIrrelevantSources", "notHelpfulOpinionSpeculation", "notHelpfulNoteNotNeeded", "ratingsId", "raterParticipantId") SELECT "noteId", "createdAtMillis", "version", "agree", "disagree", "helpful", "notHelpful", "helpfulnessLevel", "helpfulOther", "helpfulInformative", "helpfulClear", "helpfulEmpathetic", "helpfulGoodSources", "helpfulUniqueContext", "helpfulAddressesClaim", "helpfulImportantContext", "helpfulUnbiasedLanguage", "notHelpfulOther", "notHelpfulIncorrect", "notHelpfulSourcesMissingOrUnreliable", "notHelpfulOpinionSpeculationOrBias", "notHelpfulMissingKeyPoints", "notHelpfulOutdated", "notHelpfulHardToUnderstand", "notHelpfulArgumentativeOrBiased", "notHelpfulOffTopic", "notHelpfulSpamHarassmentOrAbuse", "notHelpfulIrrelevantSources", "notHelpfulOpinionSpeculation", "notHelpfulNoteNotNeeded", "ratingsId", "raterParticipantId" FROM {0} ON CONFLICT DO NOTHING;'.format(table_name)
-            cursor.execute(sql)
-            try:
-                cursor.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-                logger.log_struct(
-                    {
-                        "message": 'Dropped temporary table',
-                        "severity": 'INFO',
-                        "table-name": table_name
-                    }
-                )
-            except Exception as e:
-                print('Unable to drop a temp table. Does it actually exist?')
-                print(str(type(e)))
-                logger.log_struct(
-                    {
-                        "message": "Error when dropping temp_notes",
-                        "severity": "WARNING",
-                        "table-name": table_name,
-                        "exception": str(type(e))
-                    })
-            cursor.close()
-            connection.commit()
-            db.putconn(connection)
-        except Exception as e:
-            print('Error when getting ratings:')
-            print(str(type(e)))
-            print(e)
-            logger.log_struct(
-                {
-                    "message": "Error when retreiving ratings.tsv",
-                    "severity": "WARNING",
-                    "exception": str(type(e))
-                })
-
-
-
-
-        ## Get noteStatusHistory ##
-        logger.log_struct(
-            {
-                "message": "Retrieving noteStatusHistory.tsv",
-                "severity": "INFO",
-                "current-date": str(file_path)
-            })
-        object = file_path + '/noteStatusHistory.tsv'
-        table_name = 'temp_status_' + date.today().strftime("%Y%m%d") + '_import_old'
-        print(f'Searching for {object}')
-        try:
-            df = retrieve_tsv(object)
-            try:
-                df['statusId'] = df[['noteId', 'noteAuthorParticipantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
-            except:
-                try:
-                    df['statusId'] = df[['noteId', 'participantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
-                except:
-                    df['statusId'] = 'IDERROR' + datetime.now().strftime('%s')
-
-            # Coax this column into being an actual number, and replace any NaN values with 0
-            df['timestampMillisOfStatusLock'] = pd.to_numeric(df['timestampMillisOfStatusLock'], errors='coerce').fillna(0).astype(int)
-
-            print(df.info())
-            print(df)
-            logger.log_struct(
-                {
-                    "message": 'Now converting dataframe into sql and placing into a temporary table',
-                    "severity": "INFO",
-                    "object": str(object),
-                    "table-name": table_name
-                }
-            )
-            print('Now converting dataframe into sql and placing in a temporary table')
-            df.to_sql(table_name, engine, if_exists='replace')
-            engine.commit()
-
-            # After moving data to the temporary table, attempt to force the column to be the correct type:
-            sql = 'ALTER TABLE {0} ALTER COLUMN "timestampMillisOfStatusLock" TYPE BIGINT;'.format(table_name)
-            print(f'Attempting to run SQL statement: {str(sql)}')
-            logger.log_struct(
-                {
-                    "message": 'Running SQL statement to convert column datatype',
-                    "severity": 'INFO',
-                    "table-name": table_name,
-                    "column-name": 'timestampMillisOfStatusLock',
-                    "sql": str(sql)
-                }
-            )
-            cursor.execute(sql)
-
-            logger.log('Copying temp_status into status_history', severity="INFO")
-            print('Now copying into the real table...')
-            connection = db.getconn()
-            cursor = connection.cursor()
-            # Manually specify which columns to insert so that we can *force* "timestampMillisOfStatusLock" to be cast as BIGINT when inserting into the primary table
-            sql = 'INSERT INTO status_history ("noteId", "noteAuthorParticipantId", "createdAtMillis", "timestampMillisOfFirstNonNMRStatus", "firstNonNMRStatus", "timestampMillisOfCurrentStatus", "currentStatus", "timestampMillisOfLatestNonNMRStatus", "mostRecentNonNMRStatus", "timestampMillisOfStatusLock", "lockedStatus", "timestampMillisOfRetroLock", "statusId") SELECT "noteId", "noteAuthorParticipantId", "createdAtMillis", "timestampMillisOfFirstNonNMRStatus", "firstNonNMRStatus", "timestampMillisOfCurrentStatus", "currentStatus", "timestampMillisOfLatestNonNMRStatus", "mostRecentNonNMRStatus", "timestampMillisOfStatusLock"::BIGINT, "lockedStatus", "timestampMillisOfRetroLock", "statusId" FROM {0} ON CONFLICT DO NOTHING;'.format(table_name)
-
-            cursor.execute(sql)
-            try:
-                cursor.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-                logger.log_struct(
-                    {
-                        "message": 'Dropped temporary table',
-                        "severity": 'INFO',
-                        "table-name": table_name
-                    }
-                )
-            except Exception as e:
-                print('Unable to drop a temp table. Does it actually exist?')
-                print(str(type(e)))
-                logger.log_struct(
-                    {
-                        "message": "Error when dropping temp_notes",
-                        "severity": "WARNING",
-                        "table-name": table_name,
-                        "exception": str(type(e))
-                    })
-            cursor.close()
-            connection.commit()
-            db.putconn(connection)
-
-
-        except Exception as e:
-            print('Error when getting noteStatusHisotyr:')
-            print(str(type(e)))
-            print(e)
-            logger.log_struct(
-                {
-                    "message": "Error when retreiving notesStatusHistory.tsv",
-                    "severity": "WARNING",
-                    "exception": str(type(e))
-                })
-            
-        
-
-
-
-        ## Get userEnrollmentStatus ##
-        logger.log_struct(
-            {
-                "message": "Retrieving userEnrollmentStatus.tsv",
-                "severity": "INFO",
-                "current-date": str(file_path)
-            })
-        object = file_path + '/userEnrollmentStatus.tsv'
-        table_name = 'temp_enrollment_' + date.today().strftime("%Y%m%d") + '_import_old'
-        try:
-            df = retrieve_tsv(object)
-            # Participant Ids may be duplicated (because the same user's status may change), so we concatenate with the timestamp to create a primary key
-            df['statusId'] = df[['participantId', 'timestampOfLastStateChange']].astype(str).apply(lambda x: ''.join(x), axis=1)
-            print(df.info())
-            print(df)
-            print('Now converting dataframe into sql and placing in a temporary table')
-            logger.log_struct(
-                {
-                    "message": 'Now converting dataframe into sql and placing into a temporary table',
-                    "severity": "INFO",
-                    "object": str(object),
-                    "table-name": table_name
-                }
-            )
-            df.to_sql(table_name, engine, if_exists='replace')
-            engine.commit()
-
-            # Some older data is likely to not include the modelPopulation value, so we add that column if it's not present. It will contain null data, but we add it just in case.
-            # sql = text("""INSERT INTO enrollment_status SELECT * FROM """ + table_name + """ ON CONFLICT DO NOTHING""")
-            sql = 'ALTER TABLE {0} ADD COLUMN IF NOT EXISTS "modelingPopulation" TEXT;'.format(table_name)
-            cursor.execute(sql)
-
-            print('Now copying into the real table...')
-            logger.log('Copying temp_userenrollment into enrollment_status', severity="INFO")
-            connection = db.getconn()
-            cursor = connection.cursor()
-            sql = 'INSERT INTO enrollment_status ("participantId", "enrollmentState", "successfulRatingNeededToEarnIn", "timestampOfLastStateChange", "timestampOfLastEarnOut", "modelingPopulation", "statusId") SELECT "participantId", "enrollmentState", "successfulRatingNeededToEarnIn", "timestampOfLastStateChange", "timestampOfLastEarnOut", "modelingPopulation", "statusId" FROM {0} ON CONFLICT DO NOTHING;'.format(table_name)
-            cursor.execute(sql)
-            try:
-                cursor.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-                logger.log_struct(
-                    {
-                        "message": 'Dropped temporary table',
-                        "severity": 'INFO',
-                        "table-name": table_name
-                    }
-                )
-            except Exception as e:
-                print('Unable to drop a temp table. Does it actually exist?')
-                print(str(type(e)))
-                logger.log_struct(
-                    {
-                        "message": "Error when dropping temp_notes",
-                        "severity": "WARNING",
-                        "table-name": table_name,
-                        "exception": str(type(e))
-                    })
-            cursor.close()
-            connection.commit()
-            db.putconn(connection)
-        except Exception as e:
-            print('Error when getting enrollment_status:')
-            print(str(type(e)))
-            print(e)
-            logger.log_struct(
-                {
-                    "message": "Error when retreiving enrollmentStatus.tsv",
-                    "severity": "WARNING",
-                    "exception": str(type(e))
-                })
-
-            
-    # close the db engine:
-    if engine:
-        engine.close()
+    # Every dataset of every day is its own unit of work, and they run on BACKFILL_WORKERS threads (see backfill.py)
+    # A db engine is only needed for LOAD_METHOD=to_sql - each worker gets its own, since they aren't thread safe
+    units = backfill.work_units(dates_list, list(IMPORTERS))
+    make_engine = connection_engine if bulk_load.load_method == 'to_sql' else None
+    backfill.run(db, units, IMPORTERS, make_engine=make_engine, logger=logger)
 
     # close the db connection pool:
     if db:
-        db.closeall
+        db.closeall()
         print("PostgreSQL connection pool is closed")
     
+    storage_session.log_stats(logger)
+    stage_timer.finish('import-old-tsv', logger)
+
+    # Make sure everything logged has been sent before a Cloud Function invocation returns
+    logger.flush(structured_log.exit_timeout)
     print('Done!')
 
 if __name__ == "__main__":
     start_time = datetime.now()
     print('FYI: Script started directly as __main__')
+    setup()
     logger.log_struct(
             {
                 "message": "Script Execution Started - import-old-tsv.py",
@@ -0,0 +1,128 @@
+from datetime import datetime, timezone
+from google.api_core.exceptions import NotFound
+import pyarrow as pa
+import os, shutil
+import compression
+
+# A directory on disk that stands in for a GCS bucket (STORAGE_BACKEND=local or mmap, see storage_session.py)
+#
+# Object names map straight onto paths under the directory, e.g. 2023/01/05/ratings00000.tsv is
+# <directory>/2023/01/05/ratings00000.tsv - the same layout that gcs_transfer.LocalFileSink writes downloads in.
+# Only the parts of the google.cloud.storage Bucket and Blob classes that this repo uses are here, and they
+# raise the same NotFound for missing objects.
+#
+# With memory_map=True, objects are opened for reading as memory-mapped (pyarrow) files instead. The kernel
+# pages them in as they're read rather than each read() copying into a buffer, pyarrow can read Parquet
+# snapshots straight out of the page cache, and the shard reader's worker processes share the same pages.
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split('/'))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    @property
+    def updated(self):
+        return datetime.fromtimestamp(os.path.getmtime(self.path), timezone.utc) if self.exists() else None
+
+    @property
+    def generation(self):
+        # Changes whenever the file is written, like a GCS generation
+        return os.stat(self.path).st_mtime_ns if self.exists() else None
+
+    @property
+    def content_encoding(self):
+        # Not stored anywhere - gzipped files are recognised by their first bytes, the same as compression.py does
+        if not self.exists():
+            return None
+        with open(self.path, 'rb') as f:
+            return 'gzip' if compression.is_gzip(f.read(2)) else None
+
+    @content_encoding.setter
+    def content_encoding(self, value):
+        # Nothing to set, see above
+        pass
+
+    @property
+    def content_type(self):
+        # Not stored either
+        return None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def reload(self):
+        if not self.exists():
+            raise NotFound(self.path)
+
+    def open(self, mode='rb', **kwargs):
+        # kwargs like raw_download= only mean something to GCS
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            return open(self.path, mode)
+        self.reload()
+        # Empty files can't be mapped
+        if self.bucket.memory_map and 'b' in mode and os.path.getsize(self.path):
+            return pa.memory_map(self.path, 'r')
+        return open(self.path, mode)
+
+    def download_as_bytes(self, **kwargs):
+        self.reload()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_to_filename(self, filename, **kwargs):
+        self.reload()
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        # Written to a temporary file and renamed, so that nothing ever reads half a file
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+
+    def delete(self, **kwargs):
+        self.reload()
+        os.remove(self.path)
+
+
+class LocalBucket:
+    def __init__(self, name, directory, memory_map=False):
+        self.name = name
+        self.path = directory
+        self.memory_map = memory_map
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        # None if it doesn't exist, like Bucket.get_blob()
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=''):
+        # In name order, like GCS. Files that are still being written (.part, .tmp) aren't objects yet
+        # Only the directory that the prefix points into is walked, not the whole archive
+        prefix = prefix or ''
+        start = os.path.join(self.path, *prefix.split('/')[:-1])
+        for directory, subdirectories, files in os.walk(start):
+            subdirectories.sort()
+            for file in sorted(files):
+                if file.endswith(('.part', '.tmp')):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file), self.path).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    yield LocalBlob(self, name)
@@ -1,12 +1,11 @@
 from google.cloud import storage
-import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from google.cloud.sql.connector import Connector, IPTypes
-import google.cloud.logging
 from datetime import datetime
 from dotenv import load_dotenv, find_dotenv
 import os, sqlalchemy, pg8000, socket
+import storage_session, structured_log, stage_timer, dataset_importer
 
 # REQUIREMENTS
 #
@@ -28,8 +27,8 @@ start_date = os.environ.get("DATE_OVERRIDE", date.today().strftime("%Y%m%d")).re
 
 
 # Set up Google cloud logging:
-log_client = google.cloud.logging.Client(project=project_id)
-logger = log_client.logger(name=log_name)
+# Log calls only queue the entry - it's sent in the background (see structured_log.py)
+logger = structured_log.get_logger(log_name, project_id)
 
 
 
@@ -101,25 +100,15 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 # [END cloud_sql_postgres_sqlalchemy_connect_connector]
 
 
-def retrieve_tsv(object):
-    path = 'gs://' + bucket_name + '/' + object
-    print(f'Loading {path} into a pandas DataFrame...')
-    logger.log_struct(
-            {
-                "message": "Retrieving TSV and loading into Pandas dataframe",
-                "severity": "INFO",
-                "object": str(object),
-                "gcs-path": str(path)
-            })
-    # gs://birdwatch-scraper_public-data/2022/11/12/ratings.tsv
-    df = pd.read_csv(path, sep='\t', header=0)
-    return df
+# Imported the same way as in import-tsv.py (see dataset_importer.py)
+importer = dataset_importer.Importer(bucket_name, project_id, logger)
 
 
 def main(event_data, context):
     # We have to include event_data and context because these will be passed as arguments when invoked as a Cloud Function
     # and the runtime will freak out if the function only accepts 0 arguments... go figure
     print('Started Execution')
+    stage_timer.reset()
     
     
     # Set up a db connection pool
@@ -128,7 +117,6 @@ def main(event_data, context):
         # Using a with statement ensures that the connection is always released
         # back into the pool at the end of statement (even if an error occurs)
         conn = db.raw_connection()
-        cur = conn.cursor()
         print('db connection seems to have worked')
         logger.log('Database Connection was successful')
     except Exception as e:
@@ -319,110 +307,9 @@ def main(event_data, context):
     #     quit()
 
     ## Get noteStatusHistory ##
-    try:
-        object = file_path + '/noteStatusHistory.tsv'
-        table_name = 'temp_status_' + start_date
-        df = retrieve_tsv(object)
-        try:
-            df['statusId'] = df[['noteId', 'noteAuthorParticipantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
-        except:
-            try:
-                df['statusId'] = df[['noteId', 'participantId']].astype(str).apply(lambda x: ''.join(x), axis=1)
-            except:
-                df['statusId'] = 'IDERROR' + datetime.now().strftime('%s')
-
-        print(df.info())
-        print(df)
-        df.sort_values(by=['createdAtMillis'], ascending=False, inplace=True)
-        # Only keep the top 10% of the dataframe - we are almost always dealing with duplicated data, so this will improve runtime
-        size = df.shape[0]
-        drop = int(size * 0.9)
-        df.drop(df.tail(drop).index, inplace = True)
-        logger.log_struct(
-            {
-                "message": 'Dropped rows from dataframe',
-                "original-size": str(size),
-                "dropped-rows": str(drop),
-                "new-size": str(df.shape[0]),
-                "severity": 'INFO',
-            }
-        )
-        print("***")
-        print(df)
-
-        # We've been getting some problems with the noteStatusHistory processing:
-        # 
-        # (pg8000.exceptions.DatabaseError) {'S': 'ERROR', 'V': 'ERROR', 'C': '42804', 'M': 'column "timestampMillisOfStatusLock" is of type bigint but expression is of type text', 'H': 'You will need to rewrite or cast the expression.', 'P': '35', 'F': 'parse_target.c', 'L': '595', 'R': 'transformAssignedExpr'}
-        # [SQL: INSERT INTO status_history SELECT * FROM temp_status_20230310 ON CONFLICT DO NOTHING;]
-        # 
-        # So we need to try and take that column and cast it to an int
-        # Looking at a recent TSV file, it looks like many of them have good timestamps, but many have a value of `-1` which is probably messing this up?
-        df['timestampMillisOfStatusLock'] = pd.to_numeric(df['timestampMillisOfStatusLock'], errors='coerce').fillna(0).astype(int)
-
-        print('Now converting dataframe into sql and placing in a temporary table')
-        logger.log_struct(
-            {
-                "message": 'Now converting dataframe into sql and placing into a temporary table',
-                "severity": "INFO",
-                "object": str(object),
-                "table-name": table_name
-            }
-        )
-
-        df.to_sql(table_name, db, if_exists='replace')
-
-        # After moving data to the temporary table, attempt to force the column to be the correct type:
-        with db.begin() as cn:
-            sql = text('ALTER TABLE ' + table_name + ' ALTER COLUMN "timestampMillisOfStatusLock" TYPE BIGINT;')
-            print(f'Attempting to run SQL statement: {str(sql)}')
-            logger.log_struct(
-                {
-                    "message": 'Running SQL statement to convert column datatype',
-                    "severity": 'INFO',
-                    "table-name": table_name,
-                    "column-name": 'timestampMillisOfStatusLock',
-                    "sql": str(sql)
-                }
-            )
-            cn.execute(sql)
-
-        print('Now copying into the real table...')
-        logger.log('Copying temp_status into status_history', severity="INFO")
-        with db.begin() as cn:
-            # Manually specify which columns to insert so that we can *force* "timestampMillisOfStatusLock" to be cast as BIGINT when inserting into the primary table
-            sql = text('INSERT INTO status_history ("noteId", "noteAuthorParticipantId", "createdAtMillis", "timestampMillisOfFirstNonNMRStatus", "firstNonNMRStatus", "timestampMillisOfCurrentStatus", "currentStatus", "timestampMillisOfLatestNonNMRStatus", "mostRecentNonNMRStatus", "timestampMillisOfStatusLock", "lockedStatus", "timestampMillisOfRetroLock", "statusId") SELECT "noteId", "noteAuthorParticipantId", "createdAtMillis", "timestampMillisOfFirstNonNMRStatus", "firstNonNMRStatus", "timestampMillisOfCurrentStatus", "currentStatus", "timestampMillisOfLatestNonNMRStatus", "mostRecentNonNMRStatus", "timestampMillisOfStatusLock"::BIGINT, "lockedStatus", "timestampMillisOfRetroLock", "statusId" FROM ' + table_name + ' ON CONFLICT DO NOTHING;')
-            cn.execute(sql)
-        try:
-            cur.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-            logger.log_struct(
-                {
-                    "message": 'Dropped temporary table',
-                    "severity": 'INFO',
-                    "table-name": table_name
-                }
-            )
-        except Exception as e:
-            print('Unable to drop a temp table. Does it actually exist?')
-            print(str(type(e)))
-            print(e)
-            logger.log_struct(
-                {
-                    "message": "Error when dropping temp_status",
-                    "severity": "WARNING",
-                    "table-name": table_name,
-                    "exception": str(type(e))
-                })
-        conn.commit()
-    except Exception as e:
-        print('Error when processing noteStatusHistory:')
-        print(str(type(e)))
-        print(e)
-        logger.log_struct(
-            {
-                "message": "Error when retreiving noteStatusHistory.tsv",
-                "severity": "WARNING",
-                "exception": str(type(e))
-            })
+    # Everything runs on conn, so the staging table can be a TEMP table. db is only used for LOAD_METHOD=to_sql
+    dataset = dataset_importer.DATASETS['noteStatusHistory']
+    importer.run(dataset, conn, file_path, dataset.staging_table(start_date), engine=db)
 
     print('Done! Now refreshing the db connection...')
     try:
@@ -430,7 +317,6 @@ def main(event_data, context):
         # Using a with statement ensures that the connection is always released
         # back into the pool at the end of statement (even if an error occurs)
         conn = db.raw_connection()
-        cur = conn.cursor()
         print('db connection seems to have worked')
     except:
         print('db connection failure')
@@ -529,8 +415,12 @@ def main(event_data, context):
     logger.log('Closing the db connection', severity="INFO")
     conn.close()
 
+    # Includes how many files came from the local cache (see blob_cache.py)
+    storage_session.log_stats(logger)
+    stage_timer.finish('note-status-only', logger)
 
-
+    # Make sure everything logged has been sent before a Cloud Function invocation returns
+    logger.flush(structured_log.exit_timeout)
     print('Done!')
 
 if __name__ == "__main__":
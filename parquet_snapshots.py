@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow.parquet as pq
+import io, os
+import bulk_load, tsv_reader, storage_session, watermarks, schemas
+
+# Typed Parquet copies of the downloaded TSVs, so imports don't have to parse text every time
+#
+# Each TSV in the bucket gets a Parquet snapshot next to it, partitioned by dataset and date:
+#
+#     2023/01/05/ratings00003.tsv -> parquet/dataset=ratings/date=2023-01-05/ratings00003.parquet
+#
+# Rows are sorted by the dataset's main timestamp and written in row groups of PARQUET_ROW_GROUP_ROWS, so a
+# reader that only wants rows newer than its watermark can skip most of the file using the row group stats.
+# Integer columns that pandas would have turned into floats (e.g. timestampMillisOfStatusLock, whenever a
+# file had a missing value) are stored as integers.
+#
+# READ_PARQUET=true makes the importers read the snapshot instead of the TSV whenever there is one, fetching
+# only the columns they use.
+# See convert-to-parquet.py for creating snapshots of files that are already in the bucket.
+
+parquet_prefix = os.environ.get("PARQUET_PREFIX", "parquet")
+row_group_rows = int(os.environ.get("PARQUET_ROW_GROUP_ROWS", 100000))
+read_parquet = os.environ.get("READ_PARQUET", "false").lower() in ('1', 'true', 'yes')
+write_parquet = os.environ.get("PARQUET_SNAPSHOTS", "false").lower() in ('1', 'true', 'yes')
+
+# The name the TSVs use for each dataset, and the table that it gets imported into
+DATASET_TABLES = {
+    'notes': 'notes',
+    'ratings': 'ratings',
+    'noteStatusHistory': 'status_history',
+    'userEnrollmentStatus': 'enrollment_status',
+}
+
+
+def snapshot_name(object):
+    # 2023/01/05/ratings00003.tsv -> parquet/dataset=ratings/date=2023-01-05/ratings00003.parquet
+    date_path, file_name = object.rsplit('/', 1)
+    return f'{parquet_prefix}/dataset={schemas.dataset_name(object)}/date={date_path.replace("/", "-")}/{file_name[:-len(".tsv")]}.parquet'
+
+
+def row_group_filters(object, mark):
+    # pyarrow filters that only keep rows newer than the watermark for object's dataset (in the same way as
+    # watermarks.filter_rows), or None to read everything
+    table = DATASET_TABLES.get(schemas.dataset_name(object))
+    if mark is None or table is None:
+        return None
+    # Any one of the timestamp columns being new enough is enough, so this is an OR of the columns
+    return [[(column, '>', mark - watermarks.overlap_millis)] for column in watermarks.WATERMARK_COLUMNS[table]]
+
+
+def to_parquet(df, object):
+    # Returns the Parquet file for df, as bytes
+    df = bulk_load.integral_floats_to_int(df)
+    table = DATASET_TABLES.get(schemas.dataset_name(object))
+    if table:
+        sort_column = watermarks.WATERMARK_COLUMNS[table][0]
+        if sort_column in df.columns:
+            df = df.sort_values(by=[sort_column], kind='stable', ignore_index=True)
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, engine='pyarrow', index=False, compression='zstd', row_group_size=row_group_rows)
+    return buffer.getvalue()
+
+
+def convert(bucket_name, object, project=None, overwrite=False):
+    # Write the snapshot for a TSV that is already in the bucket. Returns the number of rows, or None if
+    # there is no such TSV or its snapshot is already up to date
+    bucket = storage_session.get_bucket(bucket_name, project)
+    source = bucket.get_blob(object)
+    if source is None:
+        return None
+    snapshot = bucket.get_blob(snapshot_name(object))
+    if snapshot is not None and not overwrite and source.updated <= snapshot.updated:
+        return None
+    with storage_session.open_blob(bucket_name, object, project) as f:
+        df = tsv_reader.read_tsv(f, schemas.dtypes_for(object))
+    bucket.blob(snapshot_name(object)).upload_from_string(to_parquet(df, object), content_type='application/vnd.apache.parquet')
+    return df.shape[0]
+
+
+def convert_all(bucket_name, objects, project=None, workers=4, overwrite=False):
+    # Convert a list of TSVs in parallel. Returns the number of snapshots that were written
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert, bucket_name, object, project, overwrite): object for object in objects}
+        for future in as_completed(futures):
+            object = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                print(f'Error when converting {object} to Parquet')
+                print(type(e))
+                print(e)
+                continue
+            if rows is not None:
+                print(f'Wrote {snapshot_name(object)} ({rows} rows)')
+                written += 1
+    print(f'Wrote {written} Parquet snapshots out of {len(objects)} files')
+    return written
+
+
+def exists(bucket_name, object, project=None):
+    return storage_session.get_bucket(bucket_name, project).blob(snapshot_name(object)).exists()
+
+
+def present(columns, names):
+    # Older files don't have every column
+    if columns is None:
+        return None
+    return [column for column in columns if column in names]
+
+
+def read(bucket_name, object, project=None, columns=None, filters=None):
+    # Read object's snapshot, only fetching the columns asked for and the row groups that can match filters
+    with storage_session.get_bucket(bucket_name, project).blob(snapshot_name(object)).open('rb') as f:
+        names = pq.ParquetFile(f).schema_arrow.names
+        columns = present(columns, names)
+        if filters is not None:
+            filters = [clause for clause in filters if all(column in names for column, _, _ in clause)] or None
+        table = pq.read_table(f, columns=columns, filters=filters)
+    return table.to_pandas()
+
+
+def read_chunks(bucket_name, object, project=None, chunk_rows=None, columns=None):
+    # Same idea as tsv_reader.read_tsv_chunks(), one batch of rows at a time
+    if chunk_rows is None:
+        chunk_rows = tsv_reader.tsv_chunk_rows
+    with storage_session.get_bucket(bucket_name, project).blob(snapshot_name(object)).open('rb') as f:
+        file = pq.ParquetFile(f)
+        for batch in file.iter_batches(batch_size=chunk_rows, columns=present(columns, file.schema_arrow.names)):
+            yield batch.to_pandas()
+
+
+def watermark_filters(connection, object):
+    # Filters for read() that skip everything older than the watermark of object's table, when that is how we are importing
+    table = DATASET_TABLES.get(schemas.dataset_name(object))
+    if not read_parquet or watermarks.import_mode != 'incremental' or table is None:
+        return None
+    return row_group_filters(object, watermarks.get_watermark(connection, table))
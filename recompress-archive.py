@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.api_core.exceptions import PreconditionFailed
+import argparse, gzip, json, shutil, tempfile, time, os
+import storage_session, compression, schemas
+
+# Recompress the TSVs that are already in the bucket
+#
+# Goes through every .tsv object (or just the ones under --prefix) that isn't gzipped yet, and replaces it
+# with a gzipped copy that has Content-Encoding: gzip set, the same as new uploads (see compression.py).
+# The importers can read either kind, so it's safe to run this while they are running, and to stop it part
+# way through and run it again later.
+#
+# Prints the compression ratio and how quickly the gzipped files can be decoded for each dataset. Use
+# --dry-run to just measure that without changing anything.
+#
+# Each object is streamed through gzip into a temporary file and uploaded from there, so how big the files
+# are doesn't matter for memory - only for space in the temp directory.
+
+bucket_name = os.environ.get("gcs_bucket_name")
+project_id = os.environ.get("GCP_PROJECT")
+
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def recompress(blob, dry_run=False):
+    with tempfile.NamedTemporaryFile(suffix='.tsv.gz') as packed:
+        # Pinned to the generation that was listed, so the object can't change part way through reading it
+        with blob.open('rb', raw_download=True, if_generation_match=blob.generation) as f:
+            header = f.read(2)
+            if compression.is_gzip(header):
+                return None # Someone else got here first
+            start_time = time.perf_counter()
+            # No mtime (as in compression.compress()) or file name - it would be the temporary file's - in the header
+            with gzip.GzipFile(filename='', fileobj=packed, mode='wb', compresslevel=compression.compression_level, mtime=0) as writer:
+                writer.write(header)
+                shutil.copyfileobj(f, writer, COPY_CHUNK_BYTES)
+                raw_bytes = writer.tell()
+            compress_seconds = time.perf_counter() - start_time
+        packed.flush()
+        compressed_bytes = packed.tell()
+        packed.seek(0)
+        start_time = time.perf_counter()
+        with gzip.GzipFile(fileobj=packed, mode='rb') as reader:
+            while reader.read(COPY_CHUNK_BYTES):
+                pass
+        decode_seconds = time.perf_counter() - start_time
+        if not dry_run:
+            blob.content_encoding = 'gzip'
+            # Only replace the object if nobody has changed it since we downloaded it
+            blob.upload_from_filename(packed.name, content_type=blob.content_type or 'text/tab-separated-values', if_generation_match=blob.generation)
+    return {"raw-bytes": raw_bytes, "compressed-bytes": compressed_bytes, "compress-seconds": compress_seconds, "decode-seconds": decode_seconds}
+
+
+def report(totals):
+    print(f'{"dataset":<22}{"files":>7}{"raw MB":>12}{"gzip MB":>12}{"ratio":>8}{"decode MB/s":>14}')
+    for dataset, total in sorted(totals.items()):
+        ratio = total["raw-bytes"] / total["compressed-bytes"] if total["compressed-bytes"] else 0
+        throughput = total["raw-bytes"] / total["decode-seconds"] / 1e6 if total["decode-seconds"] else 0
+        print(f'{dataset:<22}{total["files"]:>7}{total["raw-bytes"] / 1e6:>12.1f}{total["compressed-bytes"] / 1e6:>12.1f}{ratio:>8.2f}{throughput:>14.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gzip the raw TSVs already stored in the bucket')
+    parser.add_argument('--prefix', default=None, help='Only look at objects under this prefix, e.g. 2023/01/')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true', help="Measure compression without replacing anything")
+    parser.add_argument('--json', action='store_true', help='Print the per-dataset numbers as JSON as well')
+    args = parser.parse_args()
+
+    bucket = storage_session.get_bucket(bucket_name, project_id)
+    blobs = [blob for blob in bucket.list_blobs(prefix=args.prefix) if blob.name.endswith('.tsv') and blob.content_encoding != 'gzip']
+    print(f'Found {len(blobs)} uncompressed TSVs to recompress using {args.workers} workers')
+
+    totals = {}
+    failed = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(recompress, blob, args.dry_run): blob for blob in blobs}
+        for future in as_completed(futures):
+            blob = futures[future]
+            try:
+                result = future.result()
+            except PreconditionFailed:
+                print(f'{blob.name} changed while it was being recompressed - skipping it')
+                continue
+            except Exception as e:
+                print(f'Error when recompressing {blob.name}')
+                print(type(e))
+                print(e)
+                failed += 1
+                continue
+            if result is None:
+                continue
+            total = totals.setdefault(schemas.dataset_name(blob.name), {"files": 0, "raw-bytes": 0, "compressed-bytes": 0, "compress-seconds": 0, "decode-seconds": 0})
+            total["files"] += 1
+            for key, value in result.items():
+                total[key] += value
+            print(f'{"Measured" if args.dry_run else "Recompressed"} {blob.name}: {result["raw-bytes"]} -> {result["compressed-bytes"]} bytes')
+
+    print(f'Finished in {time.perf_counter() - start_time:.1f} seconds with {failed} errors')
+    report(totals)
+    if args.json:
+        print(json.dumps(totals, indent=1))
+    storage_session.log_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import re, os
+
+# Column types for each Birdwatch dataset, used when the TSVs are parsed
+#
+# Without these pandas guesses every column's type on every read: IDs and timestamps become float64 whenever
+# a file has a blank in them, 0/1 flags take up 8 bytes each, and enum columns like classification are
+# stored as a separate python string on every row. Here IDs and timestamps are 64 bit ints, flags are
+# uint8, enums are categoricals, and participant IDs are arrow strings (about half the size of python ones).
+#
+# Timestamps that can legitimately be blank use pandas' nullable Int64, so they don't turn into floats.
+# Columns that aren't listed (e.g. ones added to the exports after the schema was written) are still
+# inferred by pandas. If a file doesn't fit its schema at all, tsv_reader.read_tsv() reads it again without one.
+#
+# Schemas are versioned, so that when the exports change a new version can be added without changing how
+# older ones are read. SCHEMA_VERSION picks the version to use (the newest by default), and
+# APPLY_SCHEMAS=false goes back to letting pandas infer everything. See benchmark-schemas.py for how much
+# memory this saves.
+
+apply_schemas = os.environ.get("APPLY_SCHEMAS", "true").lower() in ('1', 'true', 'yes')
+schema_version = int(os.environ.get("SCHEMA_VERSION", 0)) # 0 means the newest one
+
+FLAG = 'uint8'
+ENUM = 'category'
+PARTICIPANT = 'string[pyarrow]'
+
+NOTES_FLAGS = ['misleadingOther', 'misleadingFactualError', 'misleadingManipulatedMedia', 'misleadingOutdatedInformation', 'misleadingMissingImportantContext', 'misleadingUnverifiedClaimAsFact', 'misleadingSatire', 'notMisleadingOther', 'notMisleadingFactuallyCorrect', 'notMisleadingOutdatedButNotWhenWritten', 'notMisleadingClearlySatire', 'notMisleadingPersonalOpinion', 'trustworthySources', 'isMediaNote']
+RATINGS_FLAGS = ['agree', 'disagree', 'helpful', 'notHelpful', 'helpfulOther', 'helpfulInformative', 'helpfulClear', 'helpfulEmpathetic', 'helpfulGoodSources', 'helpfulUniqueContext', 'helpfulAddressesClaim', 'helpfulImportantContext', 'helpfulUnbiasedLanguage', 'notHelpfulOther', 'notHelpfulIncorrect', 'notHelpfulSourcesMissingOrUnreliable', 'notHelpfulOpinionSpeculationOrBias', 'notHelpfulMissingKeyPoints', 'notHelpfulOutdated', 'notHelpfulHardToUnderstand', 'notHelpfulArgumentativeOrBiased', 'notHelpfulOffTopic', 'notHelpfulSpamHarassmentOrAbuse', 'notHelpfulIrrelevantSources', 'notHelpfulOpinionSpeculation', 'notHelpfulNoteNotNeeded']
+
+SCHEMAS = {
+    'notes': {
+        1: dict({
+            'noteId': 'int64',
+            'noteAuthorParticipantId': PARTICIPANT,
+            'createdAtMillis': 'int64',
+            'tweetId': 'Int64',
+            'classification': ENUM,
+            'believable': ENUM,
+            'harmful': ENUM,
+            'validationDifficulty': ENUM,
+            'summary': 'object',
+        }, **{column: FLAG for column in NOTES_FLAGS}),
+    },
+    'ratings': {
+        1: dict({
+            'noteId': 'int64',
+            'raterParticipantId': PARTICIPANT,
+            'createdAtMillis': 'int64',
+            'version': FLAG,
+            'helpfulnessLevel': ENUM,
+        }, **{column: FLAG for column in RATINGS_FLAGS}),
+    },
+    'noteStatusHistory': {
+        1: {
+            'noteId': 'int64',
+            'noteAuthorParticipantId': PARTICIPANT,
+            'participantId': PARTICIPANT, # What older files called noteAuthorParticipantId
+            'createdAtMillis': 'int64',
+            'timestampMillisOfFirstNonNMRStatus': 'Int64',
+            'firstNonNMRStatus': ENUM,
+            'timestampMillisOfCurrentStatus': 'Int64',
+            'currentStatus': ENUM,
+            'timestampMillisOfLatestNonNMRStatus': 'Int64',
+            'mostRecentNonNMRStatus': ENUM,
+            'timestampMillisOfStatusLock': 'Int64',
+            'lockedStatus': ENUM,
+            'timestampMillisOfRetroLock': 'Int64',
+        },
+    },
+    'userEnrollmentStatus': {
+        1: {
+            'participantId': PARTICIPANT,
+            'enrollmentState': ENUM,
+            'successfulRatingNeededToEarnIn': 'Int64',
+            'timestampOfLastStateChange': 'int64',
+            'timestampOfLastEarnOut': 'Int64',
+            'modelingPopulation': ENUM,
+        },
+    },
+}
+
+
+def dataset_name(object):
+    # 2023/01/05/ratings00003.tsv -> ratings
+    return re.sub(r'\d*\.tsv$', '', object.split('/')[-1])
+
+
+def dtypes(dataset, version=None):
+    # The dtype= argument for pd.read_csv, or None to let pandas work it out
+    if not apply_schemas or dataset not in SCHEMAS:
+        return None
+    versions = SCHEMAS[dataset]
+    if version is None:
+        # The newest version that isn't newer than SCHEMA_VERSION
+        version = max(number for number in versions if not schema_version or number <= schema_version)
+    return dict(versions[version])
+
+
+def dtypes_for(object):
+    # Same as dtypes(), for a file in the bucket like 2023/01/05/ratings00003.tsv
+    return dtypes(dataset_name(object))
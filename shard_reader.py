@@ -0,0 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing, re, os
+import storage_session, tsv_reader, schemas, parquet_snapshots, blob_cache
+
+# Reads a day's shards of a dataset (e.g. ratings00000.tsv ... ratings00009.tsv) in parallel
+#
+# Which shards exist is worked out with a single listing of the bucket, rather than trying to read all ten
+# and catching the errors. The shards are then parsed in a pool of worker processes (parsing is CPU bound,
+# so threads wouldn't help much) and handed back one at a time as each finishes. They aren't concatenated,
+# so the caller can decide whether it needs to.
+#
+# SHARD_WORKERS sets the number of processes. By default there is one per core, up to the number of shards.
+
+shard_workers = int(os.environ.get("SHARD_WORKERS", 0))
+
+
+def list_shards(bucket_name, file_path, dataset, project=None):
+    # e.g. list_shards(bucket_name, '2023/01/05', 'ratings') -> ['2023/01/05/ratings00000.tsv', ...]
+    prefix = file_path + '/' + dataset
+    pattern = re.compile(re.escape(prefix) + r'\d{5}\.tsv$')
+    blobs = storage_session.get_bucket(bucket_name, project).list_blobs(prefix=prefix)
+    return sorted(blob.name for blob in blobs if pattern.match(blob.name))
+
+
+def read_shard(bucket_name, object, project=None, filters=None, columns=None):
+    # Runs in a worker process, which gets its own storage client (see storage_session.py)
+    # columns only applies to Parquet snapshots, since a TSV has to be parsed in full anyway
+    if parquet_snapshots.read_parquet and parquet_snapshots.exists(bucket_name, object, project):
+        return parquet_snapshots.read(bucket_name, object, project, columns=columns, filters=filters)
+    with storage_session.open_blob(bucket_name, object, project) as f:
+        return tsv_reader.read_tsv(f, schemas.dtypes_for(object))
+
+
+def read_shard_counted(bucket_name, object, project=None, filters=None, columns=None):
+    # read_shard() for the worker processes, which also hands back their cache hits and misses so that the
+    # parent process can report them
+    return read_shard(bucket_name, object, project, filters, columns), blob_cache.take_counts()
+
+
+def read_shards(bucket_name, objects, project=None, filters=None, workers=None, on_error=None, columns=None):
+    # Yields (object, DataFrame) for each shard as soon as it has been read, in whatever order they finish
+    # If on_error(object, exception) is given, shards that can't be read are passed to it and skipped
+    if workers is None:
+        workers = shard_workers or min(len(objects), os.cpu_count() or 1)
+    if workers <= 1 or len(objects) <= 1:
+        for object in objects:
+            try:
+                df = read_shard(bucket_name, object, project, filters, columns)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(object, e)
+                continue
+            yield object, df
+        return
+    # spawn rather than fork, since forking a process that has other threads running (the import pipelines,
+    # open GCS connections) can leave the child stuck on a lock that it will never get. Each worker imports the
+    # script's main module again, so scripts that use this keep their loggers etc. out of module level
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(read_shard_counted, bucket_name, object, project, filters, columns): object for object in objects}
+        for future in as_completed(futures):
+            object = futures[future]
+            try:
+                df, counts = future.result()
+                blob_cache.add_counts(counts)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(object, e)
+                continue
+            yield object, df
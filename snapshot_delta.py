@@ -0,0 +1,214 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os, tempfile, time
+import storage_session, snapshot_diff, stage_timer, parquet_snapshots
+
+# Works out what changed between two days' exports of a dataset, and writes just that as a delta
+#
+# Every export is a full snapshot, so the interesting part of each day is the rows that are new or different
+# from the day before. diff() compares the two days as streams of chunks, reducing every row to a key hash and a
+# content hash (see snapshot_diff.py) and matching them up with hash lookups on whole chunks - no row loops, and
+# only hashes of the previous day's keys and rows are held in memory, never either file. It finds:
+# - added: keys that are in the current day but weren't in the previous one
+# - changed: keys that are in both, but whose row is different
+# - removed: keys that were in the previous day and have gone
+#
+# The delta is written as zstd Parquet, partitioned like the Parquet snapshots:
+#
+#     delta/dataset=ratings/date=2023-01-05/changes.parquet   added and changed rows (every column, plus "change")
+#     delta/dataset=ratings/date=2023-01-05/removed.parquet   the key columns of removed rows
+#
+# changes.parquet records which day it was compared against ("previous-date" in its metadata). Content is
+# compared on the columns both days have, so a column being added to the export doesn't make every row "changed".
+# Keys are compared as 64-bit hashes. If a new key ever collided with an old one, its row would still be
+# written - as "changed" rather than "added" - since the rows themselves would still differ.
+#
+# READ_DELTA=true makes the importers load a day's delta instead of the whole file when there is one (see
+# dataset_importer.py). That's only right if the day it was compared against has already been imported.
+# See diff-snapshots.py for writing them.
+
+delta_prefix = os.environ.get("DELTA_PREFIX", "delta")
+read_delta = os.environ.get("READ_DELTA", "false").lower() in ('1', 'true', 'yes')
+
+CHANGE_COLUMN = 'change'
+
+
+def delta_name(dataset, date, part):
+    # ('ratings', '2023/01/05', 'changes') -> delta/dataset=ratings/date=2023-01-05/changes.parquet
+    return f'{delta_prefix}/dataset={dataset}/date={date.replace("/", "-")}/{part}.parquet'
+
+
+def exists(bucket_name, dataset, date, project=None):
+    return storage_session.get_bucket(bucket_name, project).blob(delta_name(dataset, date, 'changes')).exists()
+
+
+def read(bucket_name, dataset, date, project=None, part='changes'):
+    with storage_session.get_bucket(bucket_name, project).blob(delta_name(dataset, date, part)).open('rb') as f:
+        return pq.read_table(f).to_pandas()
+
+
+def read_chunks(bucket_name, dataset, date, project=None, part='changes', chunk_rows=100000):
+    with storage_session.get_bucket(bucket_name, project).blob(delta_name(dataset, date, part)).open('rb') as f:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+
+
+def previous_date(bucket_name, dataset, date, project=None):
+    # Which day a delta was compared against, from its metadata
+    with storage_session.get_bucket(bucket_name, project).blob(delta_name(dataset, date, 'changes')).open('rb') as f:
+        metadata = pq.ParquetFile(f).schema_arrow.metadata or {}
+    value = metadata.get(b'previous-date')
+    return value.decode() if value else None
+
+
+def arrow_schema(df, metadata=None):
+    # The schema every chunk gets written with. Each chunk's categories have their own dictionary, and a
+    # column that happens to be all empty in the first chunk has no type, so both are written as their values
+    # (Parquet dictionary-encodes strings by itself anyway)
+    fields = []
+    for field in pa.Schema.from_pandas(df, preserve_index=False):
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(field.type.value_type)
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=metadata)
+
+
+class DeltaWriter:
+    # Writes DataFrames one at a time into one Parquet file in bucket, which only appears once close() is called
+    # template is an (empty) DataFrame with the columns and types to write, so that a delta with no rows still
+    # gets a file saying so
+    def __init__(self, bucket, name, template, metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.schema = arrow_schema(template, metadata)
+        handle, self.path = tempfile.mkstemp(suffix='.parquet')
+        os.close(handle)
+        self.writer = pq.ParquetWriter(self.path, self.schema, compression='zstd')
+        self.rows = 0
+
+    def write(self, df):
+        if df.shape[0] == 0:
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False).select(self.schema.names).cast(self.schema)
+        self.writer.write_table(table)
+        self.rows += df.shape[0]
+
+    def close(self):
+        # Returns the size of the file, in bytes
+        self.writer.close()
+        try:
+            size = os.path.getsize(self.path)
+            self.bucket.blob(self.name).upload_from_filename(self.path, content_type='application/vnd.apache.parquet')
+        finally:
+            os.remove(self.path)
+        return size
+
+
+def peek(chunks):
+    # (the first chunk, or None if there aren't any, and an iterator over all of them including the first)
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return None, iter(())
+    return first, prepend(first, chunks)
+
+
+def prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+def index_previous(chunks, dataset, columns):
+    # The previous day's fingerprints, as hash indexes: one of its keys, and one of its row contents (with the
+    # key that went with each). Returns (keys, contents, content_keys, rows)
+    keys = []
+    contents = []
+    rows = 0
+    for chunk in chunks:
+        current = snapshot_diff.fingerprint(chunk, dataset, columns)
+        keys.append(current['key'].to_numpy())
+        contents.append(current['content'].to_numpy())
+        rows += chunk.shape[0]
+    key = np.concatenate(keys) if keys else np.array([], dtype='uint64')
+    content = np.concatenate(contents) if contents else np.array([], dtype='uint64')
+    del keys, contents
+    # A key can be in a file more than once (it happens in ratings), so each index only keeps one of each
+    unique_key = pd.Index(key).drop_duplicates()
+    duplicated = pd.Index(content).duplicated()
+    return unique_key, pd.Index(content[~duplicated]), key[~duplicated], rows
+
+
+def diff(previous_chunks, current_chunks, dataset, bucket, date, previous_date_name):
+    # Compare two days of dataset (each an iterable of DataFrames, read straight from the files) and write the
+    # delta for date into bucket. previous_chunks is a function that returns the previous day's chunks, since
+    # it's read a second time if anything was removed. Returns a summary of what was found
+    started = time.perf_counter()
+    key_columns = snapshot_diff.KEY_COLUMNS.get(dataset, [])
+    first_previous, previous = peek(previous_chunks())
+    first_current, current = peek(current_chunks)
+    if first_current is None:
+        raise ValueError(f'The {dataset} files for {date} are empty')
+    # Only the columns that both days have are compared
+    columns = [column for column in first_current.columns if first_previous is None or column in first_previous.columns]
+
+    table = parquet_snapshots.DATASET_TABLES.get(dataset, dataset)
+    with stage_timer.start(table, 'index-previous') as stage:
+        index, content_index, content_keys, previous_rows = index_previous(stage.excluding(previous), dataset, columns)
+        stage.rows = previous_rows
+    seen = np.zeros(len(index), dtype=bool)
+
+    summary = {"dataset": dataset, "date": date, "previous-date": previous_date_name, "previous-rows": previous_rows, "current-rows": 0, "added": 0, "changed": 0, "unchanged": 0, "removed": 0}
+    metadata = {"previous-date": previous_date_name, "dataset": dataset}
+    template = first_current.head(0).assign(**{CHANGE_COLUMN: pd.Series(dtype=object)})
+    changes = DeltaWriter(bucket, delta_name(dataset, date, 'changes'), template, metadata)
+    comparing = stage_timer.start(table, 'compare')
+    for chunk in comparing.excluding(current):
+        fingerprint = snapshot_diff.fingerprint(chunk, dataset, columns)
+        key = fingerprint['key'].to_numpy()
+        position = index.get_indexer(key)
+        found = position >= 0
+        seen[position[found]] = True
+        # A row is unchanged if the previous day had exactly that row (same content and key) anywhere in it
+        matched = content_index.get_indexer(fingerprint['content'].to_numpy())
+        unchanged = matched >= 0
+        unchanged[unchanged] = content_keys[matched[unchanged]] == key[unchanged]
+        is_changed = found & ~unchanged
+        is_added = ~found
+        summary["current-rows"] += chunk.shape[0]
+        summary["added"] += int(is_added.sum())
+        summary["changed"] += int(is_changed.sum())
+        keep = is_added | is_changed
+        if keep.any():
+            delta = chunk[keep].copy()
+            delta[CHANGE_COLUMN] = np.where(is_added[keep], 'added', 'changed')
+            changes.write(delta)
+    comparing.stop(rows=summary["current-rows"])
+    summary["unchanged"] = summary["current-rows"] - summary["added"] - summary["changed"]
+    summary["changes-bytes"] = changes.close()
+
+    # Removed keys are usually rare, so the previous day is only read again (for their key columns) when there are some
+    gone = ~seen
+    summary["removed"] = int(gone.sum())
+    source = first_previous if first_previous is not None else first_current
+    removed = DeltaWriter(bucket, delta_name(dataset, date, 'removed'), source[[column for column in key_columns if column in source.columns]].head(0), metadata)
+    if summary["removed"]:
+        with stage_timer.start(table, 'removed') as stage:
+            for chunk in stage.excluding(previous_chunks()):
+                position = index.get_indexer(snapshot_diff.fingerprint(chunk, dataset, columns)['key'].to_numpy())
+                wanted = position >= 0
+                wanted[wanted] = gone[position[wanted]]
+                rows = np.flatnonzero(wanted)
+                # Each removed key once, even if the file had it more than once
+                unique, first = np.unique(position[rows], return_index=True)
+                rows = rows[np.sort(first)]
+                gone[position[rows]] = False
+                removed.write(chunk.iloc[rows][removed.schema.names])
+            stage.rows = summary["removed"]
+    summary["removed-bytes"] = removed.close()
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    summary["peak-rss-bytes"] = stage_timer.peak_rss()
+    return summary
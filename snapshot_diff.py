@@ -0,0 +1,63 @@
+import pandas as pd
+import os, threading
+
+# Works out which rows of a daily export weren't in the previous day's export
+#
+# Every export is a full snapshot, so a backfill that loads each day in turn sends nearly the same rows to
+# postgres over and over, only for ON CONFLICT to throw them away. Instead, each row is reduced to a
+# fingerprint - a hash of its primary key columns and a hash of the whole row - and only the rows whose
+# fingerprint isn't in the previous day's file are loaded. Those are the new rows and the ones that changed.
+#
+# Set BACKFILL_DEDUP=true to use it in import-old-tsv.py.
+
+cross_day_dedup = os.environ.get("BACKFILL_DEDUP", "false").lower() in ('1', 'true', 'yes')
+
+# The columns that the surrogate keys are built from (see surrogate_keys.py)
+KEY_COLUMNS = {
+    'notes': ['noteId'],
+    'ratings': ['noteId', 'raterParticipantId'],
+    'noteStatusHistory': ['noteId', 'noteAuthorParticipantId'],
+    'userEnrollmentStatus': ['participantId', 'timestampOfLastStateChange'],
+}
+
+
+def fingerprint(df, dataset, columns=None):
+    # A DataFrame with a 'key' and 'content' hash for each row of df, in the same order
+    # Call it before adding any columns of our own (ratingsId etc.), so that it only covers what is in the file
+    # columns limits the content hash to those columns, e.g. the ones that two days' files both have
+    content = pd.util.hash_pandas_object(df if columns is None else df[columns], index=False).to_numpy()
+    keys = [column for column in KEY_COLUMNS.get(dataset, []) if column in df.columns]
+    key = pd.util.hash_pandas_object(df[keys], index=False).to_numpy() if keys else content
+    return pd.DataFrame({'key': key, 'content': content})
+
+
+def changed(current, previous):
+    # Boolean array, True for each row of current (a fingerprint) that isn't in previous
+    # A row only counts as unchanged if both its key and content hashes match, so a collision on one of them
+    # can't make a new row get skipped
+    previous = pd.Series(previous['key'].to_numpy(), index=previous['content'].to_numpy())
+    previous = previous[~previous.index.duplicated()]
+    position = previous.index.get_indexer(current['content'].to_numpy())
+    matched_key = previous.to_numpy()[position]
+    return ~((position >= 0) & (matched_key == current['key'].to_numpy()))
+
+
+class FingerprintCache:
+    # Holds on to each day's fingerprint until the next day has used it, so that the previous day's file
+    # usually doesn't need to be read a second time. Thread safe, since backfill units run in parallel
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.taken = set()
+
+    def put(self, date, dataset, fingerprint):
+        # Not kept if the next day has already been and looked for it, since nothing else will
+        with self.lock:
+            if (date, dataset) not in self.taken:
+                self.fingerprints[(date, dataset)] = fingerprint
+
+    def take(self, date, dataset):
+        # Returns None if it isn't there
+        with self.lock:
+            self.taken.add((date, dataset))
+            return self.fingerprints.pop((date, dataset), None)
@@ -0,0 +1,257 @@
+from datetime import datetime, timezone
+import io, json, os, resource, socket, threading, time
+
+# Times each stage of an import (download, parse, building keys, trimming, loading, the INSERT, the DROP)
+# for each dataset, so we can see where a run spends its time and notice when that changes
+#
+# stage = stage_timer.start('ratings', 'insert') ... stage.stop(rows=cursor.rowcount)
+# records the stage's wall clock time, the CPU time used by the thread that ran it, how many rows and bytes
+# it handled, and the peak memory use (RSS) of the whole process when it ended. Stages can also be used as
+# `with stage_timer.start(...) as stage:`. Note that the CPU time of anything a stage hands to other
+# processes (e.g. shard_reader.py) isn't counted.
+#
+# Call reset() at the start of each run, since a Cloud Function instance can be reused for several of them.
+# At the end of a run, finish() logs a summary and writes:
+# - the full report as JSON to RUN_REPORT, if it's set
+# - Prometheus metrics to PROMETHEUS_TEXTFILE, if it's set (e.g. a .prom file in node_exporter's
+#   --collector.textfile.directory)
+
+run_report = os.environ.get("RUN_REPORT")
+prometheus_textfile = os.environ.get("PROMETHEUS_TEXTFILE")
+metric_prefix = os.environ.get("PROMETHEUS_PREFIX", "birdwatch_import")
+
+lock = threading.Lock()
+stages = []
+run_started = time.time()
+
+
+def reset():
+    # Forget the stages of any earlier run in this process, and start the clock for a new one
+    global run_started
+    with lock:
+        stages.clear()
+        run_started = time.time()
+
+
+def peak_rss():
+    # Bytes. ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        self.rows = None
+        self.bytes = None
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        self.excluded = 0.0
+        self.excluded_cpu = 0.0
+        self.stopped = False
+
+    def stop(self, rows=None, bytes=None):
+        # Can only be stopped once - calling it again does nothing
+        if self.stopped:
+            return
+        self.stopped = True
+        if rows is not None:
+            self.rows = rows
+        if bytes is not None:
+            self.bytes = bytes
+        record(self.dataset, self.name, time.perf_counter() - self.wall_start - self.excluded, time.thread_time() - self.cpu_start - self.excluded_cpu, self.rows, self.bytes, self.started)
+
+    def split_off(self, name, seconds, rows=None, bytes=None):
+        # Record seconds of this stage as a separate stage instead, e.g. the time a parse spent waiting on the download
+        self.excluded += seconds
+        record(self.dataset, name, seconds, None, rows, bytes, self.started)
+
+    def excluding(self, chunks):
+        # Iterates over chunks without counting the time it takes to produce them (e.g. a parse that is
+        # timed on its own) as part of this stage
+        iterator = iter(chunks)
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.excluded += time.perf_counter() - wall_start
+                self.excluded_cpu += time.thread_time() - cpu_start
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def start(dataset, name):
+    return Stage(dataset, name)
+
+
+def record(dataset, name, seconds, cpu_seconds=None, rows=None, bytes=None, started=None):
+    entry = {
+        "dataset": dataset,
+        "stage": name,
+        "started": datetime.fromtimestamp(started or time.time(), timezone.utc).isoformat(),
+        "seconds": seconds,
+        "cpu-seconds": cpu_seconds,
+        "rows": rows,
+        "bytes": bytes,
+        "peak-rss-bytes": peak_rss(),
+    }
+    with lock:
+        stages.append(entry)
+    return entry
+
+
+def timed_chunks(chunks, dataset, name, reader=None):
+    # Times a generator of DataFrames as one stage, counting only the time spent producing each chunk and not
+    # whatever the caller does with it in between. If reader (a TimedReader) is given, the time spent waiting on
+    # it is recorded as a separate download stage
+    started = time.time()
+    seconds = 0.0
+    cpu_seconds = 0.0
+    rows = 0
+    iterator = iter(chunks)
+    try:
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - wall_start
+                cpu_seconds += time.thread_time() - cpu_start
+            rows += chunk.shape[0]
+            yield chunk
+    finally:
+        download = reader.seconds if reader is not None else 0.0
+        if reader is not None:
+            record(dataset, 'download', download, None, None, reader.bytes, started)
+        record(dataset, name, seconds - download, cpu_seconds, rows, None, started)
+
+
+class TimedReader(io.RawIOBase):
+    # Wraps a file so that the time spent waiting in read() (i.e. on the download) and the bytes read can be
+    # counted, while the file is still being parsed as it streams in
+    def __init__(self, f):
+        self.f = f
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.f.seekable()
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, size=-1):
+        start_time = time.perf_counter()
+        data = self.f.read(size)
+        self.seconds += time.perf_counter() - start_time
+        self.bytes += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def totals():
+    # Each (dataset, stage) added up, since some stages happen more than once (e.g. once per chunk)
+    summed = {}
+    with lock:
+        for entry in stages:
+            total = summed.setdefault((entry["dataset"], entry["stage"]), {"dataset": entry["dataset"], "stage": entry["stage"], "count": 0, "seconds": 0.0, "cpu-seconds": 0.0, "rows": 0, "bytes": 0})
+            total["count"] += 1
+            for field in ("seconds", "cpu-seconds", "rows", "bytes"):
+                total[field] += entry[field] or 0
+    for total in summed.values():
+        total["rows-per-second"] = total["rows"] / total["seconds"] if total["seconds"] else None
+    return list(summed.values())
+
+
+def report(script=None):
+    with lock:
+        recorded = list(stages)
+    return {
+        "script": script,
+        "hostname": socket.gethostname(),
+        "started": datetime.fromtimestamp(run_started, timezone.utc).isoformat(),
+        "seconds": time.time() - run_started,
+        "peak-rss-bytes": peak_rss(),
+        "totals": totals(),
+        "stages": recorded,
+    }
+
+
+def prometheus_metrics(run):
+    def labels(total):
+        return '{{script="{0}",dataset="{1}",stage="{2}"}}'.format(run["script"], total["dataset"], total["stage"])
+    metrics = [
+        ('stage_seconds', 'Wall clock seconds spent in each stage of the last run', 'seconds'),
+        ('stage_cpu_seconds', 'CPU seconds used by each stage of the last run', 'cpu-seconds'),
+        ('stage_rows', 'Rows handled by each stage of the last run', 'rows'),
+        ('stage_bytes', 'Bytes handled by each stage of the last run', 'bytes'),
+    ]
+    lines = []
+    for name, help, field in metrics:
+        lines.append(f'# HELP {metric_prefix}_{name} {help}')
+        lines.append(f'# TYPE {metric_prefix}_{name} gauge')
+        for total in run["totals"]:
+            lines.append(f'{metric_prefix}_{name}{labels(total)} {total[field]}')
+    script = '{{script="{0}"}}'.format(run["script"])
+    for name, help, value in [
+            ('run_seconds', 'Wall clock seconds the last run took', run["seconds"]),
+            ('peak_rss_bytes', 'Peak resident memory of the last run', run["peak-rss-bytes"]),
+            ('last_run_timestamp_seconds', 'When the last run finished', time.time())]:
+        lines.append(f'# HELP {metric_prefix}_{name} {help}')
+        lines.append(f'# TYPE {metric_prefix}_{name} gauge')
+        lines.append(f'{metric_prefix}_{name}{script} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, text):
+    # node_exporter could read the file half written otherwise
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def finish(script, logger=None):
+    # Log the totals, and write the report and metrics files if they're turned on. Returns the report
+    run = report(script)
+    for total in sorted(run["totals"], key=lambda total: -total["seconds"]):
+        print(f'{total["dataset"]:<18}{total["stage"]:<12}{total["seconds"]:9.2f}s {total["cpu-seconds"]:9.2f}s cpu {total["rows"]:>12,} rows')
+    print(f'Peak memory use: {run["peak-rss-bytes"] / 1024 / 1024:.0f} MiB')
+    if logger:
+        logger.log_struct(
+            {
+                "message": 'Run report',
+                "severity": 'INFO',
+                "script": script,
+                "seconds": str(run["seconds"]),
+                "peak-rss-bytes": str(run["peak-rss-bytes"]),
+                "totals": json.dumps(run["totals"])
+            })
+    if run_report:
+        write_atomically(run_report, json.dumps(run, indent=1))
+    if prometheus_textfile:
+        write_atomically(prometheus_textfile, prometheus_metrics(run))
+    return run
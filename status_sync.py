@@ -0,0 +1,74 @@
+import os
+
+# Keeps status_history in step with the latest noteStatusHistory export by comparing content hashes
+#
+# Every row in status_history gets a "contentHash" (an md5 of all of its columns apart from the key), worked
+# out by postgres from the same column types whether the row is in the staging table or the real one. An
+# import then only has to compare one value per row to know whether a note's status has changed, and only
+# rewrites the rows where it has - so catching up costs as much as the number of changed notes, not a reload.
+#
+# Set STATUS_SYNC=true to use it in import-tsv.py. The first run adds the column and hashes the rows that
+# are already there, which touches the whole table once.
+# Set STATUS_CHANGE_LOG=true to also keep a status_changes table with a row (old and new status) for every
+# note whose status changed.
+
+status_sync = os.environ.get("STATUS_SYNC", "false").lower() in ('1', 'true', 'yes')
+change_log = os.environ.get("STATUS_CHANGE_LOG", "false").lower() in ('1', 'true', 'yes')
+
+HASH_COLUMN = 'contentHash'
+KEY_COLUMN = 'statusId'
+CHANGE_LOG_TABLE = 'status_changes'
+
+
+def quoted(columns, table=None):
+    prefix = table + '.' if table else ''
+    return ', '.join(prefix + '"' + column + '"' for column in columns)
+
+
+def hash_sql(columns, table=None):
+    # ROW(...)::text depends on the column types, which is why both sides have to be hashed by postgres
+    # The columns are sorted, so the hash doesn't depend on what order they were listed in
+    hashed = sorted(column for column in columns if column not in (KEY_COLUMN, HASH_COLUMN))
+    return 'md5(ROW({0})::text)::uuid'.format(quoted(hashed, table))
+
+
+def ensure_tables(connection, columns, target_table='status_history'):
+    # Adds the hash column the first time round, and hashes everything that's already in the table
+    # columns should be the same list that gets passed to sync()
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s;', (target_table, HASH_COLUMN))
+    if cursor.fetchone() is None:
+        print(f'Adding "{HASH_COLUMN}" to {target_table} - this hashes every row that is already there, so it takes a while')
+        cursor.execute('ALTER TABLE {0} ADD COLUMN IF NOT EXISTS "{1}" UUID;'.format(target_table, HASH_COLUMN))
+        cursor.execute('UPDATE {0} SET "{1}" = {2};'.format(target_table, HASH_COLUMN, hash_sql(columns)))
+    if change_log:
+        cursor.execute('CREATE TABLE IF NOT EXISTS {0} ("changeId" BIGSERIAL PRIMARY KEY, "statusId" TEXT NOT NULL, "noteId" BIGINT, "previousStatus" TEXT, "currentStatus" TEXT, "previousLockedStatus" TEXT, "lockedStatus" TEXT, "timestampMillisOfCurrentStatus" BIGINT, "previousHash" UUID, "contentHash" UUID, "changedAt" TIMESTAMP NOT NULL DEFAULT now());'.format(CHANGE_LOG_TABLE))
+    cursor.close()
+    connection.commit()
+
+
+def sync(connection, table_name, columns, target_table='status_history', casts=None, newest_column='timestampMillisOfCurrentStatus'):
+    # Copy the staging table table_name into target_table: new rows are added, rows whose hash differs are
+    # updated (and logged to status_changes, if turned on) and everything else is left alone
+    # If a note is in the staging table more than once, the row with the highest newest_column is the one used
+    # Returns (inserted, updated). Doesn't commit, so it happens along with the rest of the import
+    casts = casts or {}
+    columns = [column for column in columns if column != HASH_COLUMN]
+    select_list = ', '.join('"' + column + '"' + ('::' + casts[column] if column in casts else '') for column in columns)
+    updates = [column for column in columns if column != KEY_COLUMN]
+    cursor = connection.cursor()
+    # Each note once, cast to the real table's types and then hashed the same way as the rows already in target_table
+    incoming = 'SELECT *, {0} AS "{1}" FROM (SELECT DISTINCT ON ("{2}") {3} FROM {4} ORDER BY "{2}", "{5}" DESC NULLS LAST) d'.format(hash_sql(columns, 'd'), HASH_COLUMN, KEY_COLUMN, select_list, table_name, newest_column)
+    if change_log:
+        # Before the update, while the previous status is still there to log
+        # Rows added by something else (e.g. note-status-only.py) have no hash, so those are only logged if the status itself differs
+        cursor.execute('INSERT INTO {0} ("statusId", "noteId", "previousStatus", "currentStatus", "previousLockedStatus", "lockedStatus", "timestampMillisOfCurrentStatus", "previousHash", "contentHash") SELECT t."statusId", s."noteId", t."currentStatus", s."currentStatus", t."lockedStatus", s."lockedStatus", s."timestampMillisOfCurrentStatus", t."{1}", s."{1}" FROM ({2}) s JOIN {3} t USING ("{4}") WHERE t."{1}" IS DISTINCT FROM s."{1}" AND (t."{1}" IS NOT NULL OR (t."currentStatus", t."lockedStatus") IS DISTINCT FROM (s."currentStatus", s."lockedStatus"));'.format(CHANGE_LOG_TABLE, HASH_COLUMN, incoming, target_table, KEY_COLUMN))
+    # Rows whose hash already matches are dropped before the INSERT - otherwise ON CONFLICT would still lock
+    # (and write WAL for) every one of them, even though it then decides not to update them
+    # xmax is 0 for a row that has just been inserted, and set for one that was updated
+    cursor.execute('WITH merged AS (INSERT INTO {0} ({1}, "{2}") SELECT * FROM ({3}) s WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE t."{4}" = s."{4}" AND t."{2}" = s."{2}") ON CONFLICT ("{4}") DO UPDATE SET {5}, "{2}" = EXCLUDED."{2}" WHERE {0}."{2}" IS DISTINCT FROM EXCLUDED."{2}" RETURNING (xmax = 0) AS inserted) SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged;'.format(
+        target_table, quoted(columns), HASH_COLUMN, incoming, KEY_COLUMN,
+        ', '.join('"{0}" = EXCLUDED."{0}"'.format(column) for column in updates)))
+    inserted, updated = cursor.fetchone()
+    cursor.close()
+    return inserted, updated
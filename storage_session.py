@@ -0,0 +1,117 @@
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
+import threading, os
+import compression, local_bucket, blob_cache
+
+# One google.cloud.storage Client (and one handle per bucket) for the whole process
+#
+# Creating a new storage.Client for every upload means re-doing auth and opening a brand new HTTP session
+# every time, which is especially slow on a Cloud Function cold start. Everything that talks to GCS should
+# get its client or bucket from here instead, so that connections get reused.
+#
+# stats() reports how many clients were created vs reused, and how many HTTP connections were opened vs
+# reused for requests.
+#
+# STORAGE_BACKEND picks where the "bucket" actually is:
+# - gcs (the default) is Google Cloud Storage
+# - local is a directory on disk, STORAGE_DIR (see local_bucket.py). On a host that keeps its own copy of the
+#   files (e.g. the on-prem postgres server, see migration-notes.md), imports read them at disk speed instead of
+#   going back to GCS, and the downloaders can write straight into it
+# - mmap is the same directory, but files are read through memory maps rather than copied into read buffers
+# Setting LOCAL_BUCKET_DIR (what gcs_transfer.py used to check) is the same as STORAGE_BACKEND=local with that STORAGE_DIR.
+
+http_pool_size = int(os.environ.get("STORAGE_POOL_SIZE", 16)) # Connections kept open per host - should be at least DOWNLOAD_WORKERS
+
+storage_dir = os.environ.get("STORAGE_DIR", os.environ.get("LOCAL_BUCKET_DIR"))
+storage_backend = os.environ.get("STORAGE_BACKEND", "local" if os.environ.get("LOCAL_BUCKET_DIR") else "gcs")
+
+BACKENDS = ('gcs', 'local', 'mmap')
+if storage_backend not in BACKENDS:
+    raise ValueError(f'STORAGE_BACKEND must be one of {", ".join(BACKENDS)}, not {storage_backend}')
+if storage_backend != 'gcs' and not storage_dir:
+    raise ValueError(f'STORAGE_BACKEND={storage_backend} needs STORAGE_DIR to be set')
+
+# The directory the bucket lives in, or None when it's in GCS
+local_root = storage_dir if storage_backend != 'gcs' else None
+
+lock = threading.Lock()
+clients = {}
+buckets = {}
+counters = {"clients-created": 0, "clients-reused": 0}
+
+
+def get_client(project=None):
+    # Keyed on the process id as well, so a forked worker process makes its own client rather than sharing sockets with its parent
+    key = (os.getpid(), project)
+    with lock:
+        if key in clients:
+            counters["clients-reused"] += 1
+            return clients[key]
+        client = storage.Client(project)
+        adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+        client._http.mount('https://', adapter)
+        client._http.mount('http://', adapter)
+        clients[key] = client
+        counters["clients-created"] += 1
+        return client
+
+
+def get_bucket(bucket_name, project=None):
+    key = (os.getpid(), project, bucket_name)
+    if local_root:
+        return local_bucket.LocalBucket(bucket_name, local_root, memory_map=storage_backend == 'mmap')
+    client = get_client(project)
+    with lock:
+        if key not in buckets:
+            buckets[key] = client.bucket(bucket_name)
+        return buckets[key]
+
+
+@contextmanager
+def open_blob(bucket_name, object, project=None):
+    # File-like object for reading a blob, which pd.read_csv can read from directly
+    # Gzipped objects are downloaded as they are stored and decompressed here (see compression.py)
+    # With BLOB_CACHE=true, objects in GCS are read from a copy on local disk when there is a current one (see blob_cache.py)
+    if blob_cache.enabled and not local_root:
+        with blob_cache.open_cached(get_bucket(bucket_name, project), object) as f:
+            yield compression.decompressed(f)
+        return
+    with get_bucket(bucket_name, project).blob(object).open('rb', raw_download=True) as f:
+        yield compression.decompressed(f)
+
+
+def url(bucket_name, object):
+    # Where object is, for printing and logging
+    if local_root:
+        return os.path.join(local_root, *object.split('/'))
+    return 'gs://' + bucket_name + '/' + object
+
+
+def stats():
+    connections_opened = 0
+    requests_sent = 0
+    with lock:
+        for client in clients.values():
+            for adapter in set(client._http.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in list(pools.keys()):
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    connections_opened += pool.num_connections
+                    requests_sent += pool.num_requests
+        result = dict(counters)
+    result["connections-opened"] = connections_opened
+    result["connections-reused"] = max(0, requests_sent - connections_opened)
+    if blob_cache.enabled:
+        result.update({"cache-" + name: value for name, value in blob_cache.stats().items()})
+    return result
+
+
+def log_stats(logger=None):
+    result = stats()
+    print(f'GCS session stats: {result}')
+    if logger:
+        logger.log_struct(dict({"message": "GCS storage session stats", "severity": "INFO"}, **{key: str(value) for key, value in result.items()}))
+    return result
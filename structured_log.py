@@ -0,0 +1,206 @@
+from datetime import datetime, timezone
+import atexit, json, os, queue, sys, threading, time
+
+# Structured logging for the scripts, without waiting on the network for every log line
+#
+# get_logger() returns something with the same log_struct() / log() / log_text() calls as a Google Cloud
+# Logging logger. Calling them only puts the entry on a queue; a background thread takes entries off in
+# batches (up to LOG_BATCH_SIZE, or whatever has turned up after LOG_FLUSH_SECONDS) and sends each batch in
+# one request. Anything still queued is sent when the script exits, or when flush() is called.
+#
+# LOG_SINKS is a comma separated list of where the entries go: 'cloud' (Google Cloud Logging, the default)
+# and/or 'jsonl', which appends them as JSON lines to LOG_FILE (default <log name>.jsonl, or
+# birdwatch-scraper.jsonl when there's no LOG_ID) - handy for running offline, without any GCP credentials.
+# The queue holds at most LOG_QUEUE_SIZE entries. When it's full, LOG_DROP_POLICY decides what happens:
+# 'drop-newest' (the default) throws away the new entry, 'drop-oldest' throws away the oldest queued one
+# instead, and 'block' waits for room. Dropped entries are counted and reported at the end.
+# LOG_ASYNC=false sends every entry straight away, like before.
+
+log_sinks = [sink.strip() for sink in os.environ.get("LOG_SINKS", "cloud").split(',') if sink.strip()]
+log_file = os.environ.get("LOG_FILE")
+log_async = os.environ.get("LOG_ASYNC", "true").lower() in ('1', 'true', 'yes')
+queue_size = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+batch_size = int(os.environ.get("LOG_BATCH_SIZE", 200))
+flush_seconds = float(os.environ.get("LOG_FLUSH_SECONDS", 2.0))
+drop_policy = os.environ.get("LOG_DROP_POLICY", "drop-newest")
+exit_timeout = float(os.environ.get("LOG_EXIT_TIMEOUT", 10.0)) # How long to wait for queued entries to be sent on exit
+
+DROP_POLICIES = ('drop-newest', 'drop-oldest', 'block')
+DEFAULT_LOG_NAME = 'birdwatch-scraper' # for the jsonl sink, when the script has no LOG_ID
+
+
+class CloudSink:
+    def __init__(self, name, project=None):
+        # Only imported when it's needed, so the jsonl sink works without google-cloud-logging installed
+        import google.cloud.logging
+        self.logger = google.cloud.logging.Client(project=project).logger(name=name)
+
+    def write(self, entries):
+        batch = self.logger.batch()
+        for kind, payload, fields in entries:
+            if kind == 'struct':
+                batch.log_struct(payload, **fields)
+            else:
+                batch.log_text(payload, **fields)
+        batch.commit()
+
+
+class JsonLinesSink:
+    def __init__(self, name, path=None):
+        self.name = name or DEFAULT_LOG_NAME
+        self.file = open(path or self.name + '.jsonl', 'a')
+
+    def write(self, entries):
+        for kind, payload, fields in entries:
+            line = {"logName": self.name}
+            line.update({key: value for key, value in fields.items() if key != 'timestamp'})
+            line["timestamp"] = fields["timestamp"].isoformat()
+            if kind == 'struct':
+                line.update(payload)
+            else:
+                line["message"] = payload
+            self.file.write(json.dumps(line, default=str) + '\n')
+        self.file.flush()
+
+
+class StructuredLogger:
+    def __init__(self, sinks, asynchronous=True, max_queued=None, max_batch=None, policy=None):
+        self.sinks = sinks
+        self.asynchronous = asynchronous
+        self.max_batch = max_batch or batch_size
+        self.policy = policy or drop_policy
+        if self.policy not in DROP_POLICIES:
+            raise ValueError(f'LOG_DROP_POLICY must be one of {", ".join(DROP_POLICIES)}, not {self.policy}')
+        self.counts = {"logged": 0, "sent": 0, "dropped": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queued or queue_size)
+        self.thread = None
+        if asynchronous:
+            self.thread = threading.Thread(target=self.run, name='structured-log', daemon=True)
+            self.thread.start()
+
+    def log_struct(self, info, **fields):
+        self.enqueue('struct', dict(info), fields)
+
+    def log_text(self, text, **fields):
+        self.enqueue('text', str(text), fields)
+
+    def log(self, message, **fields):
+        if isinstance(message, dict):
+            self.log_struct(message, **fields)
+        else:
+            self.log_text(message, **fields)
+
+    def enqueue(self, kind, payload, fields):
+        # When it happened, rather than when it gets sent
+        fields.setdefault('timestamp', datetime.now(timezone.utc))
+        entry = (kind, payload, fields)
+        with self.lock:
+            self.counts["logged"] += 1
+        if not self.asynchronous:
+            self.send([entry])
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            if self.policy == 'block':
+                self.queue.put(entry)
+                return
+            with self.lock:
+                self.counts["dropped"] += 1
+                if self.policy == 'drop-oldest':
+                    self.replace_oldest(entry)
+
+    def replace_oldest(self, entry):
+        # Swaps the oldest queued log entry for entry. The flush() and close() markers are never the ones
+        # thrown away, since something is waiting on them; if the queue is nothing but markers, entry is dropped
+        with self.queue.mutex:
+            for index, item in enumerate(self.queue.queue):
+                if isinstance(item, tuple):
+                    del self.queue.queue[index]
+                    self.queue.queue.append(entry)
+                    return
+
+    def send(self, entries):
+        sent = True
+        for sink in self.sinks:
+            try:
+                sink.write(entries)
+            except Exception as e:
+                # Nowhere to log this to but stderr
+                print(f'Unable to send {len(entries)} log entries to {type(sink).__name__} ({type(e).__name__}: {e})', file=sys.stderr)
+                sent = False
+        with self.lock:
+            self.counts["sent" if sent else "failed"] += len(entries)
+
+    def run(self):
+        # The background thread: sends entries in batches until it's told to stop
+        while True:
+            batch = []
+            markers = []
+            item = self.queue.get()
+            deadline = time.monotonic() + flush_seconds
+            while True:
+                if isinstance(item, threading.Event) or item is None:
+                    # flush() or close() - send what we have now
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self.send(batch)
+            for marker in markers:
+                if marker is None:
+                    return
+                marker.set()
+
+    def flush(self, timeout=None):
+        # Waits until everything logged so far has been sent. Returns False if that took longer than timeout
+        if not self.asynchronous or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        flushed = self.flush(timeout)
+        if self.asynchronous and self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+                self.thread.join(timeout)
+            except queue.Full:
+                pass
+        if self.counts["dropped"] or self.counts["failed"] or not flushed:
+            print(f'Log entries: {self.counts["logged"]} logged, {self.counts["sent"]} sent, {self.counts["dropped"]} dropped because the queue was full, {self.counts["failed"]} failed to send' + ('' if flushed else ' (gave up waiting for the rest)'), file=sys.stderr)
+
+    def stats(self):
+        return dict(self.counts, queued=self.queue.qsize())
+
+
+def get_logger(name, project=None, sinks=None, asynchronous=None):
+    # e.g. logger = structured_log.get_logger(log_name, project_id)
+    sinks = sinks or log_sinks
+    if asynchronous is None:
+        asynchronous = log_async
+    outputs = []
+    for sink in sinks:
+        if sink == 'cloud':
+            outputs.append(CloudSink(name, project))
+        elif sink == 'jsonl':
+            outputs.append(JsonLinesSink(name, log_file))
+        else:
+            raise ValueError(f'Unknown log sink {sink} (expected cloud or jsonl)')
+    logger = StructuredLogger(outputs, asynchronous)
+    atexit.register(logger.close, exit_timeout)
+    return logger
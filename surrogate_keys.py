@@ -0,0 +1,41 @@
+import pandas as pd
+from datetime import datetime
+
+# Builds the surrogate primary keys that the importers add to each dataset (ratingsId, statusId)
+#
+# These used to be built with df[[...]].astype(str).apply(lambda x: ''.join(x), axis=1), which calls a
+# python function for every single row. Concatenating whole columns of strings at once gives exactly the
+# same keys (so rows that are already in the database still conflict), but is a lot faster.
+# See benchmark-keys.py for a comparison of the two.
+
+
+def as_str(column):
+    # Same result as column.astype(str). For plain integer columns (noteId, timestamps) going through
+    # python ints is quicker than pandas' own conversion, and str(int) can't be formatted any other way
+    if pd.api.types.is_integer_dtype(column) and not pd.api.types.is_extension_array_dtype(column):
+        return pd.Series(list(map(str, column.tolist())), index=column.index, dtype=object)
+    return column.astype(str)
+
+
+def build_key(df, columns):
+    # Equivalent to df[columns].astype(str).apply(lambda x: ''.join(x), axis=1)
+    key = as_str(df[columns[0]])
+    for column in columns[1:]:
+        key = key + as_str(df[column])
+    return key
+
+
+def ratings_id(df):
+    return build_key(df, ['noteId', 'raterParticipantId'])
+
+
+def status_history_id(df):
+    # Some older noteStatusHistory files used participantId instead of noteAuthorParticipantId
+    for author_column in ['noteAuthorParticipantId', 'participantId']:
+        if 'noteId' in df.columns and author_column in df.columns:
+            return build_key(df, ['noteId', author_column])
+    return 'IDERROR' + datetime.now().strftime('%s')
+
+
+def enrollment_status_id(df):
+    return build_key(df, ['participantId', 'timestampOfLastStateChange'])
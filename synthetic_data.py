@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+import os
+import schemas
+
+# Synthetic Birdwatch-shaped data for the benchmarks
+#
+# The columns, value ranges and missing values roughly follow the real exports, so that parsing and
+# loading them costs about the same as the real thing. None of it means anything.
+#
+# Everything is generated from a seed, so the same arguments always give exactly the same files.
+
+FIRST_NOTE_ID = 1350000000000000000
+CHUNK_ROWS = 1000000 # Big files are generated and written this many rows at a time
+
+CLASSIFICATIONS = ['MISINFORMED_OR_POTENTIALLY_MISLEADING', 'NOT_MISLEADING']
+STATUSES = ['NEEDS_MORE_RATINGS', 'CURRENTLY_RATED_HELPFUL', 'CURRENTLY_RATED_NOT_HELPFUL']
+ENROLLMENT_STATES = ['newUser', 'earnedIn', 'atRisk', 'earnedOutNoAcknowledge', 'earnedOutAcknowledged']
+WORDS = np.array(['the', 'video', 'claim', 'is', 'from', '2019', 'and', 'not', 'this', 'year', 'source', 'says', 'photo', 'shows', 'a', 'different', 'event', 'https://example.com/article', 'reported', 'by'])
+
+
+def participants(rng, count):
+    # Participant ids are 64 character hex strings
+    return np.array(['%064X' % rng.integers(0, 2**63) for i in range(count)])
+
+
+def note_ids(rows, seed=0):
+    # Unique, increasing noteIds that look like tweet snowflake ids
+    rng = np.random.default_rng(seed)
+    return FIRST_NOTE_ID + np.cumsum(rng.integers(1, 1000000000, size=rows, dtype=np.int64))
+
+
+def timestamps(rng, rows, missing=0.0):
+    # Millisecond timestamps, with roughly missing of them blank
+    values = pd.array(rng.integers(1611000000000, 1700000000000, size=rows, dtype=np.int64), dtype='Int64')
+    if missing:
+        values[rng.random(rows) < missing] = pd.NA
+    return values
+
+
+def summaries(rng, rows):
+    lengths = rng.integers(5, 40, size=rows)
+    words = WORDS[rng.integers(0, len(WORDS), size=lengths.sum())]
+    return [' '.join(words[end - length:end]) for end, length in zip(np.cumsum(lengths), lengths)]
+
+
+def notes(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        'noteId': note_ids(rows, seed),
+        'noteAuthorParticipantId': participants(rng, rows)[rng.permutation(rows)],
+        'createdAtMillis': rng.integers(1611000000000, 1700000000000, size=rows, dtype=np.int64),
+        'tweetId': timestamps(rng, rows, missing=0.05) * 1000000,
+        'classification': rng.choice(CLASSIFICATIONS, size=rows, p=[0.8, 0.2]),
+        'believable': rng.choice(['BELIEVABLE_BY_MANY', 'BELIEVABLE_BY_FEW', ''], size=rows),
+        'harmful': rng.choice(['CONSIDERABLE_HARM', 'LITTLE_HARM', ''], size=rows),
+        'validationDifficulty': rng.choice(['EASY', 'CHALLENGING', ''], size=rows),
+    }
+    for column in schemas.NOTES_FLAGS:
+        columns[column] = rng.integers(0, 2, size=rows)
+    columns['summary'] = summaries(rng, rows)
+    return pd.DataFrame(columns)
+
+
+def ratings(rows, seed=0, note_id_pool=None):
+    # note_id_pool makes the ratings refer to those noteIds, rather than random ones
+    rng = np.random.default_rng(seed)
+    raters = participants(rng, min(rows, 200000))
+    if note_id_pool is None:
+        rated = rng.integers(1350000000000000000, 1700000000000000000, size=rows, dtype=np.int64)
+    else:
+        rated = note_id_pool[rng.integers(0, len(note_id_pool), size=rows)]
+    columns = {
+        'noteId': rated,
+        'raterParticipantId': raters[rng.integers(0, len(raters), size=rows)],
+        'createdAtMillis': rng.integers(1611000000000, 1700000000000, size=rows, dtype=np.int64),
+        'version': rng.choice([1, 2], size=rows),
+        # Older ratings don't have a helpfulnessLevel
+        'helpfulnessLevel': rng.choice(['HELPFUL', 'SOMEWHAT_HELPFUL', 'NOT_HELPFUL', ''], size=rows),
+    }
+    for column in schemas.RATINGS_FLAGS:
+        columns[column] = rng.integers(0, 2, size=rows)
+    return pd.DataFrame(columns)
+
+
+def status_history(rows, seed=0):
+    # One row per note, for the same notes as notes(rows, seed)
+    rng = np.random.default_rng(seed + 1)
+    note = notes(rows, seed)
+    rated = rng.random(rows) < 0.3 # Most notes never get out of NEEDS_MORE_RATINGS
+    def when(fraction=1.0):
+        values = timestamps(rng, rows)
+        values[~rated | (rng.random(rows) >= fraction)] = pd.NA
+        return values
+    return pd.DataFrame({
+        'noteId': note['noteId'],
+        'noteAuthorParticipantId': note['noteAuthorParticipantId'],
+        'createdAtMillis': note['createdAtMillis'],
+        'timestampMillisOfFirstNonNMRStatus': when(),
+        'firstNonNMRStatus': np.where(rated, rng.choice(STATUSES[1:], size=rows), ''),
+        'timestampMillisOfCurrentStatus': timestamps(rng, rows),
+        'currentStatus': np.where(rated, rng.choice(STATUSES[1:], size=rows), STATUSES[0]),
+        'timestampMillisOfLatestNonNMRStatus': when(),
+        'mostRecentNonNMRStatus': np.where(rated, rng.choice(STATUSES[1:], size=rows), ''),
+        'timestampMillisOfStatusLock': when(0.5),
+        'lockedStatus': np.where(rated & (rng.random(rows) < 0.5), rng.choice(STATUSES, size=rows), ''),
+        'timestampMillisOfRetroLock': when(0.1),
+    })
+
+
+def enrollment(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'participantId': participants(rng, rows),
+        'enrollmentState': rng.choice(ENROLLMENT_STATES, size=rows, p=[0.3, 0.55, 0.05, 0.05, 0.05]),
+        'successfulRatingNeededToEarnIn': rng.integers(0, 10, size=rows),
+        'timestampOfLastStateChange': rng.integers(1611000000000, 1700000000000, size=rows, dtype=np.int64),
+        'timestampOfLastEarnOut': timestamps(rng, rows, missing=0.9),
+        'modelingPopulation': rng.choice(['CORE', 'EXPANSION'], size=rows, p=[0.9, 0.1]),
+    })
+
+
+def write_tsv(df, path, header=True, mode='w'):
+    df.to_csv(path, sep='\t', index=False, header=header, mode=mode)
+
+
+def write_ratings_shards(directory, rows, shards=10, seed=0, note_id_pool=None):
+    # Splits rows ratings across ratings00000.tsv ... files in directory, generating up to CHUNK_ROWS at a
+    # time so that 50M rows doesn't need 50M rows' worth of memory. Returns the paths
+    paths = []
+    per_shard = -(-rows // shards)
+    for shard in range(shards):
+        path = os.path.join(directory, 'ratings' + str(shard).zfill(5) + '.tsv')
+        # The last few shards can be left with nothing when there are fewer rows than shards. Those are
+        # still written, with only the header
+        shard_rows = max(0, min(per_shard, rows - shard * per_shard))
+        for chunk, start in enumerate(range(0, max(shard_rows, 1), CHUNK_ROWS)):
+            df = ratings(min(CHUNK_ROWS, shard_rows - start), seed=seed * 100000 + shard * 1000 + chunk, note_id_pool=note_id_pool)
+            write_tsv(df, path, header=chunk == 0, mode='w' if chunk == 0 else 'a')
+        paths.append(path)
+    return paths
+
+
+def write_day(directory, ratings_rows, shards=10, seed=0, notes_rows=None, enrollment_rows=None):
+    # Writes a whole day's export into directory, named the way they are in the bucket:
+    # notes00004.tsv, ratings00000.tsv ..., noteStatusHistory.tsv and userEnrollmentStatus.tsv
+    # The other datasets are sized relative to the ratings, about as they are in the real exports
+    # Returns the number of rows written for each dataset
+    if notes_rows is None:
+        notes_rows = max(ratings_rows // 40, 1)
+    if enrollment_rows is None:
+        enrollment_rows = max(ratings_rows // 25, 1)
+    os.makedirs(directory, exist_ok=True)
+    note = notes(notes_rows, seed)
+    write_tsv(note, os.path.join(directory, 'notes00004.tsv'))
+    write_ratings_shards(directory, ratings_rows, shards, seed, note['noteId'].to_numpy())
+    del note
+    write_tsv(status_history(notes_rows, seed), os.path.join(directory, 'noteStatusHistory.tsv'))
+    write_tsv(enrollment(enrollment_rows, seed), os.path.join(directory, 'userEnrollmentStatus.tsv'))
+    return {'notes': notes_rows, 'ratings': ratings_rows, 'noteStatusHistory': notes_rows, 'userEnrollmentStatus': enrollment_rows}
@@ -0,0 +1,45 @@
+import importlib.util, os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import backfill, dataset_importer, snapshot_diff, storage_session, structured_log, synthetic_data, tsv_reader
+
+# BACKFILL_DEDUP with the streaming importer: a sharded day that is identical to the previous one should send
+# nothing, since every one of its shards is compared against the whole of the previous day
+
+DAYS = ['2023/01/04', '2023/01/05']
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name[:-len('.py')].replace('-', '_'), os.path.join(ROOT, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_identical_sharded_day_sends_no_rows(tmp_path, monkeypatch):
+    for day in DAYS:
+        synthetic_data.write_day(str(tmp_path.joinpath(*day.split('/'))), 9000, shards=3, seed=1)
+    monkeypatch.setattr(storage_session, 'local_root', str(tmp_path))
+    monkeypatch.setattr(structured_log, 'log_sinks', ['jsonl'])
+    monkeypatch.setattr(structured_log, 'log_file', str(tmp_path / 'log.jsonl'))
+    monkeypatch.setattr(snapshot_diff, 'cross_day_dedup', True)
+    monkeypatch.setattr(tsv_reader, 'tsv_chunk_rows', 1000)
+    # As if backfill.run() was loading both days
+    units = set(backfill.work_units(DAYS, ['ratings']))
+    monkeypatch.setattr(backfill, 'pending_units', units)
+    monkeypatch.setattr(backfill, 'covered_units', units)
+
+    import_old_tsv = load_script('import-old-tsv.py')
+    import_old_tsv.setup()
+    importer = import_old_tsv.importer
+    dataset = dataset_importer.DATASETS['ratings']
+
+    def sent(day):
+        objects = importer.objects(dataset, day)
+        assert len(objects) == 3
+        return sum(chunk.shape[0] for chunk in importer.chunks(dataset, objects, day, None, []))
+
+    assert sent(DAYS[0]) == 9000
+    assert sent(DAYS[1]) == 0
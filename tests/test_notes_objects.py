@@ -0,0 +1,38 @@
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dataset_importer, storage_session
+
+# A day's notes are one file, whatever it's called. notes00000.tsv and notes00004.tsv aren't shards of it, so
+# on a day that has both only notes00004.tsv (which import-tsv.py has always read) is imported
+
+DAY = '2023/01/05'
+
+
+def objects(tmp_path, monkeypatch, names, dataset='notes'):
+    directory = tmp_path.joinpath(*DAY.split('/'))
+    directory.mkdir(parents=True)
+    for name in names:
+        directory.joinpath(name).write_text('noteId\n1\n')
+    monkeypatch.setattr(storage_session, 'local_root', str(tmp_path))
+    importer = dataset_importer.Importer('b')
+    return importer.objects(dataset_importer.DATASETS[dataset], DAY)
+
+
+def test_notes00004_wins(tmp_path, monkeypatch):
+    assert objects(tmp_path, monkeypatch, ['notes00000.tsv', 'notes00004.tsv']) == [DAY + '/notes00004.tsv']
+
+
+def test_notes00000(tmp_path, monkeypatch):
+    assert objects(tmp_path, monkeypatch, ['notes00000.tsv']) == [DAY + '/notes00000.tsv']
+
+
+def test_unnumbered(tmp_path, monkeypatch):
+    assert objects(tmp_path, monkeypatch, ['notes.tsv', 'notes-old.tsv']) == [DAY + '/notes.tsv']
+
+
+def test_ratings_are_still_shards(tmp_path, monkeypatch):
+    shards = objects(tmp_path, monkeypatch, ['ratings00000.tsv', 'ratings00001.tsv'], 'ratings')
+    assert shards == [DAY + '/ratings00000.tsv', DAY + '/ratings00001.tsv']
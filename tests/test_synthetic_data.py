@@ -0,0 +1,16 @@
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+import synthetic_data
+
+# Fewer ratings than shards: every shard is still written, and the ones with nothing left in them only have the header
+
+
+def test_more_shards_than_rows(tmp_path):
+    paths = synthetic_data.write_ratings_shards(str(tmp_path), 25, shards=10)
+    sizes = [pd.read_csv(path, sep='\t').shape[0] for path in paths]
+    assert sizes == [3] * 8 + [1, 0]
+    assert pd.read_csv(paths[-1], sep='\t').columns[0] == 'noteId'
@@ -0,0 +1,159 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from pandas._libs.parsers import STR_NA_VALUES
+import os
+
+# Shared helpers for parsing the Birdwatch TSV files into DataFrames.
+#
+# read_tsv() loads a whole file at once, which is what the importers have always done.
+# read_tsv_chunks() instead yields DataFrames of at most TSV_CHUNK_ROWS rows, so a file can be
+# piped into the database (see bulk_load.load_chunks) without ever holding all of it in memory.
+# Set STREAMING_IMPORT=true to have the importers use the chunked version where they support it.
+#
+# TSV_ENGINE picks what does the parsing. 'c' is pandas' own parser, which only ever uses one core.
+# 'pyarrow' uses pyarrow's CSV reader, which splits the file into blocks and parses them on every core
+# (or TSV_PARSE_THREADS of them). Either way you get the same DataFrame: the same column types (after
+# applying the schema), and blanks and 'NA'-style values are missing values in both.
+# See benchmark-parse.py for comparing the two.
+
+tsv_chunk_rows = int(os.environ.get("TSV_CHUNK_ROWS", 250000))
+streaming_import = os.environ.get("STREAMING_IMPORT", "false").lower() in ('1', 'true', 'yes')
+tsv_engine = os.environ.get("TSV_ENGINE", "c")
+parse_threads = int(os.environ.get("TSV_PARSE_THREADS", 0)) # 0 means use every core
+
+if parse_threads:
+    pa.set_cpu_count(parse_threads)
+
+# How each schema type is parsed by pyarrow, before being turned into the pandas type
+ARROW_TYPES = {
+    'int64': pa.int64(),
+    'Int64': pa.int64(),
+    'uint8': pa.uint8(),
+    'UInt8': pa.uint8(),
+    'string[pyarrow]': pa.string(),
+    'category': pa.string(),
+    'object': pa.string(),
+}
+
+
+# The nullable version of each type, which a blank value can't break
+NULLABLE_TYPES = {
+    'int64': 'Int64',
+    'uint8': 'UInt8',
+}
+
+# How pyarrow's integers come out in pandas, so that a missing value doesn't turn a column of IDs into floats
+PANDAS_TYPES = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.uint8(): pd.UInt8Dtype(),
+}
+
+
+def nullable(dtype):
+    if not dtype:
+        return dtype
+    return {column: NULLABLE_TYPES.get(type, type) for column, type in dtype.items()}
+
+
+def conform(df, dtype):
+    # Puts a chunk read with nullable(dtype) back into dtype's own types, except for the columns that have
+    # blanks in this chunk, which stay nullable
+    strict = {column: type for column, type in (dtype or {}).items() if type in NULLABLE_TYPES and column in df.columns and not df[column].hasnans}
+    return df.astype(strict) if strict else df
+
+
+def arrow_options(dtype):
+    parse_options = pa_csv.ParseOptions(delimiter='\t', newlines_in_values=True)
+    # Treat the same values as missing that pandas does
+    convert_options = pa_csv.ConvertOptions(
+        null_values=sorted(STR_NA_VALUES),
+        strings_can_be_null=True,
+        column_types={column: ARROW_TYPES[type] for column, type in (dtype or {}).items() if type in ARROW_TYPES})
+    return parse_options, convert_options
+
+
+def arrow_to_pandas(table, dtype, start_row=0):
+    df = table.to_pandas(types_mapper=PANDAS_TYPES.get if dtype else None)
+    if start_row:
+        # Number the rows the way pandas' chunked reader does
+        df.index = pd.RangeIndex(start_row, start_row + df.shape[0])
+    if dtype:
+        df = df.astype({column: type for column, type in dtype.items() if column in df.columns})
+    return df
+
+
+def parse(path, dtype, engine):
+    if engine == 'pyarrow':
+        parse_options, convert_options = arrow_options(dtype)
+        return arrow_to_pandas(pa_csv.read_csv(path, parse_options=parse_options, convert_options=convert_options), dtype)
+    return pd.read_csv(path, sep='\t', header=0, dtype=dtype)
+
+
+def read_tsv(path, dtype=None, engine=None):
+    # dtype is usually schemas.dtypes_for(object) (see schemas.py)
+    if engine is None:
+        engine = tsv_engine
+    try:
+        df = parse(path, dtype, engine)
+    except (TypeError, ValueError) as e:
+        if dtype is None:
+            raise
+        # A file that doesn't match its schema still gets imported, just without the compact types
+        print(f'File did not match its schema ({e}) - reading it again without one')
+        if hasattr(path, 'seek'):
+            path.seek(0)
+        df = parse(path, None, engine)
+    return df
+
+
+def read_tsv_chunks(path, chunk_rows=None, dtype=None, engine=None):
+    # The same as read_tsv(), a chunk at a time. The chunks are parsed with nullable types, so a blank in an
+    # integer or flag column doesn't stop the file halfway through, after some of it has already been loaded.
+    # A file that doesn't match its schema in some other way is read again without one, like read_tsv(),
+    # as long as that shows up in the first chunk. After that, the error is raised
+    chunks = parse_chunks(path, chunk_rows, dtype, engine)
+    try:
+        first = next(chunks, None)
+    except (TypeError, ValueError) as e:
+        if dtype is None:
+            raise
+        print(f'File did not match its schema ({e}) - reading it again without one')
+        if hasattr(path, 'seek'):
+            path.seek(0)
+        chunks = parse_chunks(path, chunk_rows, None, engine)
+        first = next(chunks, None)
+    if first is None:
+        return
+    yield first
+    yield from chunks
+
+
+def parse_chunks(path, chunk_rows, dtype, engine):
+    if chunk_rows is None:
+        chunk_rows = tsv_chunk_rows
+    if engine is None:
+        engine = tsv_engine
+    loose = nullable(dtype)
+    if engine == 'pyarrow':
+        parse_options, convert_options = arrow_options(loose)
+        reader = pa_csv.open_csv(path, parse_options=parse_options, convert_options=convert_options)
+        batches = []
+        rows = 0
+        start_row = 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            # pyarrow reads in blocks of its own size, so hand them on once there are at least chunk_rows
+            while rows >= chunk_rows:
+                table = pa.Table.from_batches(batches)
+                yield conform(arrow_to_pandas(table.slice(0, chunk_rows), loose, start_row), dtype)
+                batches = table.slice(chunk_rows).to_batches()
+                rows -= chunk_rows
+                start_row += chunk_rows
+        if rows:
+            yield conform(arrow_to_pandas(pa.Table.from_batches(batches, schema=reader.schema), loose, start_row), dtype)
+        return
+    with pd.read_csv(path, sep='\t', header=0, chunksize=chunk_rows, dtype=loose) as reader:
+        for chunk in reader:
+            yield conform(chunk, dtype)
@@ -1,12 +1,11 @@
 from google.cloud import storage
-import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from google.cloud.sql.connector import Connector, IPTypes
-import google.cloud.logging
 from datetime import datetime
 from dotenv import load_dotenv, find_dotenv
 import os, sqlalchemy, pg8000, socket
+import storage_session, structured_log, stage_timer, dataset_importer
 
 # REQUIREMENTS
 #
@@ -28,8 +27,8 @@ start_date = os.environ.get("DATE_OVERRIDE", date.today().strftime("%Y%m%d")).re
 
 
 # Set up Google cloud logging:
-log_client = google.cloud.logging.Client(project=project_id)
-logger = log_client.logger(name=log_name)
+# Log calls only queue the entry - it's sent in the background (see structured_log.py)
+logger = structured_log.get_logger(log_name, project_id)
 
 
 
@@ -101,25 +100,15 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 # [END cloud_sql_postgres_sqlalchemy_connect_connector]
 
 
-def retrieve_tsv(object):
-    path = 'gs://' + bucket_name + '/' + object
-    print(f'Loading {path} into a pandas DataFrame...')
-    logger.log_struct(
-            {
-                "message": "Retrieving TSV and loading into Pandas dataframe",
-                "severity": "INFO",
-                "object": str(object),
-                "gcs-path": str(path)
-            })
-    # gs://birdwatch-scraper_public-data/2022/11/12/ratings.tsv
-    df = pd.read_csv(path, sep='\t', header=0)
-    return df
+# Imported the same way as in import-tsv.py (see dataset_importer.py)
+importer = dataset_importer.Importer(bucket_name, project_id, logger)
 
 
 def main(event_data, context):
     # We have to include event_data and context because these will be passed as arguments when invoked as a Cloud Function
     # and the runtime will freak out if the function only accepts 0 arguments... go figure
     print('Started Execution')
+    stage_timer.reset()
     
     
     # Set up a db connection pool
@@ -128,7 +117,6 @@ def main(event_data, context):
         # Using a with statement ensures that the connection is always released
         # back into the pool at the end of statement (even if an error occurs)
         conn = db.raw_connection()
-        cur = conn.cursor()
         print('db connection seems to have worked')
         logger.log('Database Connection was successful')
     except Exception as e:
@@ -149,85 +137,9 @@ def main(event_data, context):
     file_path = os.environ.get("DATE_OVERRIDE", date.today().strftime("%Y/%m/%d"))
 
     ## Get userEnrollmentStatus ##
-    try:
-        object = file_path + '/userEnrollmentStatus.tsv'
-        table_name = 'temp_enrollment_' + start_date
-        df = retrieve_tsv(object)
-        df.sort_values(by=['timestampOfLastStateChange'], ascending=False, inplace=True)
-        # Participant Ids may be duplicated (because the same user's status may change), so we concatenate with the timestamp to create a primary key
-        df['statusId'] = df[['participantId', 'timestampOfLastStateChange']].astype(str).apply(lambda x: ''.join(x), axis=1)
-        print(df.info())
-        print(df)
-        # Only keep the top 10% of the dataframe - we are almost always dealing with duplicated data, so this will improve runtime
-        size = df.shape[0]
-        drop = int(size * 0.9)
-        # drop = int(size - 10) # only keep 10 rows. A small number for testing so things move quickly
-        df.drop(df.tail(drop).index, inplace = True)
-        logger.log_struct(
-            {
-                "message": 'Dropped rows from dataframe',
-                "original-size": str(size),
-                "dropped-rows": str(drop),
-                "new-size": str(df.shape[0]),
-                "severity": 'INFO',
-            }
-        )
-        print("***")
-        print(df)
-        print('Now converting dataframe into sql and placing in a temporary table')
-        logger.log_struct(
-            {
-                "message": 'Now converting dataframe into sql and placing into a temporary table',
-                "severity": "INFO",
-                "object": str(object),
-                "table-name": table_name
-            }
-        )
-        df.to_sql(table_name, db, if_exists='replace')
-
-        # Some older data is likely to not include the modelPopulation value, so we add that column if it's not present. It will contain null data, but we add it just in case.
-        with db.begin() as cn:
-            # sql = text("""INSERT INTO enrollment_status SELECT * FROM """ + table_name + """ ON CONFLICT DO NOTHING""")
-            sql = text('ALTER TABLE ' + table_name + ' ADD COLUMN IF NOT EXISTS "modelingPopulation" TEXT;')
-            cn.execute(sql)
-
-        print('Now copying into the real table...')
-        logger.log('Copying temp_userenrollment into enrollment_status', severity="INFO")
-        with db.begin() as cn:
-            # sql = text("""INSERT INTO enrollment_status SELECT * FROM """ + table_name + """ ON CONFLICT DO NOTHING""")
-            sql = text('INSERT INTO enrollment_status ("participantId", "enrollmentState", "successfulRatingNeededToEarnIn", "timestampOfLastStateChange", "timestampOfLastEarnOut", "modelingPopulation", "statusId") SELECT "participantId", "enrollmentState", "successfulRatingNeededToEarnIn", "timestampOfLastStateChange", "timestampOfLastEarnOut", "modelingPopulation", "statusId" FROM ' + table_name + ' ON CONFLICT DO NOTHING;')
-            cn.execute(sql)
-        try:
-            cur.execute("""DROP TABLE IF EXISTS """ + table_name + """ CASCADE;""")
-            logger.log_struct(
-                {
-                    "message": 'Dropped temporary table',
-                    "severity": 'INFO',
-                    "table-name": table_name
-                }
-            )
-        except Exception as e:
-            print('Unable to drop a temp table. Does it actually exist?')
-            print(str(type(e)))
-            logger.log_struct(
-                {
-                    "message": "Error when dropping temp_enrollment",
-                    "severity": "WARNING",
-                    "table-name": table_name,
-                    "exception": str(type(e))
-                })
-        conn.commit()
-    except Exception as e:
-        print('Error when processing userEnrollmentStatus:')
-        print(str(type(e)))
-        message = e.args[0]
-        logger.log_struct(
-            {
-                "message": "Error when retreiving userEnrollmentStatus.tsv",
-                "severity": "WARNING",
-                "exception": str(type(e)),
-                "error": message
-            })
+    # Everything runs on conn, so the staging table can be a TEMP table. db is only used for LOAD_METHOD=to_sql
+    dataset = dataset_importer.DATASETS['userEnrollmentStatus']
+    importer.run(dataset, conn, file_path, dataset.staging_table(start_date), engine=db)
 
     
     print('Attempting to Commit any lingering SQL changes')
@@ -250,8 +162,12 @@ def main(event_data, context):
     logger.log('Closing the db connection', severity="INFO")
     conn.close()
 
+    # Includes how many files came from the local cache (see blob_cache.py)
+    storage_session.log_stats(logger)
+    stage_timer.finish('user-enrollment-only', logger)
 
-
+    # Make sure everything logged has been sent before a Cloud Function invocation returns
+    logger.flush(structured_log.exit_timeout)
     print('Done!')
 
 if __name__ == "__main__":
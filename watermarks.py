@@ -0,0 +1,99 @@
+import pandas as pd
+import os
+
+# Incremental imports using a per-table high-water mark stored in the database.
+#
+# Each daily export is a full snapshot, so most of every file is already in the database. Rather than
+# sorting the whole file and keeping the newest 10% (which can miss real updates, like a status change
+# on an old note), we remember the newest timestamp we have loaded for each table and only pass on rows
+# that are newer than that. For tables where rows change over time, every timestamp column that moves
+# when the row changes is checked - so a note whose status changed today is picked up even if the note
+# itself is months old.
+#
+# IMPORT_MODE=trim goes back to the old "keep the top 10%" behavior.
+
+import_mode = os.environ.get("IMPORT_MODE", "incremental")
+# Rows slightly older than the watermark are still let through, in case an export included a row late.
+# Anything that is already in the database is skipped by ON CONFLICT anyway
+overlap_millis = int(os.environ.get("WATERMARK_OVERLAP_MILLIS", 24 * 60 * 60 * 1000))
+
+WATERMARK_COLUMNS = {
+    'notes': ['createdAtMillis'],
+    'ratings': ['createdAtMillis'],
+    'status_history': ['createdAtMillis', 'timestampMillisOfFirstNonNMRStatus', 'timestampMillisOfCurrentStatus', 'timestampMillisOfLatestNonNMRStatus', 'timestampMillisOfStatusLock', 'timestampMillisOfRetroLock'],
+    'enrollment_status': ['timestampOfLastStateChange', 'timestampOfLastEarnOut'],
+}
+
+
+def ensure_table(connection):
+    # Every dataset's pipeline calls this, and they run at the same time with IMPORT_WORKERS > 1. Two
+    # CREATE TABLE IF NOT EXISTS racing each other can still fail (on pg_type's unique index), so the create
+    # is done under an advisory lock, and only when the table isn't there yet
+    cursor = connection.cursor()
+    cursor.execute("SELECT to_regclass('import_watermarks');")
+    if cursor.fetchone()[0] is None:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('import_watermarks'));")
+        cursor.execute('CREATE TABLE IF NOT EXISTS import_watermarks ("tableName" TEXT PRIMARY KEY, "highWaterMark" BIGINT NOT NULL, "updatedAt" TIMESTAMP NOT NULL DEFAULT now());')
+        # Releases the lock
+        connection.commit()
+    cursor.close()
+
+
+def get_watermark(connection, table):
+    # Returns None if we have never loaded anything into this table
+    ensure_table(connection)
+    cursor = connection.cursor()
+    cursor.execute('SELECT "highWaterMark" FROM import_watermarks WHERE "tableName" = %s;', (table,))
+    row = cursor.fetchone()
+    cursor.close()
+    connection.commit()
+    return row[0] if row else None
+
+
+def set_watermark(connection, table, value):
+    # Only ever moves forward. Call this once the rows have actually been committed to the table
+    if value is None:
+        return
+    ensure_table(connection)
+    cursor = connection.cursor()
+    cursor.execute('INSERT INTO import_watermarks ("tableName", "highWaterMark") VALUES (%s, %s) ON CONFLICT ("tableName") DO UPDATE SET "highWaterMark" = GREATEST(import_watermarks."highWaterMark", EXCLUDED."highWaterMark"), "updatedAt" = now();', (table, int(value)))
+    cursor.close()
+    connection.commit()
+
+
+def row_marks(df, table):
+    # The newest timestamp on each row, out of the columns that move when the row is added or changed
+    columns = [column for column in WATERMARK_COLUMNS[table] if column in df.columns]
+    marks = df[columns].apply(pd.to_numeric, errors='coerce')
+    return marks.max(axis=1).fillna(-1)
+
+
+def filter_rows(df, table, mark):
+    # Returns (rows newer than the watermark, the newest timestamp seen in df)
+    marks = row_marks(df, table)
+    newest = int(marks.max()) if len(marks) else None
+    if mark is None:
+        return df, newest
+    return df[marks > mark - overlap_millis], newest
+
+
+def filter_dataframe(df, table, connection, logger=None):
+    # Look up the watermark for table and drop everything in df that is already loaded
+    # Returns the filtered DataFrame and the watermark to save with set_watermark() once it has been inserted
+    mark = get_watermark(connection, table)
+    size = df.shape[0]
+    df, newest = filter_rows(df, table, mark)
+    new_mark = max(value for value in [mark, newest, -1] if value is not None)
+    print(f'Kept {df.shape[0]} of {size} rows that are newer than the watermark for {table} ({mark})')
+    if logger:
+        logger.log_struct(
+            {
+                "message": 'Filtered rows against the watermark',
+                "severity": 'INFO',
+                "table": table,
+                "watermark": str(mark),
+                "new-watermark": str(new_mark),
+                "original-size": str(size),
+                "new-size": str(df.shape[0])
+            })
+    return df, new_mark